@@ -0,0 +1,83 @@
+import os
+import time
+
+# Synthetic filesystem shared by the stand-in btrfs and btrfs-find-root executables.
+# Scale and speed come from the environment:
+#   BENCH_ROOTS       roots btrfs-find-root reports (default 64)
+#   BENCH_PATHS       distinct paths across all roots (default 20000)
+#   BENCH_LINE_DELAY  seconds to sleep after every output line (default 0)
+#   BENCH_REPLAY_DIR  directory of captured outputs to print instead, named
+#                     find-root.txt and restore-<root>.txt
+
+ROOTS = int(os.environ.get('BENCH_ROOTS', '64'))
+PATHS = int(os.environ.get('BENCH_PATHS', '20000'))
+LINE_DELAY = float(os.environ.get('BENCH_LINE_DELAY', '0'))
+REPLAY_DIR = os.environ.get('BENCH_REPLAY_DIR')
+
+FIRST_ROOT = 30408704
+ROOT_STEP = 16384
+TOP_GENERATION = 100000
+EXTENSIONS = [b'txt', b'conf', b'sql', b'jpg', b'py', b'log']
+
+
+def root_bytenr(index):
+    return FIRST_ROOT + index * ROOT_STEP
+
+
+def root_index(bytenr):
+    return (bytenr - FIRST_ROOT) // ROOT_STEP
+
+
+def path(number):
+    # Relative path as bytes; a few contain spaces or aren't valid UTF-8
+    directory = b'home/user%d/project%d/dir%d' % (number % 8, number // 1000 % 50, number % 97)
+    if number % 13 == 0:
+        name = b'notes %d.%s' % (number, EXTENSIONS[number % len(EXTENSIONS)])
+    elif number % 1009 == 0:
+        name = b'caf\xe9-%d.%s' % (number, EXTENSIONS[number % len(EXTENSIONS)])
+    else:
+        name = b'file%d.%s' % (number, EXTENSIONS[number % len(EXTENSIONS)])
+    return directory + b'/' + name
+
+
+def root_paths(index):
+    # Neighbouring roots share most of their paths, like successive generations do
+    for number in range(PATHS):
+        if (number + index) % 4:
+            yield number, path(number)
+
+
+class LineWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = []
+
+    def write(self, line):
+        if LINE_DELAY:
+            self.stream.write(line + b'\n')
+            self.stream.flush()
+            time.sleep(LINE_DELAY)
+            return
+        self.buffer.append(line)
+        if len(self.buffer) >= 4096:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(b'\n'.join(self.buffer) + b'\n')
+            self.buffer = []
+        self.stream.flush()
+
+
+def replay(name, stream):
+    if not REPLAY_DIR:
+        return False
+    try:
+        with open(os.path.join(REPLAY_DIR, name), 'rb') as f:
+            writer = LineWriter(stream)
+            for line in f:
+                writer.write(line.rstrip(b'\n'))
+            writer.flush()
+        return True
+    except FileNotFoundError:
+        return False
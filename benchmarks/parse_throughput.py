@@ -0,0 +1,94 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from btrfs_engine import DRY_RUN_RESTORING, LogChannel  # noqa: E402
+from btrfs_output import decode_path, read_line_blocks  # noqa: E402
+
+# Throughput of the 'btrfs restore -Divv' output parser, against captured output or a
+# synthetic listing:
+#   btrfs restore -t <root> -Divv --path-regex '^/.*' /dev/sdb1 /dev/null > capture.txt
+#   python benchmarks/parse_throughput.py capture.txt
+# "lines" is the old text-mode parser (decode, strip, split per line) for comparison.
+
+
+def synthetic_output(paths):
+    lines = []
+    for i in range(paths):
+        lines.append(b"Restoring /dev/null/home/user/project%d/src/module%d.py" % (i % 100, i))
+        if i % 10 == 0:
+            lines.append(b"Restoring /dev/null/home/user/My Documents/report %d.odt" % i)
+        if i % 1000 == 0:
+            lines.append(b"Restoring /dev/null/home/user/latin1-caf\xe9-%d.txt" % i)
+        if i % 50 == 0:
+            lines.append(b"Skipping existing file /dev/null/home/user/project%d" % (i % 100))
+    return b'\n'.join(lines) + b'\n'
+
+
+def parse_lines(data):
+    files = set()
+    log = LogChannel()
+    for line in io.TextIOWrapper(io.BytesIO(data), errors='replace'):
+        log.append(line.rstrip('\n'))
+        if line.startswith("Restoring"):
+            parts = line.split()
+            if len(parts) >= 2:
+                files.add(parts[1].replace('/dev/null/', ''))
+    return files
+
+
+def parse_blocks(data):
+    files = set()
+    log = LogChannel()
+    for block in read_line_blocks(io.BufferedReader(io.BytesIO(data))):
+        log.append_block(block)
+        files.update(map(decode_path, DRY_RUN_RESTORING.findall(block)))
+    return files
+
+
+def measure(parser, data, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        files = parser(data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {'seconds': best, 'mb_per_sec': len(data) / best / 1e6,
+            'lines_per_sec': data.count(b'\n') / best, 'files': len(files)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark btrfs restore output parsing.")
+    parser.add_argument('capture', nargs='?', help="captured 'btrfs restore -Divv' output (default: synthetic)")
+    parser.add_argument('--paths', type=int, default=500000, help="paths in the synthetic listing")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.capture:
+        with open(args.capture, 'rb') as f:
+            data = f.read()
+    else:
+        data = synthetic_output(args.paths)
+
+    results = {'bytes': len(data), 'lines': data.count(b'\n'),
+               'parsers': {'lines': measure(parse_lines, data, args.repeat),
+                           'blocks': measure(parse_blocks, data, args.repeat)}}
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return 0
+    print(f"{results['lines']} lines, {len(data) / 1e6:.1f} MB")
+    for name, result in results['parsers'].items():
+        print(f"{name:>6}: {result['seconds']:.3f}s  {result['mb_per_sec']:.1f} MB/s  "
+              f"{result['lines_per_sec'] / 1e6:.2f}M lines/s  {result['files']} files")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
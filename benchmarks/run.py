@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from btrfs_engine import ListEngine, RestoreEngine, chunk_restore_paths  # noqa: E402
+
+# Scaling benchmarks for the listing and restore pipeline. The btrfs and btrfs-find-root
+# stand-ins in benchmarks/fakebin are put first on PATH, so no btrfs device is needed:
+#   python benchmarks/run.py --roots 64 --paths 20000 --output bench_output.txt
+#   python benchmarks/run.py --compare bench_output.txt
+# Every phase records wall and CPU time and the growth of the peak RSS; --trace-memory
+# adds the peak of Python allocations at the cost of much slower runs.
+
+PHASES = ['discovery', 'parse', 'list', 'lookup', 'table', 'sort', 'restore']
+
+
+class Phase:
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.result = {}
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.cpu = time.process_time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.result['seconds'] = time.perf_counter() - self.started
+        self.result['cpu_seconds'] = time.process_time() - self.cpu
+        self.result['max_rss_growth_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self.rss
+        if self.trace_memory:
+            self.result['peak_alloc_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+
+
+def make_engine(device, args):
+    return ListEngine(device, False, '/.', max_workers=args.jobs, use_cache=False)
+
+
+def run_suite(args, device):
+    results = {}
+    state = {}
+
+    def phase(name):
+        entry = Phase(args.trace_memory)
+        results[name] = entry.result
+        return entry
+
+    if 'discovery' in args.phases:
+        engine = make_engine(device, args)
+        with phase('discovery') as p:
+            roots = engine.find_roots()
+        p.result['roots'] = len(roots)
+
+    if 'parse' in args.phases:
+        engine = make_engine(device, args)
+        root = engine.find_roots()[0]
+        with phase('parse') as p:
+            engine.scan_root(root)
+        p.result['lines'] = engine.lines_parsed
+        p.result['lines_per_sec'] = engine.lines_parsed / p.result['seconds']
+
+    if args.phases & {'list', 'lookup', 'table', 'sort', 'restore'}:
+        engine = make_engine(device, args)
+        with phase('list') as p:
+            files, scan_results = engine.run()
+        p.result['files'] = len(files)
+        p.result['roots_scanned'] = len(scan_results.root_names)
+        state['files'] = files
+        state['results'] = scan_results
+
+    if 'lookup' in args.phases:
+        with phase('lookup') as p:
+            file_roots = {path: state['results'].root_for(path) for path in state['files']}
+            groups = state['results'].group_by_root(state['files'])
+            batches = sum(1 for paths in groups.values() for _ in chunk_restore_paths(paths))
+        p.result['batches'] = batches
+        state['file_roots'] = file_roots
+
+    if args.phases & {'table', 'sort'}:
+        try:
+            os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+            from PyQt5.QtCore import Qt
+            from PyQt5.QtWidgets import QApplication
+            from btrfs_gui_restore import DeletedFilesModel
+        except ImportError as e:
+            results['table'] = results['sort'] = {'skipped': f"PyQt5 unavailable: {e}"}
+        else:
+            state['app'] = QApplication.instance() or QApplication([])
+            model = DeletedFilesModel()
+            with phase('table'):
+                model.set_files(state['files'])
+            with phase('sort') as p:
+                model.sort(0, Qt.AscendingOrder)
+                model.sort(1, Qt.DescendingOrder)
+            p.result['rows'] = len(model.files)
+
+    if 'restore' in args.phases:
+        file_roots = state.get('file_roots') or {path: state['results'].root_for(path) for path in state['files']}
+        with tempfile.TemporaryDirectory() as destination:
+            engine = RestoreEngine(device, destination, file_roots, use_sudo=False, max_workers=args.jobs)
+            with phase('restore') as p:
+                restored = engine.run()
+        p.result['restored'] = restored
+        p.result['selected'] = len(file_roots)
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(current, previous):
+    print(f"{'phase':<10} {'before':>10} {'after':>10} {'change':>8}", file=sys.stderr)
+    for name in PHASES:
+        before = previous['phases'].get(name, {}).get('seconds')
+        after = current['phases'].get(name, {}).get('seconds')
+        if before is None or after is None:
+            continue
+        print(f"{name:<10} {before:>9.3f}s {after:>9.3f}s {(after / before - 1) * 100:>+7.1f}%", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark root discovery, scanning, table and restore.")
+    parser.add_argument('--roots', type=int, default=64, help="roots btrfs-find-root reports")
+    parser.add_argument('--paths', type=int, default=20000, help="distinct paths across all roots")
+    parser.add_argument('--line-delay', type=float, default=0.0, help="seconds per line of btrfs output")
+    parser.add_argument('--replay', help="directory of captured output, see fakebin/btrfs_stub_data.py")
+    parser.add_argument('--jobs', '-j', type=int, default=4)
+    parser.add_argument('--phases', default=','.join(PHASES), help="comma-separated subset of " + ','.join(PHASES))
+    parser.add_argument('--trace-memory', action='store_true', help="record peak Python allocations per phase")
+    parser.add_argument('--output', '-o', help="write the JSON results here instead of to stdout")
+    parser.add_argument('--compare', help="earlier JSON results to compare against")
+    args = parser.parse_args(argv)
+    args.phases = set(args.phases.split(','))
+
+    os.environ['PATH'] = os.path.join(BENCH_DIR, 'fakebin') + os.pathsep + os.environ.get('PATH', '')
+    os.environ['BENCH_ROOTS'] = str(args.roots)
+    os.environ['BENCH_PATHS'] = str(args.paths)
+    os.environ['BENCH_LINE_DELAY'] = str(args.line_delay)
+    if args.replay:
+        os.environ['BENCH_REPLAY_DIR'] = os.path.abspath(args.replay)
+
+    # Not a btrfs filesystem, so the engine falls back to btrfs-find-root
+    with tempfile.NamedTemporaryFile(suffix='.img') as device:
+        device.truncate(1024 * 1024)
+        phases = run_suite(args, device.name)
+
+    report = {'revision': git_revision(), 'python': platform.python_version(),
+              'parameters': {'roots': args.roots, 'paths': args.paths, 'line_delay': args.line_delay,
+                             'jobs': args.jobs, 'replay': args.replay},
+              'phases': phases}
+    document = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(document + '\n')
+    else:
+        print(document)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
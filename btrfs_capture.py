@@ -0,0 +1,226 @@
+import json
+import os
+import struct
+import subprocess
+import sys
+
+from btrfs_ondisk import (BLOCK_GROUP_METADATA, BLOCK_GROUP_SYSTEM, SUPERBLOCK_OFFSETS, SUPERBLOCK_SIZE,
+                          BtrfsFormatError, BtrfsImage)
+from btrfs_trace import wait_process
+
+# Captures a device's filesystem metadata into a local image file once, so root discovery,
+# listing and metadata reads can run against the image instead of the (possibly failing)
+# device; only the final restore reads the device again.
+#
+# The built-in copier writes the superblocks and every SYSTEM and METADATA chunk stored on
+# the device to the same offsets of a sparse file. Logical addresses therefore stay the
+# same, and roots found in the image can be restored from the device. Unreadable sectors
+# are left as holes and counted. When the device can only be read as root, the reading
+# is done by this file run under sudo as a helper, which streams the ranges back over a
+# pipe, so the image is still written by (and owned by) the calling user.
+#
+# 'btrfs-image' is only used when asked for: it copies just the metadata that is still
+# in use, leaving out the old tree roots that deleted files are found in.
+
+COPY_SIZE = 4 * 1024 * 1024
+ZEROS = bytes(COPY_SIZE)
+CAPTURE_METHODS = ['builtin', 'btrfs-image']
+BTRFS_IMAGE_WARNING = ("Warning: btrfs-image only copies metadata that is still in use. The old tree roots "
+                       "deleted files are found in are left out, so listings of this image find little or "
+                       "nothing; use the built-in copier for recovery.")
+
+# Records the sudo helper writes after its JSON header line: kind, offset, length, and
+# for DATA the bytes themselves
+RECORD = struct.Struct('<cQI')
+DATA, ZERO, UNREADABLE = b'D', b'Z', b'U'
+
+
+def no_op(*args):
+    pass
+
+
+def metadata_ranges(image):
+    # Sorted, merged (physical offset, length) ranges holding metadata on this device
+    ranges = [(offset, SUPERBLOCK_SIZE) for offset in SUPERBLOCK_OFFSETS if offset + SUPERBLOCK_SIZE <= image.size]
+    for chunk in image.chunks:
+        if not chunk.type & (BLOCK_GROUP_METADATA | BLOCK_GROUP_SYSTEM):
+            continue
+        if image.stripe_offset(chunk) is None:
+            raise BtrfsFormatError(f"metadata chunk at {chunk.logical} is striped over several devices "
+                                   "and can't be captured from one device")
+        # Every mirror on this device (DUP), so a bad copy can still be read from the other
+        for devid, physical in chunk.stripes:
+            if devid == image.superblock.devid:
+                ranges.append((physical, min(chunk.length, image.size - physical)))
+    merged = []
+    for offset, length in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            start, previous = merged[-1]
+            merged[-1] = (start, max(previous, offset + length - start))
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+def read_range(source, offset, length, block_size):
+    # Yields (kind, offset, length, data) for one range, retrying a failed read block by
+    # block; data is only set for DATA
+    try:
+        data = os.pread(source, length, offset)
+    except OSError:
+        if length <= block_size:
+            yield UNREADABLE, offset, length, None
+            return
+        for start in range(offset, offset + length, block_size):
+            yield from read_range(source, start, min(block_size, offset + length - start), block_size)
+        return
+    if data == ZEROS[:len(data)]:
+        yield ZERO, offset, len(data), None
+    else:
+        yield DATA, offset, len(data), data
+    # Past the end of the device
+    if len(data) < length:
+        yield UNREADABLE, offset + len(data), length - len(data), None
+
+
+def read_metadata(device):
+    # Returns (device size, metadata bytes, pieces), pieces yielding read_range() tuples
+    # for all of the device's metadata
+    with BtrfsImage(device) as image:
+        ranges = metadata_ranges(image)
+        size = image.size
+        block_size = image.superblock.nodesize
+
+    def pieces():
+        source = os.open(device, os.O_RDONLY)
+        try:
+            for offset, length in ranges:
+                for start in range(offset, offset + length, COPY_SIZE):
+                    yield from read_range(source, start, min(COPY_SIZE, offset + length - start), block_size)
+        finally:
+            os.close(source)
+
+    return size, sum(length for _, length in ranges), pieces()
+
+
+def write_image(path, size, total, pieces, on_progress):
+    # Returns {bytes, unreadable_bytes}. Zero and unreadable pieces stay holes.
+    copied = 0
+    unreadable = 0
+    target = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(target, size)
+        for kind, offset, length, data in pieces:
+            if kind == DATA:
+                os.pwrite(target, data, offset)
+            elif kind == UNREADABLE:
+                unreadable += length
+            copied += length
+            on_progress(copied, total)
+    finally:
+        os.close(target)
+    return {'bytes': total, 'unreadable_bytes': unreadable}
+
+
+def capture_builtin(device, path, on_progress=no_op):
+    size, total, pieces = read_metadata(device)
+    return write_image(path, size, total, pieces, on_progress)
+
+
+def read_exactly(stream, length):
+    data = stream.read(length)
+    if len(data) != length:
+        raise OSError("the capture helper stopped unexpectedly")
+    return data
+
+
+def helper_pieces(stream):
+    # read_range() tuples back from the helper's RECORDs
+    while True:
+        record = stream.read(RECORD.size)
+        if not record:
+            return
+        if len(record) != RECORD.size:
+            raise OSError("the capture helper stopped unexpectedly")
+        kind, offset, length = RECORD.unpack(record)
+        yield kind, offset, length, read_exactly(stream, length) if kind == DATA else None
+
+
+def capture_builtin_sudo(device, path, on_progress=no_op):
+    # The built-in copier for a device only root can read: this file runs under sudo and
+    # streams the metadata back, see helper_main()
+    command = ['sudo', sys.executable, os.path.abspath(__file__), device]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        header = process.stdout.readline()
+        if not header:
+            error = process.stderr.read().decode('utf-8', 'replace').strip()
+            raise OSError(f"could not read {device} through sudo: {error or 'no output'}")
+        layout = json.loads(header)
+        result = write_image(path, layout['size'], layout['total'], helper_pieces(process.stdout), on_progress)
+        error = process.stderr.read().decode('utf-8', 'replace').strip()
+        usage = wait_process(process)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    if process.returncode != 0:
+        raise OSError(f"reading {device} through sudo failed: {error or process.returncode}")
+    return {**result, **usage}
+
+
+def helper_main(device):
+    # Run as root by capture_builtin_sudo(): a JSON line with the device size and the
+    # metadata bytes, then the RECORDs
+    out = sys.stdout.buffer
+    size, total, pieces = read_metadata(device)
+    out.write(json.dumps({'size': size, 'total': total}).encode() + b'\n')
+    for kind, offset, length, data in pieces:
+        out.write(RECORD.pack(kind, offset, length))
+        if data is not None:
+            out.write(data)
+    out.flush()
+
+
+def capture_btrfs_image(device, path, use_sudo=False, on_progress=no_op):
+    # btrfs-image writes a compressed dump; 'btrfs-image -r' turns it into an image file
+    # with the same logical addresses
+    dump = path + '.dump'
+    prefix = ['sudo'] if use_sudo else []
+    usage = {}
+    try:
+        for command in (['btrfs-image', '-t', str(os.cpu_count() or 1), device, dump], ['btrfs-image', '-r', dump, path]):
+            on_progress(0, 0)
+            process = subprocess.Popen(prefix + command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            error = process.stderr.read().decode('utf-8', 'replace').strip()
+            usage = wait_process(process)
+            if process.returncode != 0:
+                raise OSError(f"{' '.join(command)} failed: {error or process.returncode}")
+    finally:
+        if os.path.exists(dump):
+            os.remove(dump)
+    return {'bytes': os.path.getsize(path), 'unreadable_bytes': 0, **usage}
+
+
+def capture_metadata(device, path, use_sudo=False, method=None, on_progress=no_op):
+    # Writes device's metadata to path and returns {method, bytes, unreadable_bytes} and,
+    # for btrfs-image, a warning to show. on_progress(bytes copied, bytes total) is called
+    # as it goes; total is 0 when unknown.
+    method = method or 'builtin'
+    if method == 'btrfs-image':
+        return {'method': method, **capture_btrfs_image(device, path, use_sudo, on_progress),
+                'warning': BTRFS_IMAGE_WARNING}
+    if os.access(device, os.R_OK):
+        result = capture_builtin(device, path, on_progress)
+    elif use_sudo:
+        result = capture_builtin_sudo(device, path, on_progress)
+    else:
+        raise OSError(f"{device} can't be read by this user; capture it with sudo")
+    return {'method': method, **result}
+
+
+if __name__ == '__main__':
+    try:
+        helper_main(sys.argv[1])
+    except (OSError, BtrfsFormatError) as e:
+        sys.exit(str(e))
@@ -0,0 +1,87 @@
+import itertools
+import json
+import os
+import socket
+import threading
+
+from btrfs_daemon import default_socket_path, peer_uid
+from btrfs_engine import RecoveryError, no_op
+from btrfs_results import ScanResults
+
+# Client side of btrfs_daemon: one connection, one request at a time. subscribe() holds
+# the connection until its task ends, so a program that wants to cancel a task while it
+# watches it opens a second client for that.
+#
+#   client = DaemonClient()
+#   scan = client.call('scan', device='/dev/sdb1', pattern='ext:sql')
+#   client.subscribe(scan['task'], lambda event: print(event))
+#   page = client.call('query', scan=scan['task'], filter='*.sql', limit=50)
+
+
+def daemon_available(path=None):
+    path = path or default_socket_path()
+    if not os.path.exists(path):
+        return False
+    try:
+        DaemonClient(path).close()
+        return True
+    except OSError:
+        return False
+
+
+class DaemonClient:
+    def __init__(self, path=None):
+        self.path = path or default_socket_path()
+        self.socket = socket.socket(socket.AF_UNIX)
+        try:
+            self.socket.connect(self.path)
+            # Only a daemon run by root or by this user; anyone else could pose as one
+            # to collect paths and restores
+            uid = peer_uid(self.socket)
+            if uid not in (0, os.getuid()):
+                raise PermissionError(f"{self.path} is served by user {uid}, not by root or you")
+        except OSError:
+            self.socket.close()
+            raise
+        self.file = self.socket.makefile('rwb')
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def call(self, method, on_event=no_op, **params):
+        # Returns the result, passing every notification that comes first to on_event;
+        # an error answer raises RecoveryError
+        with self.lock:
+            request_id = next(self.ids)
+            self.file.write((json.dumps({'jsonrpc': '2.0', 'id': request_id, 'method': method,
+                                         'params': params}) + '\n').encode())
+            self.file.flush()
+            for line in self.file:
+                message = json.loads(line)
+                if 'id' not in message:
+                    on_event(message['params'])
+                elif message['id'] == request_id:
+                    if 'error' in message:
+                        raise RecoveryError(message['error']['message'])
+                    return message['result']
+        raise RecoveryError("The recovery daemon closed the connection")
+
+    def subscribe(self, task, on_event=no_op, log=False):
+        # Calls on_event(event) for each of the task's events and returns the finished task
+        return self.call('subscribe', on_event, task=task, log=log)
+
+    def fetch_results(self, scan):
+        # (ScanResults, {path: (size, mtime, generation)}) of a finished scan
+        exported = self.call('results', scan=scan)
+        results = ScanResults.from_export(exported)
+        metadata = {path: tuple(info) for path, info in zip(exported['paths'], exported['metadata']) if info}
+        return results, metadata
@@ -0,0 +1,448 @@
+import collections
+import inspect
+import itertools
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from btrfs_devices import DeviceCache
+from btrfs_engine import (LOG_FLUSH_INTERVAL, LOG_MAX_BLOCKS, ListEngine, LogChannel, PathPatterns, RecoveryError,
+                          RestoreEngine, check_device, unmount_device)
+from btrfs_index import PathIndex
+from btrfs_journal import RestoreJournal, default_journal_path
+from btrfs_results import file_record
+from btrfs_scan_cache import filesystem_identity
+from btrfs_trace import Tracer
+
+# Long-lived recovery service on a Unix socket. Started once as root (sudo python -m
+# btrfs_restore_cli daemon), it runs btrfs-progs directly instead of through one sudo per
+# subprocess, and keeps every finished scan in memory with its PathIndex, so the same
+# listing asked for again, by the GUI or a script, is answered without touching the
+# device as long as the filesystem's superblock generation hasn't changed.
+#
+# The protocol is JSON-RPC 2.0, one JSON object per line in both directions. Scans and
+# restores run as tasks on a pool of max_tasks threads: 'scan' and 'restore' return the
+# task right away, and 'subscribe' streams its events as notifications
+#   {"jsonrpc": "2.0", "method": "event", "params": {"task": 3, "event": "root", ...}}
+# before answering with the finished task. Methods (see RecoveryDaemon.METHODS):
+#   devices, roots, scan, restore, tasks, subscribe, cancel, forget,
+#   query (filter a scan's files, paged), children (its directory tree), results (all of it)
+# Only root and the user who started the daemon through sudo may connect.
+
+ERROR_PARSE = -32700
+ERROR_METHOD = -32601
+ERROR_PARAMS = -32602
+ERROR_INTERNAL = -32603
+ERROR_FAILED = -32000
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+QUERY_LIMIT = 1000
+# btrfs output kept per task for clients that subscribe with log=true
+TASK_LOG_LINES = 20000
+# Events kept per task for clients that subscribe late; older ones are dropped
+TASK_EVENTS = 2000
+
+
+def default_socket_path():
+    # Per user, so a client finds the daemon its user started with sudo. Only in the
+    # user's runtime directory: a socket in a world-writable directory could be created
+    # first by another user posing as the daemon.
+    if os.environ.get('BTRFS_RESTORE_SOCKET'):
+        return os.environ['BTRFS_RESTORE_SOCKET']
+    uid = int(os.environ.get('SUDO_UID', os.getuid()))
+    runtime = None if 'SUDO_UID' in os.environ else os.environ.get('XDG_RUNTIME_DIR')
+    return os.path.join(runtime or f'/run/user/{uid}', 'btrfs-restore-gui.sock')
+
+
+def peer_uid(connection):
+    # The user id of the process at the other end of a Unix socket
+    pid, uid, gid = struct.unpack('3i', connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                              struct.calcsize('3i')))
+    return uid
+
+
+class Task:
+    # A scan or restore. Its last TASK_EVENTS events are kept for clients subscribing
+    # late, numbered from the first one ever emitted, and all of them are let go once a
+    # client has read the finished task; btrfs output goes to its own LogChannel.
+
+    def __init__(self, id, kind, params):
+        self.id = id
+        self.kind = kind
+        self.params = params
+        self.state = RUNNING
+        self.result = None
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self.events = collections.deque()
+        # Number of the first event in events
+        self.dropped = 0
+        self.condition = threading.Condition()
+        self.log = LogChannel(TASK_LOG_LINES)
+        self.engine = None
+        # Scans only
+        self.key = None
+        self.identity = None
+        self.device = None
+        self.results = None
+        self.metadata = None
+        self.patterns = None
+        self.index = None
+
+    def emit(self, event, **values):
+        with self.condition:
+            self.events.append({'task': self.id, 'event': event, **values})
+            if len(self.events) > TASK_EVENTS:
+                self.events.popleft()
+                self.dropped += 1
+            self.condition.notify_all()
+
+    def event_count(self):
+        return self.dropped + len(self.events)
+
+    def events_since(self, position):
+        # Called with condition held: the kept events from number position on
+        return list(itertools.islice(self.events, max(0, position - self.dropped), None))
+
+    def trim(self):
+        with self.condition:
+            if self.state != RUNNING:
+                self.dropped += len(self.events)
+                self.events.clear()
+
+    def finish(self, state, result=None, error=None):
+        with self.condition:
+            self.state = state
+            self.result = result
+            self.error = error
+            self.finished = time.time()
+            self.condition.notify_all()
+
+    def describe(self):
+        return {'task': self.id, 'kind': self.kind, 'state': self.state, 'params': self.params,
+                'result': self.result, 'error': self.error, 'started': self.started, 'finished': self.finished}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+
+    def handle(self):
+        if not self.server.daemon.is_allowed(self.request):
+            return
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    method = request['method']
+                    params = request.get('params') or {}
+                    request_id = request.get('id')
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    self.send({'jsonrpc': '2.0', 'id': None,
+                               'error': {'code': ERROR_PARSE, 'message': "Invalid request"}})
+                    continue
+                self.send(self.server.daemon.dispatch(method, params, request_id, self.notify))
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, e.g. while subscribed to a task; the task carries on
+            pass
+
+    def notify(self, event):
+        self.send({'jsonrpc': '2.0', 'method': 'event', 'params': event})
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode()
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class RecoveryDaemon:
+    METHODS = ['devices', 'roots', 'scan', 'restore', 'tasks', 'subscribe', 'cancel', 'forget', 'query',
+               'children', 'results']
+
+    def __init__(self, socket_path=None, max_tasks=2, max_workers=None, use_sudo=False, tracer=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.max_workers = max_workers
+        self.use_sudo = use_sudo
+        self.tracer = tracer or Tracer()
+        self.pool = ThreadPoolExecutor(max_workers=max_tasks)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.tasks = {}
+        # Newest scan per set of scan settings, reused while its filesystem is unchanged
+        self.scans = {}
+        # (device, min_generation) -> (identity, [(root, generation)])
+        self.roots = {}
+        self.device_cache = DeviceCache()
+        self.owner = int(os.environ.get('SUDO_UID', os.getuid()))
+        self.server = None
+
+    def serve(self):
+        directory = os.path.dirname(self.socket_path) or '.'
+        if not os.path.isdir(directory):
+            raise RecoveryError(f"{directory} does not exist; pick a socket in a directory only you can write "
+                                f"to with --socket")
+        if os.path.exists(self.socket_path):
+            # Left behind by a daemon that died, unless one still answers on it
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(self.socket_path)
+                raise RecoveryError(f"A daemon is already listening on {self.socket_path}")
+            except ConnectionRefusedError:
+                os.remove(self.socket_path)
+            finally:
+                probe.close()
+        self.server = DaemonServer(self.socket_path, RequestHandler)
+        self.server.daemon = self
+        os.chmod(self.socket_path, 0o600)
+        if self.owner != os.getuid():
+            os.chown(self.socket_path, self.owner, int(os.environ.get('SUDO_GID', os.getgid())))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+        for task in list(self.tasks.values()):
+            if task.state == RUNNING and task.engine:
+                task.engine.cancel()
+
+    def is_allowed(self, connection):
+        return peer_uid(connection) in (0, self.owner, os.getuid())
+
+    def dispatch(self, method, params, request_id, notify):
+        if method not in self.METHODS:
+            return {'jsonrpc': '2.0', 'id': request_id,
+                    'error': {'code': ERROR_METHOD, 'message': f"Unknown method {method}"}}
+        handler = getattr(self, 'rpc_' + method)
+        # Checked before the call, so a TypeError from inside a method isn't blamed on the client
+        try:
+            if not isinstance(params, dict):
+                raise TypeError("params must be an object")
+            inspect.signature(handler).bind(notify=notify, **params)
+        except TypeError as e:
+            return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': ERROR_PARAMS, 'message': str(e)}}
+        try:
+            result = handler(notify=notify, **params)
+        except (RecoveryError, OSError, ValueError, KeyError) as e:
+            message = str(e) if not isinstance(e, KeyError) else f"Unknown {e.args[0]}"
+            return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': ERROR_FAILED, 'message': message}}
+        except Exception as e:
+            traceback.print_exc()
+            return {'jsonrpc': '2.0', 'id': request_id,
+                    'error': {'code': ERROR_INTERNAL, 'message': f"Internal error: {str(e)}"}}
+        return {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+
+    def new_task(self, kind, params):
+        with self.lock:
+            task = Task(next(self.ids), kind, params)
+            self.tasks[task.id] = task
+            return task
+
+    def task(self, task_id, kind=None):
+        task = self.tasks.get(task_id)
+        if task is None or (kind and task.kind != kind):
+            raise RecoveryError(f"There is no {kind or 'task'} {task_id}")
+        return task
+
+    def finished_scan(self, scan_id):
+        task = self.task(scan_id, 'scan')
+        if task.state not in (DONE, CANCELLED) or task.results is None:
+            raise RecoveryError(f"Scan {scan_id} is {task.state}")
+        return task
+
+    def rpc_devices(self, notify, force=False):
+        return [{'device': device, 'uuid': uuid, 'label': label}
+                for device, uuid, label in self.device_cache.refresh(force, interactive=False)]
+
+    def rpc_roots(self, notify, device, metadata_image=None, min_generation=None):
+        source = metadata_image or device
+        error = check_device(source)
+        if error:
+            raise RecoveryError(error)
+        identity = filesystem_identity(source, self.use_sudo)
+        key = (device, metadata_image, min_generation)
+        cached = self.roots.get(key)
+        if cached and identity and cached[0] == identity:
+            roots = cached[1]
+        else:
+            engine = ListEngine(device, self.use_sudo, '/.', min_generation=min_generation, tracer=self.tracer,
+                                metadata_image=metadata_image)
+            roots = engine.list_roots()
+            self.roots[key] = (identity, roots)
+        return [{'root': root, 'generation': generation} for root, generation in roots]
+
+    def rpc_scan(self, notify, device, pattern='', type='everything', depth='Deep', min_generation=None,
+                 metadata_image=None, root_timeout=None, max_matches=None, use_cache=True, unmount=False,
+                 triage=True):
+        source = metadata_image or device
+        error = check_device(source)
+        if error:
+            raise RecoveryError(error)
+        patterns = PathPatterns.parse(pattern, type)
+        key = (device, metadata_image, patterns.path_regex, depth, min_generation, root_timeout, max_matches, triage)
+        identity = filesystem_identity(source, self.use_sudo)
+        with self.lock:
+            previous = self.scans.get(key)
+            # A scan still running, or finished on the same generation, answers again
+            if (previous and use_cache and previous.state in (RUNNING, DONE)
+                    and identity and previous.identity == identity):
+                return previous.describe()
+            task = Task(next(self.ids), 'scan', {'device': device, 'pattern': pattern, 'type': type, 'depth': depth,
+                                                 'min_generation': min_generation, 'metadata_image': metadata_image})
+            self.tasks[task.id] = task
+            self.scans[key] = task
+        task.key = key
+        task.identity = identity
+        task.device = device
+        task.patterns = patterns
+        if unmount and not metadata_image and unmount_device(device):
+            task.emit('progress', message=f"Successfully unmounted {device}")
+        task.engine = ListEngine(device, self.use_sudo, patterns.path_regex, max_workers=self.max_workers,
+                                 depth=depth, use_cache=use_cache, log_channel=task.log,
+                                 min_generation=min_generation, triage=triage, tracer=self.tracer,
+                                 root_timeout=root_timeout, max_matches=max_matches, metadata_image=metadata_image)
+        self.pool.submit(self.run_scan, task)
+        return task.describe()
+
+    def run_scan(self, task):
+        engine = task.engine
+        engine.on_progress = lambda message: task.emit('progress', message=message)
+        engine.on_files_found = lambda paths: task.emit('files', paths=paths)
+        engine.on_root_progress = lambda done, total, root, seconds: task.emit(
+            'root', done=done, total=total, root=root, seconds=seconds)
+        engine.on_stats = lambda stats: task.emit('stats', **stats)
+        metadata = {}
+        engine.on_metadata = metadata.update
+        try:
+            files, results = engine.run()
+            with self.tracer.span('build index', 'scan', paths=len(files)):
+                index = PathIndex(files, metadata)
+                index.prepare()
+        except Exception as e:
+            task.finish(FAILED, error=str(e))
+            return
+        task.results = results
+        task.metadata = metadata
+        task.index = index
+        task.finish(CANCELLED if engine.cancelled else DONE, {'files': len(files), 'roots': len(results.roots())})
+
+    def rpc_restore(self, notify, scan, destination, paths=None, journal=True, max_read_mib=None,
+                    max_files_per_sec=None, check_space=True):
+        source = self.finished_scan(scan)
+        error = check_device(source.device)
+        if error:
+            raise RecoveryError(error)
+        paths = source.results if paths is None else [path for path in paths if path in source.results]
+        file_roots = {path: source.results.root_for(path) for path in paths}
+        task = self.new_task('restore', {'scan': scan, 'destination': destination, 'files': len(file_roots)})
+        task.engine = RestoreEngine(source.device, destination, file_roots, self.use_sudo, self.max_workers,
+                                    task.log, self.tracer,
+                                    journal=RestoreJournal(default_journal_path(destination)) if journal else None,
+                                    sizes={path: info[0] for path, info in source.metadata.items()},
+                                    max_read_bytes=max_read_mib * 1024 * 1024 if max_read_mib else None,
+                                    max_files=max_files_per_sec, check_space=check_space)
+        self.pool.submit(self.run_restore, task)
+        return task.describe()
+
+    def run_restore(self, task):
+        engine = task.engine
+        engine.on_progress = lambda message: task.emit('progress', message=message)
+        engine.on_restore_progress = lambda restored, total: task.emit('restore', restored=restored, total=total)
+        try:
+            restored = engine.run()
+        except Exception as e:
+            task.finish(FAILED, error=str(e))
+            return
+        task.finish(CANCELLED if engine.cancelled else DONE,
+                    {'restored': restored, 'selected': len(engine.file_roots), 'skipped': engine.skipped,
+                     'verified': engine.verified, 'failed': engine.failed})
+
+    def rpc_tasks(self, notify):
+        return [task.describe() for task in list(self.tasks.values())]
+
+    def rpc_subscribe(self, notify, task, since=0, log=False):
+        # Streams the task's events from number since on, and its btrfs output as 'log'
+        # events if log is set (one subscriber gets each line), then returns the task.
+        # Events no longer kept are reported as one 'dropped' event.
+        task = self.task(task)
+        position = since
+        while True:
+            with task.condition:
+                if position >= task.event_count() and task.state == RUNNING:
+                    task.condition.wait(LOG_FLUSH_INTERVAL)
+                missed = task.dropped - position
+                events = task.events_since(position)
+                position = task.event_count()
+                running = task.state == RUNNING
+            if missed > 0:
+                notify({'task': task.id, 'event': 'dropped', 'events': missed})
+            for event in events:
+                notify(event)
+            if log:
+                lines, dropped = task.log.drain(LOG_MAX_BLOCKS)
+                if lines or dropped:
+                    notify({'task': task.id, 'event': 'log', 'lines': lines, 'dropped': dropped})
+            if not running and position >= task.event_count():
+                # Read to the end; its results stay available through query and results
+                task.trim()
+                return task.describe()
+
+    def rpc_cancel(self, notify, task):
+        task = self.task(task)
+        if task.state == RUNNING and task.engine:
+            task.engine.cancel()
+        return task.describe()
+
+    def rpc_forget(self, notify, task):
+        # Drops a finished task and, for a scan, its results
+        with self.lock:
+            task = self.task(task)
+            if task.state == RUNNING:
+                raise RecoveryError(f"Task {task.id} is still running")
+            del self.tasks[task.id]
+            if task.key and self.scans.get(task.key) is task:
+                del self.scans[task.key]
+        return True
+
+    def rpc_query(self, notify, scan, filter='', directory='', offset=0, limit=QUERY_LIMIT):
+        # One page of a scan's files matching filter (see btrfs_index) under directory
+        task = self.finished_scan(scan)
+        paths = task.index.filter(filter, directory)
+        return {'total': len(paths),
+                'files': [file_record(path, task.results, task.metadata, task.patterns)
+                          for path in paths[offset:offset + limit]]}
+
+    def rpc_children(self, notify, scan, directory=''):
+        task = self.finished_scan(scan)
+        subdirectories, files = task.index.children(directory)
+        return {'directories': [{'name': name, 'files': count, 'size': size} for name, count, size in subdirectories],
+                'files': files}
+
+    def rpc_results(self, notify, scan):
+        # Everything a client needs to rebuild the scan: ScanResults.export() and the
+        # metadata per path id
+        task = self.finished_scan(scan)
+        exported = task.results.export()
+        exported['metadata'] = [task.metadata.get(path) for path in exported['paths']]
+        return exported
@@ -0,0 +1,204 @@
+import json
+import os
+import stat
+import subprocess
+
+from btrfs_ondisk import SUPERBLOCK_OFFSETS, SUPERBLOCK_SIZE, format_uuid, parse_superblock
+
+# Finding btrfs devices without running anything as root where possible. Mounted
+# filesystems are listed under /sys/fs/btrfs; every other block device is probed for a
+# btrfs superblock directly. Only when some device can't be read does it fall back to
+# 'btrfs filesystem show', and then through 'sudo -n' unless interactive, so a background
+# refresh never waits on a password prompt.
+#
+# DeviceCache keeps the last result on disk together with a fingerprint of the block
+# devices and filesystem UUIDs udev has set up, so a refresh that finds nothing changed
+# is a few directory listings.
+
+SYSFS_BTRFS = '/sys/fs/btrfs'
+SYSFS_BLOCK = '/sys/class/block'
+SYSFS_DEV_BLOCK = '/sys/dev/block'
+DISK_BY_UUID = '/dev/disk/by-uuid'
+NO_LABEL = 'none'
+
+
+def default_device_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'btrfs-restore-gui', 'devices.json')
+
+
+def read_text(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def list_directory(path):
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+
+def sysfs_filesystems():
+    # {device: (uuid, label)} for the filesystems the kernel has mounted
+    found = {}
+    for uuid in list_directory(SYSFS_BTRFS):
+        devices = os.path.join(SYSFS_BTRFS, uuid, 'devices')
+        if not os.path.isdir(devices):
+            continue
+        label = read_text(os.path.join(SYSFS_BTRFS, uuid, 'label')) or NO_LABEL
+        for name in list_directory(devices):
+            found[f"/dev/{name}"] = (uuid, label)
+    return found
+
+
+def block_devices():
+    # Block devices with a nonzero size; /sys/class/block names match their /dev nodes
+    devices = []
+    for name in list_directory(SYSFS_BLOCK):
+        size = read_text(os.path.join(SYSFS_BLOCK, name, 'size'))
+        if size and size != '0':
+            devices.append(f"/dev/{name.replace('!', '/')}")
+    return devices
+
+
+def probe_device(device):
+    # (uuid, label) from device's primary superblock, or None if it isn't btrfs. Raises
+    # PermissionError when the device can't be opened.
+    try:
+        with open(device, 'rb') as f:
+            f.seek(SUPERBLOCK_OFFSETS[0])
+            sb = parse_superblock(f.read(SUPERBLOCK_SIZE), SUPERBLOCK_OFFSETS[0])
+    except PermissionError:
+        raise
+    except OSError:
+        return None
+    return (format_uuid(sb.fsid), sb.label or NO_LABEL) if sb else None
+
+
+def filesystem_show(interactive=True):
+    # [(device, uuid, label)] as reported by 'btrfs filesystem show'
+    command = ['sudo', 'btrfs', 'filesystem', 'show'] if interactive else ['sudo', '-n', 'btrfs', 'filesystem', 'show']
+    result = subprocess.run(command, capture_output=True, text=True)
+
+    partitions = []
+    current_uuid = None
+    current_label = None
+    for line in result.stdout.split('\n'):
+        if line.startswith('Label:'):
+            parts = line.split()
+            current_label = parts[1].strip("'")
+            current_uuid = parts[-1]
+        elif line.strip().startswith('devid'):
+            parts = line.split()
+            device = parts[-1]
+            if current_uuid and device:
+                partitions.append((device, current_uuid, current_label))
+            current_uuid = None
+            current_label = None
+
+    return partitions
+
+
+def discover_devices(interactive=True):
+    # [(device, uuid, label)] sorted by device
+    found = sysfs_filesystems()
+    unreadable = False
+    for device in block_devices():
+        if device in found:
+            continue
+        try:
+            filesystem = probe_device(device)
+        except PermissionError:
+            unreadable = True
+            continue
+        if filesystem:
+            found[device] = filesystem
+    if unreadable:
+        try:
+            for device, uuid, label in filesystem_show(interactive):
+                found.setdefault(device, (uuid, label))
+        except OSError:
+            pass
+    return [(device, uuid, label) for device, (uuid, label) in sorted(found.items())]
+
+
+def sysfs_disks(node, seen=None):
+    # Names of the whole disks behind a /sys/class/block entry: a partition's parent disk,
+    # the disks under a device-mapper or md device, and the disk holding a loop device's
+    # backing file
+    seen = seen if seen is not None else set()
+    real = os.path.realpath(node)
+    if real in seen:
+        return set()
+    seen.add(real)
+    backing = read_text(os.path.join(real, 'loop', 'backing_file'))
+    if backing:
+        try:
+            return physical_disks(backing, seen)
+        except OSError:
+            pass
+    slaves = list_directory(os.path.join(real, 'slaves'))
+    if slaves:
+        return set().union(*(sysfs_disks(os.path.join(real, 'slaves', name), seen) for name in slaves))
+    if os.path.exists(os.path.join(real, 'partition')):
+        real = os.path.dirname(real)
+    return {os.path.basename(real)}
+
+
+def physical_disks(path, seen=None):
+    # Keys of the physical disks a device or image file is read from, so jobs on the same
+    # spindle can be told apart from jobs on different ones. A file on a filesystem
+    # without a block device (tmpfs, NFS, ...) gets that filesystem's device number.
+    st = os.stat(path)
+    number = st.st_rdev if stat.S_ISBLK(st.st_mode) else st.st_dev
+    node = os.path.join(SYSFS_DEV_BLOCK, f"{os.major(number)}:{os.minor(number)}")
+    if not os.path.exists(node):
+        return {f"dev-{os.major(number)}:{os.minor(number)}"}
+    return sysfs_disks(node, seen)
+
+
+def device_fingerprint():
+    # Changes whenever a block device appears or goes away, a filesystem is mounted or
+    # unmounted, or udev sees a new filesystem UUID
+    return [list_directory(SYSFS_BLOCK), list_directory(SYSFS_BTRFS), list_directory(DISK_BY_UUID)]
+
+
+class DeviceCache:
+    def __init__(self, path=None):
+        self.path = path or default_device_cache_path()
+        self.fingerprint = None
+        self.devices = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.fingerprint = data['fingerprint']
+            self.devices = [tuple(device) for device in data['devices']]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.fingerprint = None
+            self.devices = None
+        return self.devices
+
+    def is_current(self):
+        return self.devices is not None and self.fingerprint == device_fingerprint()
+
+    def refresh(self, force=False, interactive=True):
+        # Returns [(device, uuid, label)], rediscovered unless nothing changed
+        if not force and self.is_current():
+            return self.devices
+        fingerprint = device_fingerprint()
+        self.devices = discover_devices(interactive)
+        self.fingerprint = fingerprint
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump({'fingerprint': fingerprint, 'devices': self.devices}, f)
+        except OSError:
+            pass
+        return self.devices
@@ -0,0 +1,938 @@
+import collections
+import contextlib
+import heapq
+import os
+import queue
+import re
+import shutil
+import stat
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from btrfs_devices import discover_devices
+from btrfs_metadata import read_inode_metadata
+from btrfs_ondisk import BtrfsImage, BtrfsFormatError
+from btrfs_output import RESTORING, WELL_BLOCK, decode_lines, decode_path, read_line_blocks, restoring_pattern
+from btrfs_results import ScanResults
+from btrfs_scan_cache import ScanCache, filesystem_identity
+from btrfs_trace import Tracer, wait_process
+
+# Qt-free recovery engine shared by the GUI (btrfs_gui_restore) and the command line
+# (btrfs_restore_cli).
+
+DEFAULT_DESTINATION = '/tmp/btrfs_recovery'
+
+# Recovery types, in the order MainWindow.regex_type lists them
+RECOVERY_TYPES = ['file', 'directory', 'extension', 'file-in-directory', 'everything']
+
+
+def build_path_regex(recovery_type, user_input):
+    if recovery_type == 'file':  # Specific File
+        return f"/{user_input}"
+    elif recovery_type == 'directory':  # Specific Directory
+        return f"/{user_input}/."
+    elif recovery_type == 'extension':  # File Extension
+        return f"/.*\\.{user_input}"
+    elif recovery_type == 'file-in-directory':  # File in Directory
+        return f"/{user_input}"
+    else:  # Everything
+        return "/."
+
+
+def recovery_type_named(name):
+    # A recovery type by its name or an unambiguous prefix of it ("ext", "dir"), else None
+    if name in RECOVERY_TYPES:
+        return name
+    candidates = [recovery_type for recovery_type in RECOVERY_TYPES if name and recovery_type.startswith(name)]
+    return candidates[0] if len(candidates) == 1 else None
+
+
+class PathPatterns:
+    # Several targets listed by one scan. The input is separated by ';', and each part may
+    # name its own recovery type, e.g. "ext:sql; ext:conf; dir:nginx; report.pdf"; parts
+    # without one use default_type. Every root is scanned once with path_regex, the
+    # alternation of all targets' regexes, and tag() tells which target a match came from.
+
+    def __init__(self, targets):
+        # targets: [(label, path_regex)]
+        self.targets = []
+        for label, regex in targets:
+            if all(regex != existing for _, existing in self.targets):
+                self.targets.append((label, regex))
+        if len(self.targets) == 1:
+            self.path_regex = self.targets[0][1]
+        else:
+            # Grouped, so a ^ or $ in one target only anchors that target
+            self.path_regex = '|'.join(f"({regex})" for _, regex in self.targets)
+        self.matchers = []
+        for label, regex in self.targets:
+            try:
+                # --path-regex is a POSIX extended regex; Python's re agrees on what
+                # build_path_regex produces and on most hand-written patterns
+                self.matchers.append((label, re.compile(regex).search))
+            except re.error:
+                pass
+
+    @classmethod
+    def parse(cls, text, default_type):
+        targets = []
+        for part in text.split(';'):
+            part = part.strip()
+            name, separator, value = part.partition(':')
+            recovery_type = recovery_type_named(name.strip()) if separator else None
+            if recovery_type:
+                value = value.strip()
+            else:
+                recovery_type, value = default_type, part
+            if value or recovery_type == 'everything':
+                targets.append((f"{recovery_type}:{value}", build_path_regex(recovery_type, value)))
+        if not targets:
+            targets.append((f"{default_type}:", build_path_regex(default_type, '')))
+        return cls(targets)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def labels(self):
+        return [label for label, _ in self.targets]
+
+    def tag(self, path):
+        # Label of the first target whose regex matches path, or None
+        if len(self.targets) == 1:
+            return self.targets[0][0]
+        full_path = '/' + path
+        for label, search in self.matchers:
+            if search(full_path):
+                return label
+        return None
+
+
+def check_device(device):
+    # Returns an error message, or None if device can be scanned
+    if not device:
+        return "Please select a BTRFS device or partition."
+    if not os.path.exists(device):
+        return f"Error: Device '{device}' does not exist."
+    if not os.path.isfile(device) and not stat.S_ISBLK(os.stat(device).st_mode):
+        return f"Error: '{device}' is not a block device or regular file."
+    return None
+
+
+def unmount_device(device):
+    try:
+        subprocess.run(['sudo', 'umount', device], check=True)
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+
+def list_btrfs_partitions():
+    # Returns [(device, uuid, label)], see btrfs_devices
+    return discover_devices()
+
+
+# Subprocess output is collected here instead of being signalled line by line; the GUI
+# drains it on a timer and renders each batch with a single append.
+LOG_FLUSH_INTERVAL = 0.1
+LOG_RING_LINES = 500000
+LOG_MAX_BLOCKS = 5000
+
+
+class LogChannel:
+    # Subprocess output is stored as the raw blocks read_line_blocks() returns and only
+    # decoded when it is drained for display or saved. The ring drops whole entries, so
+    # it can run over max_lines by up to one block.
+
+    def __init__(self, max_lines=LOG_RING_LINES):
+        self.lock = threading.Lock()
+        self.max_lines = max_lines
+        self.pending = []
+        self.pending_lines = 0
+        self.ring = collections.deque()
+        self.ring_lines = 0
+        self.total_lines = 0
+
+    def append(self, line):
+        self.add(1, line)
+
+    def append_block(self, block):
+        self.add(block.count(b'\n'), block)
+
+    def add(self, count, entry):
+        with self.lock:
+            self.pending.append(entry)
+            self.pending_lines += count
+            self.ring.append((count, entry))
+            self.ring_lines += count
+            self.total_lines += count
+            while self.ring_lines - self.ring[0][0] >= self.max_lines:
+                self.ring_lines -= self.ring.popleft()[0]
+
+    def drain(self, limit=LOG_MAX_BLOCKS):
+        # Returns (newest pending lines, number of older pending lines left out)
+        with self.lock:
+            pending, count = self.pending, self.pending_lines
+            self.pending = []
+            self.pending_lines = 0
+        # Only the newest entries that will actually be shown are decoded
+        chunks = []
+        shown = 0
+        for entry in reversed(pending):
+            chunks.append(decode_lines(entry) if isinstance(entry, bytes) else [entry])
+            shown += len(chunks[-1])
+            if shown >= limit:
+                break
+        lines = [line for chunk in reversed(chunks) for line in chunk][-limit:]
+        return lines, count - len(lines)
+
+    def clear(self):
+        with self.lock:
+            self.pending = []
+            self.pending_lines = 0
+            self.ring.clear()
+            self.ring_lines = 0
+
+    def save(self, path):
+        with self.lock:
+            entries = [entry for _, entry in self.ring]
+            dropped = self.total_lines - self.ring_lines
+        with open(path, 'wb') as f:
+            if dropped > 0:
+                f.write(f"[{dropped} earlier lines were dropped from the in-memory log]\n".encode())
+            for entry in entries:
+                f.write(entry if isinstance(entry, bytes) else entry.encode('utf-8', 'surrogateescape') + b'\n')
+
+
+# Root selection per "Search Depth": how many of the newest roots (by generation) to
+# scan, and how many roots must match the path regex before the scan stops early.
+# None means no limit.
+SEARCH_DEPTHS = {
+    'Basic': {'max_roots': 16, 'stop_after_matches': 2},
+    'Advanced': {'max_roots': 128, 'stop_after_matches': 8},
+    'Deep': {'max_roots': None, 'stop_after_matches': None},
+}
+
+# A dry run still prints every path under the (unused) output directory
+DRY_RUN_OUTPUT = '/dev/null'
+DRY_RUN_RESTORING = restoring_pattern(DRY_RUN_OUTPUT)
+
+
+class RecoveryError(Exception):
+    pass
+
+
+def no_op(*args):
+    pass
+
+
+class ListEngine:
+    # Finds roots, scans them and collects metadata. Progress is reported through the
+    # on_* callbacks, which may be called from any thread:
+    #   on_progress(message)
+    #   on_files_found(paths)                  paths not reported by any earlier root
+    #   on_root_progress(done, total, root, seconds)
+    #   on_metadata({path: (size, mtime, root generation)})
+    #   on_stats({roots_done, roots_total, roots_skipped, roots_timed_out, files_matched,
+    #             lines_per_sec}) at most every LOG_FLUSH_INTERVAL
+    # Timing and subprocess resource usage of every phase go to tracer (see btrfs_trace).
+    # cancel() may be called from any thread; run() then returns what was found so far.
+    # root_timeout stops a single root's scan, or the dump of its metadata, after that
+    # many seconds, and max_matches stops the whole listing once that many distinct
+    # paths were found and keeps only those. With metadata_image (see btrfs_capture),
+    # everything is read from that image instead of device; restore the results from
+    # device itself.
+
+    def __init__(self, device, use_sudo, path_regex, destination='/tmp/btrfs_recovery', max_workers=None,
+                 depth='Deep', use_cache=True, log_channel=None, min_generation=None, triage=True, tracer=None,
+                 root_timeout=None, max_matches=None, metadata_image=None):
+        self.on_progress = no_op
+        self.on_files_found = no_op
+        self.on_root_progress = no_op
+        self.on_metadata = no_op
+        self.on_stats = no_op
+        self.device = metadata_image or device
+        self.source_device = device
+        self.use_sudo = use_sudo
+        self.path_regex = path_regex
+        self.destination = destination
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self.depth = depth
+        self.max_roots = SEARCH_DEPTHS[depth]['max_roots']
+        self.stop_after_matches = SEARCH_DEPTHS[depth]['stop_after_matches']
+        self.root_generations = {}
+        self.find_root_process = None
+        self.discovery_stopped = False
+        self.use_cache = use_cache
+        self.cache = None
+        self.log_channel = log_channel or LogChannel()
+        self.min_generation = min_generation
+        self.triage = triage
+        self.tracer = tracer or Tracer()
+        self.root_timeout = root_timeout
+        self.max_matches = max_matches
+        self.cancelled = False
+        self.processes = set()
+        self.stop_reasons = {}
+        self.process_lock = threading.RLock()
+        self.roots_timed_out = []
+        self.roots_failed = []
+        self.roots_skipped = 0
+        self.triage_disabled = False
+        self.lines_parsed = 0
+        self.stats_time = 0
+        self.stats_lines = 0
+
+    def run(self):
+        # Returns (paths, ScanResults)
+        if self.device != self.source_device:
+            self.check_metadata_image()
+        try:
+            if self.use_cache:
+                self.open_cache()
+            return self.list_deleted_files()
+        finally:
+            self.close_cache()
+
+    def list_roots(self):
+        # Returns [(root, generation)] without scanning any of them
+        if self.device != self.source_device:
+            self.check_metadata_image()
+        try:
+            if self.use_cache:
+                self.open_cache()
+            return [(root, self.root_generations.get(root)) for root in self.iter_roots()]
+        finally:
+            self.close_cache()
+
+    def check_metadata_image(self):
+        self.on_progress(f"Scanning metadata image {self.device} instead of {self.source_device}")
+        image = device = None
+        try:
+            image = filesystem_identity(self.device)
+            # The device may not even be attached to this machine
+            device = filesystem_identity(self.source_device, self.use_sudo)
+        except OSError:
+            pass
+        if image is None:
+            self.on_progress(f"Warning: {self.device} has no readable btrfs superblock")
+        elif device and device[0] != image[0]:
+            self.on_progress(f"Warning: {self.device} is an image of filesystem {image[0]}, "
+                             f"not of {self.source_device} ({device[0]})")
+        elif device and device[1] != image[1]:
+            self.on_progress(f"Warning: {self.source_device} is at generation {device[1]}, its metadata image "
+                             f"at {image[1]}; roots written since the image was captured are not listed")
+
+    def close_cache(self):
+        if self.cache:
+            self.cache.close()
+            self.cache = None
+
+    def open_cache(self):
+        try:
+            self.cache = ScanCache.for_device(self.device, self.use_sudo)
+        except Exception as e:
+            self.on_progress(f"Scan cache unavailable: {str(e)}")
+            return
+        if self.cache is None:
+            self.on_progress("Scan cache disabled: could not read the btrfs superblock")
+        else:
+            self.on_progress(f"Using scan cache for filesystem {self.cache.fsid} (generation {self.cache.generation})")
+
+    def list_deleted_files(self):
+        # Roots are scanned as soon as btrfs-find-root reports them. The discovery thread
+        # and the scan pool both report back through a single event queue, and this
+        # thread hands the newest pending root to the pool whenever a worker is free.
+        # Depths limited to max_roots wait for discovery to finish instead, since roots
+        # aren't necessarily found newest first and the limit is on the newest ones.
+        events = queue.Queue()
+        results = ScanResults()
+        pending = []
+        submitted = []
+        discovered = 0
+        discovering = True
+        in_flight = 0
+        scanned = 0
+        stopped = False
+        started = time.monotonic()
+        hold = bool(self.max_roots)
+        if hold:
+            self.on_progress(f"{self.depth} search: scanning the {self.max_roots} newest roots once they are all found, "
+                             f"with {self.max_workers} parallel workers")
+        else:
+            self.on_progress(f"{self.depth} search: scanning roots as they are found with {self.max_workers} parallel workers")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            discovery = threading.Thread(target=self.discover_roots, args=(events,), daemon=True)
+            discovery.start()
+            while discovering or in_flight or (pending and not stopped):
+                total = len(submitted) if stopped else max(len(submitted), min(discovered, self.max_roots or discovered))
+                self.emit_stats(scanned, total, len(results))
+                try:
+                    event, root, result = events.get(timeout=LOG_FLUSH_INTERVAL)
+                except queue.Empty:
+                    continue
+                if event == 'root':
+                    discovered += 1
+                    heapq.heappush(pending, (-self.root_generations.get(root, 0), discovered, root))
+                elif event == 'discovered':
+                    discovering = False
+                    if result is not None:
+                        raise result
+                    self.on_progress(f"Root discovery finished in {time.monotonic() - started:.2f}s: {discovered} roots")
+                else:  # scanned
+                    in_flight -= 1
+                    scanned += 1
+                    files, elapsed = result.result()
+                    if files:
+                        found = len(results)
+                        new_files = results.add_root(root, self.root_generations.get(root), files)
+                        if self.max_matches:
+                            new_files = new_files[:max(0, self.max_matches - found)]
+                        if new_files:
+                            self.on_files_found(new_files)
+                    self.on_root_progress(scanned, total, root, elapsed)
+                    self.on_progress(f"Root {root}: {len(files)} matches in {elapsed:.2f}s ({scanned}/{total})")
+
+                if not stopped and self.cancelled:
+                    stopped = True
+                    self.on_progress(f"Cancelled, keeping the {len(results)} files found so far")
+                if not stopped and self.max_matches and len(results) >= self.max_matches:
+                    stopped = True
+                    self.on_progress(f"Found {len(results)} files, stopping after {self.max_matches}")
+                    self.stop_scans('stopped')
+                if not stopped and self.stop_after_matches and len(results.root_names) >= self.stop_after_matches:
+                    stopped = True
+                    self.on_progress(f"Path matched in {len(results.root_names)} roots, stopping early")
+                if not stopped and self.max_roots and len(submitted) >= self.max_roots:
+                    stopped = True
+                    self.on_progress(f"Reached the {self.depth} limit of {self.max_roots} roots")
+                if stopped:
+                    pending.clear()
+                    self.stop_discovery()
+
+                while pending and in_flight < self.max_workers and not stopped and not (hold and discovering):
+                    _, _, root = heapq.heappop(pending)
+                    submitted.append(root)
+                    in_flight += 1
+                    future = pool.submit(self.scan_root, root)
+                    future.add_done_callback(lambda f, root=root: events.put(('scanned', root, f)))
+                    if self.max_roots and len(submitted) >= self.max_roots:
+                        break
+
+        if not discovered and not self.cancelled:
+            raise RecoveryError("Could not find any valid roots.")
+        # Roots still running when the limit was reached listed past it; only the first
+        # max_matches paths are kept, and only they have their metadata read
+        if self.max_matches and len(results) > self.max_matches:
+            self.on_progress(f"Keeping the first {self.max_matches} of {len(results)} files found")
+            results = results.head(self.max_matches)
+
+        self.emit_stats(scanned, len(submitted), len(results), force=True)
+        self.on_progress(f"Scanned {len(submitted)} of {discovered} roots in {time.monotonic() - started:.2f}s")
+        if self.triage and not self.triage_disabled:
+            self.on_progress(f"Triage skipped {self.roots_skipped} roots with duplicate filesystem trees")
+        if self.roots_timed_out:
+            self.on_progress(f"{len(self.roots_timed_out)} roots ran over the {self.root_timeout}s limit and were "
+                             f"cut short: {', '.join(self.roots_timed_out)}")
+        if self.roots_failed:
+            self.on_progress(f"{len(self.roots_failed)} roots could not be fully listed and were not cached: "
+                             f"{', '.join(self.roots_failed)}")
+        if self.cancelled:
+            self.on_progress("Cancelled, file metadata was not read")
+        else:
+            self.on_metadata(self.collect_metadata(results))
+        return list(results), results
+
+    def cancel(self):
+        # Stops discovery and every running scan; their partial output is kept
+        self.cancelled = True
+        self.stop_discovery()
+        self.stop_scans('cancelled')
+
+    def stop_scans(self, reason):
+        with self.process_lock:
+            for process in self.processes:
+                self.stop_process(process, reason)
+
+    @contextlib.contextmanager
+    def tracked(self, process, stats=None, timeout=None):
+        # While the block runs, cancel() and stop_scans() terminate process, and so does
+        # timeout after that many seconds. stats, if given, receives the reason it was
+        # terminated ('timeout', 'cancelled' or 'stopped').
+        with self.process_lock:
+            self.processes.add(process)
+            if self.cancelled:
+                self.stop_process(process, 'cancelled')
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self.time_out, (process,))
+            timer.daemon = True
+            timer.start()
+        try:
+            yield
+        finally:
+            if timer:
+                timer.cancel()
+            with self.process_lock:
+                self.processes.discard(process)
+                reason = self.stop_reasons.pop(process, None)
+            if reason and stats is not None:
+                stats['stopped'] = reason
+
+    def time_out(self, process):
+        with self.process_lock:
+            if process in self.processes:
+                self.stop_process(process, 'timeout')
+
+    def stop_process(self, process, reason):
+        # Called with process_lock held. The first reason wins, so a scan cancelled after
+        # its timeout still counts as timed out.
+        self.stop_reasons.setdefault(process, reason)
+        process.terminate()
+
+    def collect_metadata(self, results):
+        # Each path takes its size and mtime from the newest root that lists it, which is
+        # the root a restore would use. One dump of a root's filesystem tree covers all of
+        # its paths, so usually only the newest one or two roots are read.
+        # The dumps are tracked like the scans, so cancel() ends them and root_timeout
+        # bounds each one; a dump cut short still gives the sizes it got to.
+        metadata = {}
+        started = time.monotonic()
+        dumped = 0
+        for root, wanted in results.group_by_root(results).items():
+            if self.cancelled:
+                self.on_progress(f"Cancelled, keeping the metadata of {len(metadata)} files")
+                break
+            with self.tracer.span(f"metadata {root}", 'metadata', root=root, paths=len(wanted)) as span:
+                inodes = self.cache.get_metadata(root) if self.cache else None
+                span['cached'] = inodes is not None
+                if inodes is None:
+                    self.on_progress(f"Reading file metadata from root {root}")
+                    try:
+                        inodes = read_inode_metadata(self.device, root, self.use_sudo, span,
+                                                     lambda process: self.tracked(process, span, self.root_timeout))
+                    except Exception as e:
+                        self.on_progress(f"Could not read metadata from root {root}: {str(e)}")
+                        continue
+                    dumped += 1
+                    if span.get('stopped') == 'timeout':
+                        self.on_progress(f"Root {root}: reading metadata ran over the {self.root_timeout}s limit, "
+                                         f"keeping what was read")
+                    elif self.cache and not span.get('stopped'):
+                        self.cache.put_metadata(root, inodes)
+            generation = self.root_generations.get(root)
+            for path in wanted:
+                info = inodes.get(path)
+                if info:
+                    metadata[path] = (info[0], info[1], generation)
+        self.on_progress(f"Metadata for {len(metadata)} files read from {dumped} roots in {time.monotonic() - started:.2f}s")
+        return metadata
+
+    def emit_stats(self, roots_done, roots_total, files_matched, force=False):
+        now = time.monotonic()
+        if not force and now - self.stats_time < LOG_FLUSH_INTERVAL:
+            return
+        lines = self.lines_parsed
+        rate = (lines - self.stats_lines) / (now - self.stats_time) if self.stats_time else 0.0
+        self.stats_time = now
+        self.stats_lines = lines
+        self.on_stats({'roots_done': roots_done, 'roots_total': roots_total, 'roots_skipped': self.roots_skipped,
+                       'roots_timed_out': len(self.roots_timed_out), 'files_matched': files_matched,
+                       'lines_per_sec': rate})
+
+    def discover_roots(self, events):
+        # Triage: roots whose filesystem tree is identical to an earlier root's would list
+        # exactly the same files, so only the first of them is passed on for scanning.
+        error = None
+        seen = {}
+        image = self.open_triage_image() if self.triage else None
+        try:
+            for root in self.iter_roots():
+                if self.discovery_stopped:
+                    break
+                fingerprint = None
+                if image:
+                    with self.tracer.span(f"fingerprint {root}", 'triage', root=root):
+                        fingerprint = self.fingerprint_root(image, root)
+                if fingerprint is not None:
+                    if fingerprint in seen:
+                        self.roots_skipped += 1
+                        self.on_progress(f"Root {root} has the same filesystem tree as root {seen[fingerprint]}, skipping")
+                        continue
+                    seen[fingerprint] = root
+                events.put(('root', root, None))
+        except Exception as e:
+            error = e
+        finally:
+            if image:
+                image.close()
+        events.put(('discovered', None, error))
+
+    def open_triage_image(self):
+        # Triage needs the tree blocks themselves. Without direct access every root is
+        # scanned: a dump-tree per root to find its filesystem tree would cost more than
+        # the scans it saves, and the tree's address alone doesn't tell two trees apart.
+        try:
+            return BtrfsImage(self.device)
+        except (OSError, BtrfsFormatError) as e:
+            self.triage_disabled = True
+            self.on_progress(f"Triage disabled, every root is scanned: {self.device} can't be read directly ({str(e)})")
+            return None
+
+    def fingerprint_root(self, image, root):
+        # None when the root can't be fingerprinted; such roots are always scanned
+        try:
+            return image.fs_tree_fingerprint(int(root))
+        except (OSError, BtrfsFormatError, ValueError):
+            return None
+
+    def stop_discovery(self):
+        self.discovery_stopped = True
+        process = self.find_root_process
+        if process and process.poll() is None:
+            process.terminate()
+
+    def scan_root(self, root):
+        if self.cancelled:
+            return set(), 0.0
+        with self.tracer.span(f"scan {root}", 'scan', root=root, generation=self.root_generations.get(root)) as span:
+            files = self.cache.get_files(root, self.path_regex) if self.cache else None
+            span['cached'] = files is not None
+            if files is not None:
+                span['matches'] = len(files)
+                return files, 0.0
+
+            command = ['btrfs', 'restore', '-t', root, '-Divv', '--path-regex', self.path_regex, self.device, DRY_RUN_OUTPUT]
+            if self.use_sudo:
+                command = ['sudo'] + command
+
+            self.on_progress(f"Executing command: {' '.join(command)}")
+            started = time.monotonic()
+            files = self.execute_command(command, span, self.root_timeout)
+            span['matches'] = len(files)
+            if span.get('stopped') == 'timeout':
+                self.roots_timed_out.append(root)
+                self.on_progress(f"Root {root} ran over the {self.root_timeout}s limit, "
+                                 f"keeping the {len(files)} matches it listed")
+            failed = span['returncode'] != 0 and not span.get('stopped')
+            if failed:
+                self.roots_failed.append(root)
+                self.on_progress(f"Root {root}: btrfs restore failed with exit status {span['returncode']}, "
+                                 f"its {len(files)} matches may be incomplete")
+            # A scan that failed or was cut short must not be mistaken for the root's full listing
+            if self.cache and not failed and not span.get('stopped'):
+                self.cache.put_files(root, self.path_regex, files)
+        return files, time.monotonic() - started
+
+    def find_roots(self):
+        return list(self.iter_roots())
+
+    def iter_roots(self):
+        roots = self.cache.get_roots() if self.cache else None
+        if roots is not None:
+            self.on_progress(f"Using {len(roots)} cached roots")
+        elif os.access(self.device, os.R_OK):
+            roots = self.scan_roots()
+            # A generation-limited scan is not the full set of roots
+            if roots is not None and self.cache and self.min_generation is None:
+                self.cache.put_roots(roots)
+        if roots is None:
+            yield from self.run_find_root()
+            return
+        for root, generation in roots:
+            if self.wanted_generation(generation):
+                if generation is not None:
+                    self.root_generations[root] = generation
+                yield root
+
+    def wanted_generation(self, generation):
+        return self.min_generation is None or generation is None or generation >= self.min_generation
+
+    def scan_roots(self):
+        # Read the tree roots straight from the device; None means fall back to btrfs-find-root
+        self.on_progress(f"Scanning {self.device} for tree roots")
+        started = time.monotonic()
+        try:
+            with self.tracer.span('built-in root scan', 'discovery') as span, BtrfsImage(self.device) as image:
+                # Like btrfs-find-root, leave out the root the superblock already points at
+                current = image.superblock.root
+                roots = [(str(root.bytenr), root.generation)
+                         for root in image.find_tree_roots(min_generation=self.min_generation)
+                         if root.bytenr != current]
+                span['roots'] = len(roots)
+        except (OSError, BtrfsFormatError) as e:
+            self.on_progress(f"Built-in root scan failed ({str(e)}), falling back to btrfs-find-root")
+            return None
+        self.on_progress(f"Found {len(roots)} roots in {time.monotonic() - started:.2f}s")
+        return roots
+
+    def run_find_root(self):
+        find_root_command = ['btrfs-find-root', self.device]
+        # btrfs-find-root block-buffers its stdout on a pipe; force line buffering so roots stream in
+        if shutil.which('stdbuf'):
+            find_root_command = ['stdbuf', '-oL'] + find_root_command
+        if self.use_sudo:
+            find_root_command = ['sudo'] + find_root_command
+        
+        self.on_progress(f"Finding roots: {' '.join(find_root_command)}")
+        with self.tracer.span('btrfs-find-root', 'discovery') as span:
+            process = subprocess.Popen(find_root_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.find_root_process = process
+            found = []
+            lines = 0
+            for block in read_line_blocks(process.stdout):
+                lines += block.count(b'\n')
+                for bytenr, gen in WELL_BLOCK.findall(block):
+                    root = bytenr.decode()
+                    generation = int(gen) if gen else None
+                    found.append((root, generation))
+                    if self.wanted_generation(generation):
+                        if generation is not None:
+                            self.root_generations[root] = generation
+                        yield root
+            span.update(wait_process(process), lines=lines, roots=len(found))
+        # A list cut short by an early stop must not be mistaken for the full set of roots
+        if self.cache and not self.discovery_stopped and process.returncode == 0:
+            self.cache.put_roots(found)
+
+    def execute_command(self, command, stats=None, timeout=None):
+        # Output is parsed in binary; see btrfs_output. stats, if given, receives the line
+        # count, the exit status ('returncode'), the process's resource usage and, if it
+        # was terminated early, the reason ('timeout', 'cancelled' or 'stopped').
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        deleted_files = set()
+        lines = 0
+        with self.tracked(process, stats, timeout):
+            for block in read_line_blocks(process.stdout):
+                self.log_channel.append_block(block)
+                lines += block.count(b'\n')
+                deleted_files.update(map(decode_path, DRY_RUN_RESTORING.findall(block)))
+                # One root alone listing max_matches paths is enough to end the listing
+                if self.max_matches and len(deleted_files) >= self.max_matches and process not in self.stop_reasons:
+                    with self.process_lock:
+                        self.stop_process(process, 'stopped')
+            usage = wait_process(process)
+        if stats is not None:
+            stats.update(usage, lines=lines, returncode=process.returncode)
+        # Summed from every pool thread; a lost update only skews the lines/sec estimate
+        self.lines_parsed += lines
+        return deleted_files
+
+
+# Upper bound for one combined --path-regex. Well below the kernel's 128 KiB limit for a
+# single argv string, and small enough that regcomp() stays fast.
+MAX_RESTORE_REGEX = 32 * 1024
+
+
+def posix_regex_escape(text):
+    # btrfs restore compiles --path-regex as a POSIX extended regex
+    return re.sub(r'([.\[\]()*+?{}|^$\\])', r'\\\1', text)
+
+
+def build_restore_regex(paths):
+    # btrfs restore matches the regex against every directory it descends into as well as
+    # the files themselves, so each file becomes a nested alternation of its parent
+    # directories: home/a and home/b give ^(/home(|/a|/b))$
+    tree = {}
+    for path in paths:
+        node = tree
+        for part in path.strip('/').split('/'):
+            node = node.setdefault(part, {})
+
+    def render(node):
+        return '|'.join(f"/{posix_regex_escape(name)}" + (f"(|{render(child)})" if child else '')
+                        for name, child in node.items())
+
+    return f"^({render(tree)})$"
+
+
+def chunk_restore_paths(paths, max_regex=MAX_RESTORE_REGEX):
+    # Conservative size estimate: every character escaped plus the group syntax per path
+    chunk = []
+    size = 0
+    for path in sorted(paths):
+        estimate = 2 * len(path) + 8
+        if chunk and size + estimate > max_regex:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(path)
+        size += estimate
+    if chunk:
+        yield chunk
+
+
+class Throttle:
+    # Paces restore batches so their expected reads stay under max_bytes and max_files per
+    # second; None means no limit. Each batch waits until the budget of the batches
+    # before it has been spent.
+
+    def __init__(self, max_bytes=None, max_files=None):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.next_start = time.monotonic()
+
+    def __bool__(self):
+        return bool(self.max_bytes or self.max_files)
+
+    def split(self, files, sizes):
+        # Cuts a batch into pieces of at most about one second's budget
+        piece = []
+        piece_bytes = 0
+        for path in files:
+            size = sizes.get(path) or 0
+            if piece and ((self.max_files and len(piece) >= self.max_files)
+                          or (self.max_bytes and piece_bytes + size > self.max_bytes)):
+                yield piece
+                piece = []
+                piece_bytes = 0
+            piece.append(path)
+            piece_bytes += size
+        if piece:
+            yield piece
+
+    def wait(self, size, files):
+        cost = max(size / self.max_bytes if self.max_bytes else 0, files / self.max_files if self.max_files else 0)
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + cost
+        if start > now:
+            time.sleep(start - now)
+
+
+class RestoreEngine:
+    # Restores {path: root} in batches. Callbacks, called from any thread:
+    #   on_progress(message)
+    #   on_restore_progress(restored files, selected files)
+    # Every batch is recorded in tracer.
+    # With a journal (see btrfs_journal), files an earlier run already verified are
+    # skipped and every batch's files are checked and recorded as it finishes. sizes
+    # ({path: expected size}, from the btrfs metadata) is used to check free space up
+    # front, to verify sizes and to throttle reads to max_read_bytes and max_files per
+    # second; throttled jobs run one batch at a time. cancel() may be called from any
+    # thread; batches that haven't started yet are then skipped.
+
+    def __init__(self, device, destination, file_roots, use_sudo=True, max_workers=None, log_channel=None,
+                 tracer=None, journal=None, sizes=None, max_read_bytes=None, max_files=None, check_space=True):
+        self.on_progress = no_op
+        self.on_restore_progress = no_op
+        self.log_channel = log_channel or LogChannel()
+        self.tracer = tracer or Tracer()
+        self.device = device
+        self.destination = destination
+        self.file_roots = file_roots
+        self.use_sudo = use_sudo
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self.journal = journal
+        self.sizes = sizes or {}
+        self.throttle = Throttle(max_read_bytes, max_files)
+        self.check_space = check_space
+        self.skipped = 0
+        self.verified = 0
+        self.failed = []
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def run(self):
+        # Returns the number of files btrfs restore reported as restored
+        try:
+            return self.restore_files()
+        finally:
+            if self.journal:
+                self.journal.close()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def pending_files(self):
+        if not self.journal:
+            return dict(self.file_roots)
+        pending = {path: root for path, root in self.file_roots.items()
+                   if not self.journal.is_done(path, root, self.destination)}
+        self.skipped = len(self.file_roots) - len(pending)
+        if self.skipped:
+            self.on_progress(f"Skipping {self.skipped} files already restored and verified by an earlier run")
+        return pending
+
+    def check_free_space(self, files):
+        needed = sum(self.sizes.get(path) or 0 for path in files)
+        free = shutil.disk_usage(self.destination).free
+        if needed > free:
+            raise RecoveryError(f"{self.destination} has {free // (1024 * 1024)} MiB free, but the selected files "
+                                f"need {needed // (1024 * 1024)} MiB")
+        unknown = sum(1 for path in files if self.sizes.get(path) is None)
+        self.on_progress(f"Free space check: {needed // (1024 * 1024)} MiB needed, {free // (1024 * 1024)} MiB free"
+                         + (f" ({unknown} files of unknown size)" if unknown else ""))
+
+    def restore_files(self):
+        os.makedirs(self.destination, exist_ok=True)
+        pending = self.pending_files()
+        if not pending:
+            self.on_restore_progress(self.skipped, len(self.file_roots))
+            return 0
+        if self.check_space:
+            self.check_free_space(pending)
+        groups = {}
+        for file, root in pending.items():
+            groups.setdefault(root, []).append(file)
+        batches = [(root, piece) for root, files in groups.items() for chunk in chunk_restore_paths(files)
+                   for piece in (self.throttle.split(chunk, self.sizes) if self.throttle else [chunk])]
+        total = len(self.file_roots)
+        max_workers = self.max_workers
+        if self.throttle:
+            # Parallel batches would only make a fragile disk seek between them
+            max_workers = 1
+            self.on_progress("Reads are throttled, restoring one batch at a time")
+        self.on_progress(f"Restoring {len(pending)} files from {len(groups)} roots in {len(batches)} batches")
+
+        restored = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(self.restore_batch, root, files) for root, files in batches]
+            for done, future in enumerate(as_completed(futures), 1):
+                restored += future.result()
+                self.on_restore_progress(self.skipped + restored, total)
+                self.on_progress(f"Finished batch {done}/{len(batches)}")
+        if self.journal:
+            self.on_progress(f"{self.verified} files verified, {len(self.failed)} missing or of the wrong size"
+                             + (f": {', '.join(self.failed[:10])}" if self.failed else ""))
+        return restored
+
+    def restore_batch(self, root, files, destination=None):
+        # A journaled job overwrites files left half written by an interrupted run
+        options = '-oivv' if self.journal else '-ivv'
+        command = ['btrfs', 'restore', options, '-t', root, '--path-regex', build_restore_regex(files),
+                   self.device, destination or self.destination]
+        if self.use_sudo:
+            command = ['sudo'] + command
+
+        if self.throttle:
+            self.throttle.wait(sum(self.sizes.get(path) or 0 for path in files), len(files))
+        if self.cancelled:
+            return 0
+        self.on_progress(f"Restoring {len(files)} files from root {root}")
+        with self.tracer.span(f"restore {root}", 'restore', root=root, files=len(files)) as span:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            restored = 0
+            lines = 0
+            for block in read_line_blocks(process.stdout):
+                self.log_channel.append_block(block)
+                lines += block.count(b'\n')
+                restored += len(RESTORING.findall(block))
+            span.update(wait_process(process), lines=lines, restored=restored)
+        if self.journal and destination is None:
+            self.record_batch(root, files)
+        return restored
+
+    def record_batch(self, root, files):
+        with self.tracer.span(f"verify {root}", 'restore', root=root, files=len(files)):
+            records = [self.journal.verify(root, path, self.destination, self.sizes.get(path)) for path in files]
+            self.journal.write(records)
+        with self.lock:
+            for record in records:
+                if record['status'] == 'verified':
+                    self.verified += 1
+                else:
+                    self.failed.append(record['path'])
@@ -0,0 +1,249 @@
+import heapq
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from array import array
+from itertools import groupby
+
+from btrfs_engine import PathPatterns, RecoveryError, no_op
+from btrfs_output import decode_path
+from btrfs_results import ScanResults, file_record
+from btrfs_scan_cache import filesystem_identity
+
+# Saving a finished scan so it can be looked at again, or by someone else, without
+# rescanning. Two formats, picked by the file name:
+#
+# SQLite (anything but .ndjson/.jsonl), indexed for queries with other tools:
+#   scan(key, value)        the scan settings and the filesystem it came from, values as JSON
+#   roots(position, root, generation, files, members)
+#                           roots in the order they were added; members is the sorted ids
+#                           of the files the root lists, as zlib-compressed little-endian
+#                           uint32s
+#   files(id, path, size, mtime, generation, root)
+#                           root is the position of the newest root listing the file. path
+#                           is TEXT, or a BLOB of the raw bytes for names that aren't UTF-8.
+# Loading reads the three tables into ScanResults' columns directly, so a million paths
+# take a second or two.
+#
+# NDJSON (.ndjson, .jsonl), written as it goes and readable line by line:
+#   {"record": "scan", ...settings}
+#   {"record": "root", "root": ..., "generation": ..., "files": ...}      one per root
+#   {"record": "file", "path": ..., "size": ..., ..., "roots": [...]}     one per file
+
+FORMAT_VERSION = 1
+NDJSON_SUFFIXES = ('.ndjson', '.jsonl')
+SQLITE_MAGIC = b'SQLite format 3\0'
+PROGRESS_EVERY = 100000
+
+
+def is_ndjson(path):
+    return path.lower().endswith(NDJSON_SUFFIXES)
+
+
+def scan_info(results, device, metadata_image=None, use_sudo=False, **settings):
+    # What save_scan() records besides the files: the scan settings passed in (pattern,
+    # type, depth, ...) and the identity of the filesystem that was scanned, if readable
+    try:
+        identity = filesystem_identity(metadata_image or device, use_sudo)
+    except OSError:
+        identity = None
+    return {'format_version': FORMAT_VERSION, 'saved': time.time(), 'device': device,
+            'metadata_image': metadata_image, 'fsid': identity[0] if identity else None,
+            'fs_generation': identity[1] if identity else None, 'files': len(results),
+            'roots': len(results.root_names), **settings}
+
+
+def check_saved_scan(info, device, use_sudo=False):
+    # Returns a warning if device isn't the filesystem the scan was saved from, or has
+    # been written to since, and None if it is or that can't be told
+    if not info.get('fsid'):
+        return None
+    try:
+        identity = filesystem_identity(device, use_sudo)
+    except OSError:
+        identity = None
+    if identity is None:
+        return None
+    if identity[0] != info['fsid']:
+        return f"Warning: the scan was saved from filesystem {info['fsid']}, {device} is {identity[0]}"
+    if identity[1] != info['fs_generation']:
+        return (f"Warning: {device} is at generation {identity[1]}, the saved scan at {info['fs_generation']}; "
+                f"files it lists may have been overwritten since")
+    return None
+
+
+def save_scan(path, results, metadata, info, on_progress=no_op):
+    # Writes to a temporary file first, so an interrupted save never leaves half a scan.
+    # on_progress(files written, files total)
+    temporary = path + '.part'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    try:
+        if is_ndjson(path):
+            save_ndjson(temporary, results, metadata, info, on_progress)
+        else:
+            save_sqlite(temporary, results, metadata, info, on_progress)
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def stored_path(path):
+    if path.isascii():
+        return path
+    try:
+        path.encode('utf-8')
+        return path
+    except UnicodeEncodeError:
+        return path.encode('utf-8', 'surrogateescape')
+
+
+def save_sqlite(path, results, metadata, info, on_progress):
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        # Nothing to protect until the file is complete, see save_scan()
+        db.execute('PRAGMA journal_mode=OFF')
+        db.execute('PRAGMA synchronous=OFF')
+        db.executescript('''
+            CREATE TABLE scan (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE roots (
+                position INTEGER PRIMARY KEY,
+                root TEXT NOT NULL,
+                generation INTEGER,
+                files INTEGER NOT NULL,
+                members BLOB NOT NULL
+            );
+            CREATE TABLE files (
+                id INTEGER PRIMARY KEY,
+                path NOT NULL,
+                size INTEGER,
+                mtime REAL,
+                generation INTEGER,
+                root INTEGER NOT NULL REFERENCES roots (position)
+            );
+        ''')
+        db.execute('BEGIN')
+        db.executemany('INSERT INTO scan VALUES (?, ?)', [(key, json.dumps(value)) for key, value in info.items()])
+        for position, (root, generation, members) in enumerate(zip(results.root_names, results.generations,
+                                                                   results.members)):
+            packed = members
+            if sys.byteorder == 'big':
+                packed = array('I', members)
+                packed.byteswap()
+            db.execute('INSERT INTO roots VALUES (?, ?, ?, ?, ?)',
+                       (position, root, generation, len(members), zlib.compress(packed.tobytes(), 1)))
+
+        unknown = (None, None, None)
+        total = len(results.paths)
+
+        def rows():
+            for path_id, (path, newest) in enumerate(zip(results.paths, results.newest)):
+                size, mtime, generation = metadata.get(path, unknown)
+                if path_id % PROGRESS_EVERY == 0:
+                    on_progress(path_id, total)
+                yield path_id, stored_path(path), size, mtime, generation, newest
+
+        db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)', rows())
+        db.execute('CREATE INDEX files_path ON files (path)')
+        db.execute('CREATE INDEX files_root ON files (root)')
+        db.execute('COMMIT')
+        on_progress(total, total)
+    finally:
+        db.close()
+
+
+def root_lists(results):
+    # Yields (path id, [root names]) in id order, merging the roots' sorted id arrays
+    def tagged(index, members):
+        return ((path_id, index) for path_id in members)
+
+    names = results.root_names
+    merged = heapq.merge(*(tagged(index, members) for index, members in enumerate(results.members)))
+    for path_id, entries in groupby(merged, key=lambda entry: entry[0]):
+        yield path_id, [names[index] for _, index in entries]
+
+
+def save_ndjson(path, results, metadata, info, on_progress):
+    patterns = PathPatterns.parse(info.get('pattern') or '', info.get('type') or 'everything')
+    total = len(results.paths)
+    with open(path, 'w') as f:
+        f.write(json.dumps({'record': 'scan', **info}) + '\n')
+        for root, generation, members in zip(results.root_names, results.generations, results.members):
+            f.write(json.dumps({'record': 'root', 'root': root, 'generation': generation, 'files': len(members)})
+                    + '\n')
+        for path_id, roots in root_lists(results):
+            record = file_record(results.paths[path_id], results, metadata, patterns)
+            f.write(json.dumps({'record': 'file', **record, 'roots': roots}) + '\n')
+            if path_id % PROGRESS_EVERY == 0:
+                on_progress(path_id, total)
+    on_progress(total, total)
+
+
+def load_scan(path):
+    # Returns (ScanResults, {path: (size, mtime, generation)}, info)
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(len(SQLITE_MAGIC))
+        if magic == SQLITE_MAGIC:
+            return load_sqlite(path)
+        return load_ndjson(path)
+    except (sqlite3.Error, ValueError, KeyError, TypeError, IndexError, zlib.error) as e:
+        raise RecoveryError(f"{path} is not a saved scan: {e}")
+
+
+def load_sqlite(path):
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        info = {key: json.loads(value) for key, value in db.execute('SELECT key, value FROM scan')}
+        if info.get('format_version', 0) > FORMAT_VERSION:
+            raise RecoveryError(f"{path} was saved by a newer version (format {info['format_version']})")
+        roots = []
+        for root, generation, members in db.execute('SELECT root, generation, members FROM roots ORDER BY position'):
+            ids = array('I')
+            ids.frombytes(zlib.decompress(members))
+            if sys.byteorder == 'big':
+                ids.byteswap()
+            roots.append((root, generation, ids))
+        # Column at a time: a Python loop over a million rows costs more than the query
+        rows = db.execute('SELECT path, size, mtime, generation, root FROM files ORDER BY id').fetchall()
+    finally:
+        db.close()
+    paths, sizes, mtimes, generations, newest = zip(*rows) if rows else ((),) * 5
+    del rows
+    paths = [decode_path(name) if type(name) is bytes else name for name in paths]
+    unknown = (None, None, None)
+    metadata = {name: known for name, known in zip(paths, zip(sizes, mtimes, generations)) if known != unknown}
+    return ScanResults.from_parts(paths, newest, roots), metadata, info
+
+
+def load_ndjson(path):
+    info = None
+    roots = []
+    root_index = {}
+    paths = []
+    newest = []
+    metadata = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            kind = record.pop('record')
+            if kind == 'file':
+                path_id = len(paths)
+                paths.append(record['path'])
+                newest.append(root_index[record['root']])
+                for root in record['roots']:
+                    roots[root_index[root]][2].append(path_id)
+                if any(record.get(name) is not None for name in ('size', 'mtime', 'generation')):
+                    metadata[record['path']] = (record['size'], record['mtime'], record['generation'])
+            elif kind == 'root':
+                root_index[record['root']] = len(roots)
+                roots.append((record['root'], record['generation'], array('I')))
+            elif kind == 'scan':
+                info = record
+    if info is None:
+        raise RecoveryError(f"{path} is not a saved scan: it has no scan record")
+    return ScanResults.from_parts(paths, newest, roots), metadata, info
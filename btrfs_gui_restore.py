@@ -1,85 +1,315 @@
 import sys
 import os
-import stat
+import html
 from datetime import datetime
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, 
-                             QLabel, QLineEdit, QTextEdit, QFileDialog, QTableWidget, 
-                             QTableWidgetItem, QHeaderView, QComboBox, QCheckBox)
+                             QLabel, QLineEdit, QPlainTextEdit, QFileDialog, QTableView, 
+                             QAbstractItemView, QHeaderView, QComboBox, QCheckBox, QSpinBox, QSplitter,
+                             QTreeWidget, QTreeWidgetItem, QTableWidget, QTableWidgetItem)
 from PyQt5.QtWidgets import QDialog, QVBoxLayout, QTextBrowser, QPushButton, QScrollArea
-from PyQt5.QtCore import QThread, pyqtSignal, Qt
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal, Qt, QAbstractTableModel, QModelIndex
 from PyQt5.QtGui import QPalette, QColor
-import sys
-import subprocess
-import re
+from btrfs_capture import capture_metadata
+from btrfs_client import DaemonClient, daemon_available
+from btrfs_devices import DeviceCache, device_fingerprint
+from btrfs_engine import (DEFAULT_DESTINATION, LOG_FLUSH_INTERVAL, LOG_MAX_BLOCKS, RECOVERY_TYPES, ListEngine,
+                          LogChannel, PathPatterns, RecoveryError, RestoreEngine, check_device, unmount_device)
+from btrfs_export import check_saved_scan, load_scan, save_scan, scan_info
+from btrfs_index import PathIndex
+from btrfs_jobs import QUEUED, RUNNING, RESTORE, JobQueue
+from btrfs_output import display_path
+from btrfs_results import ScanResults
+from btrfs_journal import RestoreJournal, default_journal_path
+from btrfs_trace import Tracer
+from btrfs_versions import VersionCollector, restore_version
+
+# Milliseconds between checks for block devices and filesystems coming and going
+DEVICE_CHECK_INTERVAL = 3000
+# Milliseconds between refreshes of the job queue window
+JOB_REFRESH_INTERVAL = 500
 
 class BtrfsListWorker(QThread):
-    finished = pyqtSignal(list, dict)
+    # paths, ScanResults
+    finished = pyqtSignal(list, object)
+    progress = pyqtSignal(str)
+    # Paths not reported by any earlier root, emitted while the scan is still running
+    files_found = pyqtSignal(list)
+    # done, total, root, seconds spent on that root
+    root_progress = pyqtSignal(int, int, str, float)
+    # {path: (size, mtime, root generation)}, emitted right before finished
+    metadata_found = pyqtSignal(dict)
+    # roots_done, roots_total, files_matched, lines_per_sec; at most every LOG_FLUSH_INTERVAL
+    stats = pyqtSignal(dict)
+    # PathIndex over the final listing, built on this thread; emitted right before finished
+    index_ready = pyqtSignal(object)
+
+    def __init__(self, device, use_sudo, path_regex, destination=DEFAULT_DESTINATION, **options):
+        super().__init__()
+        self.engine = ListEngine(device, use_sudo, path_regex, destination, **options)
+        self.engine.on_progress = self.progress.emit
+        self.engine.on_files_found = self.files_found.emit
+        self.engine.on_root_progress = self.root_progress.emit
+        self.engine.on_metadata = self.set_metadata
+        self.engine.on_stats = self.stats.emit
+        self.metadata = {}
+
+    def cancel(self):
+        self.engine.cancel()
+
+    def set_metadata(self, metadata):
+        self.metadata = metadata
+        self.metadata_found.emit(metadata)
+
+    def run(self):
+        try:
+            files, successful_roots = self.engine.run()
+        except Exception as e:
+            self.progress.emit(f"Error: {str(e)}")
+            files, successful_roots = [], ScanResults()
+        with self.engine.tracer.span('build index', 'gui', paths=len(files)):
+            index = PathIndex(files, self.metadata)
+            index.prepare()
+        self.index_ready.emit(index)
+        self.finished.emit(files, successful_roots)
+
+
+class DaemonListWorker(BtrfsListWorker):
+    # The same signals as BtrfsListWorker, for a listing done by the recovery daemon (see
+    # btrfs_daemon); its btrfs output is copied into log_channel
+    def __init__(self, scan_params, log_channel, tracer):
+        QThread.__init__(self)
+        self.scan_params = scan_params
+        self.log_channel = log_channel
+        self.tracer = tracer
+        self.metadata = {}
+        self.task = None
+
+    def cancel(self):
+        if self.task:
+            try:
+                with DaemonClient() as client:
+                    client.call('cancel', task=self.task)
+            except (OSError, RecoveryError) as e:
+                self.progress.emit(f"Error cancelling: {str(e)}")
+
+    def handle_event(self, event):
+        kind = event['event']
+        if kind == 'progress':
+            self.progress.emit(event['message'])
+        elif kind == 'files':
+            self.files_found.emit(event['paths'])
+        elif kind == 'root':
+            self.root_progress.emit(event['done'], event['total'], event['root'], event['seconds'])
+        elif kind == 'stats':
+            self.stats.emit({name: value for name, value in event.items() if name not in ('task', 'event')})
+        elif kind == 'log':
+            for line in event['lines']:
+                self.log_channel.append(line)
+
+    def run(self):
+        try:
+            with DaemonClient() as client:
+                task = client.call('scan', **self.scan_params)
+                self.task = task['task']
+                if task['state'] != 'running':
+                    self.progress.emit(f"Reusing scan {self.task} held by the recovery daemon")
+                finished = client.subscribe(self.task, self.handle_event, log=True)
+                if finished['state'] == 'failed':
+                    raise RecoveryError(finished['error'])
+                successful_roots, metadata = client.fetch_results(self.task)
+            files = list(successful_roots)
+            self.set_metadata(metadata)
+        except Exception as e:
+            self.progress.emit(f"Error: {str(e)}")
+            files, successful_roots = [], ScanResults()
+        with self.tracer.span('build index', 'gui', paths=len(files)):
+            index = PathIndex(files, self.metadata)
+            index.prepare()
+        self.index_ready.emit(index)
+        self.finished.emit(files, successful_roots)
+
+
+class DeviceDiscoveryWorker(QThread):
+    # [(device, uuid, label)]
+    finished = pyqtSignal(list)
     progress = pyqtSignal(str)
 
-    def __init__(self, device, use_sudo, path_regex, destination='/tmp/btrfs_recovery'):
+    def __init__(self, device_cache, force=False):
+        super().__init__()
+        self.device_cache = device_cache
+        self.force = force
+
+    def run(self):
+        try:
+            # Never interactive: there is no terminal for a sudo password prompt
+            devices = self.device_cache.refresh(self.force, interactive=False)
+        except Exception as e:
+            self.progress.emit(f"Error listing BTRFS partitions: {str(e)}")
+            devices = self.device_cache.devices or []
+        self.finished.emit(devices)
+
+
+class MetadataCaptureWorker(QThread):
+    # {method, bytes, unreadable_bytes}, or None if the capture failed
+    finished = pyqtSignal(object)
+    progress = pyqtSignal(str)
+    # bytes copied, bytes total (0 when unknown)
+    capture_progress = pyqtSignal(object, object)
+
+    def __init__(self, device, path, use_sudo, tracer):
         super().__init__()
         self.device = device
+        self.path = path
         self.use_sudo = use_sudo
-        self.path_regex = path_regex
-        self.destination = destination
+        self.tracer = tracer
 
     def run(self):
         try:
-            self.list_deleted_files()
+            with self.tracer.span('capture', 'capture', device=self.device) as span:
+                result = capture_metadata(self.device, self.path, self.use_sudo,
+                                          on_progress=self.capture_progress.emit)
+                span.update(result)
         except Exception as e:
-            self.progress.emit(f"Error: {str(e)}")
-            self.finished.emit([], {})
+            self.progress.emit(f"Error capturing metadata: {str(e)}")
+            result = None
+        self.finished.emit(result)
 
-    def list_deleted_files(self):
-        roots = self.find_roots()
-        
-        if not roots:
-            self.progress.emit("Error: Could not find any valid roots.")
-            self.finished.emit([], {})
+
+class ScanSaveWorker(QThread):
+    # Error message, or '' once the scan is saved
+    finished = pyqtSignal(str)
+
+    def __init__(self, path, results, metadata, settings, tracer):
+        super().__init__()
+        self.path = path
+        self.results = results
+        self.metadata = metadata
+        self.settings = settings
+        self.tracer = tracer
+
+    def run(self):
+        try:
+            with self.tracer.span('save scan', 'gui', files=len(self.results)):
+                save_scan(self.path, self.results, self.metadata, scan_info(self.results, **self.settings))
+            error = ''
+        except Exception as e:
+            error = str(e)
+        self.finished.emit(error)
+
+
+class ScanLoadWorker(QThread):
+    # (ScanResults, metadata, info) of the saved scan, or None if it couldn't be loaded
+    finished = pyqtSignal(object)
+    progress = pyqtSignal(str)
+    # PathIndex over the saved files, emitted right before finished
+    index_ready = pyqtSignal(object)
+
+    def __init__(self, path, use_sudo, tracer):
+        super().__init__()
+        self.path = path
+        self.use_sudo = use_sudo
+        self.tracer = tracer
+
+    def run(self):
+        try:
+            with self.tracer.span('load scan', 'gui', file=self.path):
+                results, metadata, info = load_scan(self.path)
+            with self.tracer.span('build index', 'gui', paths=len(results)):
+                index = PathIndex(list(results), metadata)
+                index.prepare()
+        except Exception as e:
+            self.progress.emit(f"Error opening {self.path}: {str(e)}")
+            self.finished.emit(None)
             return
+        device = info.get('device')
+        if device and os.path.exists(device):
+            warning = check_saved_scan(info, device, self.use_sudo)
+            if warning:
+                self.progress.emit(warning)
+        self.index_ready.emit(index)
+        self.finished.emit((results, metadata, info))
+
+
+class VersionWorker(QThread):
+    # ({path: [Version]}, totals), see btrfs_versions
+    finished = pyqtSignal(object)
+    progress = pyqtSignal(str)
+    # batches done, batches total
+    stage_progress = pyqtSignal(int, int)
 
-        deleted_files = set()
-        successful_roots = {}
-        for root in roots:
-            command = ['btrfs', 'restore', '-t', root, '-Divv', '--path-regex', self.path_regex, self.device, '/dev/null']
-            if self.use_sudo:
-                command = ['sudo'] + command
-            
-            self.progress.emit(f"Executing command: {' '.join(command)}")
-            files = self.execute_command(command)
-            if files:
-                deleted_files.update(files)
-                successful_roots[root] = files
-
-        self.finished.emit(list(deleted_files), successful_roots)
-    def find_roots(self):
-        find_root_command = ['btrfs-find-root', self.device]
-        if self.use_sudo:
-            find_root_command = ['sudo'] + find_root_command
-        
-        self.progress.emit(f"Finding roots: {' '.join(find_root_command)}")
-        process = subprocess.Popen(find_root_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-        roots = []
-        for line in process.stdout:
-            if "Well block" in line:
-                root = re.search(r'Well block (\d+)', line)
-                if root:
-                    roots.append(root.group(1))
-        return roots
-
-    def execute_command(self, command):
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-        deleted_files = set()
-        for line in process.stdout:
-            self.progress.emit(line.strip())
-            if line.startswith("Restoring"):
-                parts = line.split()
-                if len(parts) >= 2:
-                    path = parts[1].replace('/dev/null/', '')
-                    deleted_files.add(path)
-        
-        process.wait()
-        return deleted_files
+    def __init__(self, device, staging, results, paths, **options):
+        super().__init__()
+        self.collector = VersionCollector(device, staging, results, paths, **options)
+        self.collector.on_progress = self.progress.emit
+        self.collector.on_stage_progress = self.stage_progress.emit
+
+    def run(self):
+        try:
+            found = self.collector.run()
+        except Exception as e:
+            self.progress.emit(f"Error: {str(e)}")
+            found = ({}, {})
+        self.finished.emit(found)
+
+
+class BtrfsRestoreWorker(QThread):
+    finished = pyqtSignal(int)
+    progress = pyqtSignal(str)
+    # restored files, selected files
+    restore_progress = pyqtSignal(int, int)
+
+    def __init__(self, device, destination, file_roots, **options):
+        super().__init__()
+        self.engine = RestoreEngine(device, destination, file_roots, **options)
+        self.engine.on_progress = self.progress.emit
+        self.engine.on_restore_progress = self.restore_progress.emit
+        self.skipped = 0
+        self.failed = []
+
+    def run(self):
+        try:
+            restored = self.engine.run()
+        except Exception as e:
+            self.progress.emit(f"Error: {str(e)}")
+            restored = 0
+        self.skipped = self.engine.skipped
+        self.failed = self.engine.failed
+        self.finished.emit(restored)
+
+
+class DaemonRestoreWorker(BtrfsRestoreWorker):
+    # BtrfsRestoreWorker for files of a scan the recovery daemon holds
+    def __init__(self, restore_params, log_channel):
+        QThread.__init__(self)
+        self.restore_params = restore_params
+        self.log_channel = log_channel
+        self.skipped = 0
+        self.failed = []
+
+    def handle_event(self, event):
+        if event['event'] == 'progress':
+            self.progress.emit(event['message'])
+        elif event['event'] == 'restore':
+            self.restore_progress.emit(event['restored'], event['total'])
+        elif event['event'] == 'log':
+            for line in event['lines']:
+                self.log_channel.append(line)
+
+    def run(self):
+        restored = 0
+        try:
+            with DaemonClient() as client:
+                task = client.call('restore', **self.restore_params)
+                finished = client.subscribe(task['task'], self.handle_event, log=True)
+            if finished['state'] == 'failed':
+                raise RecoveryError(finished['error'])
+            result = finished['result']
+            restored = result['restored']
+            self.skipped = result['skipped']
+            self.failed = result['failed']
+        except Exception as e:
+            self.progress.emit(f"Error: {str(e)}")
+        self.finished.emit(restored)
 
 
 class ColorScheme:
@@ -135,14 +365,14 @@ class ColorScheme:
             QPushButton:pressed {{ 
                 background-color: {self.accent.darker(110).name()}; 
             }}
-            QLineEdit, QTextEdit, QComboBox {{ 
+            QLineEdit, QPlainTextEdit, QComboBox {{ 
                 background-color: {self.secondary_background.name()}; 
                 border: 1px solid {self.border.name()}; 
                 padding: 5px; 
                 border-radius: 4px;
                 color: {self.text.name()};
             }}
-            QTableWidget {{ 
+            QTableView {{ 
                 background-color: {self.secondary_background.name()}; 
                 border: 1px solid {self.border.name()}; 
                 gridline-color: {self.border.name()};
@@ -163,6 +393,93 @@ class ColorScheme:
             }}
         """)
 
+class DeletedFilesModel(QAbstractTableModel):
+    # Rows are handed to the view in batches as it scrolls, so huge listings stay
+    # responsive. Size, date and generation come from the btrfs metadata the list worker
+    # read, never from the host filesystem. Pattern is the target of a multi-pattern
+    # search that matched the file.
+    FETCH_BATCH = 5000
+    HEADERS = ["File Name", "Size", "Date", "Generation", "Pattern"]
+    PATTERN_COLUMN = 4
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.files = []
+        self.loaded = 0
+        self.info = {}
+        self.patterns = None
+
+    def set_patterns(self, patterns):
+        self.patterns = patterns
+
+    def set_metadata(self, metadata):
+        self.info = metadata
+        if self.loaded:
+            self.dataChanged.emit(self.index(0, 1), self.index(self.loaded - 1, len(self.HEADERS) - 1))
+
+    def set_files(self, files):
+        self.beginResetModel()
+        self.files = list(files)
+        self.loaded = min(len(self.files), self.FETCH_BATCH)
+        self.endResetModel()
+
+    def append_files(self, files):
+        self.files.extend(files)
+        if self.loaded < self.FETCH_BATCH:
+            self.fetchMore(QModelIndex())
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.loaded
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.loaded < len(self.files)
+
+    def fetchMore(self, parent=QModelIndex()):
+        count = min(self.FETCH_BATCH, len(self.files) - self.loaded)
+        if parent.isValid() or count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.loaded, self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        path = self.files[index.row()]
+        if index.column() == 0:
+            return display_path(path)
+        if index.column() == self.PATTERN_COLUMN:
+            return self.patterns.tag(path) if self.patterns else None
+        size, mtime, generation = self.info.get(path, (None, None, None))
+        if index.column() == 1:
+            return "Unknown" if size is None else str(size)
+        if index.column() == 2:
+            return "Unknown" if mtime is None else datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+        return "Unknown" if generation is None else str(generation)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        # One precomputed key per row, taken from the metadata already in memory
+        unknown = (None, None, None)
+        if column == 0:
+            key = None
+        elif column == self.PATTERN_COLUMN:
+            key = lambda path: (self.patterns.tag(path) if self.patterns else None) or ''
+        else:
+            key = lambda path: self.info.get(path, unknown)[column - 1] or 0
+        self.beginResetModel()
+        self.files.sort(key=key, reverse=order == Qt.DescendingOrder)
+        self.loaded = min(len(self.files), max(self.loaded, self.FETCH_BATCH))
+        self.endResetModel()
+
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -176,14 +493,14 @@ class MainWindow(QMainWindow):
         self.faq_button = QPushButton("FAQ")
         self.faq_button.clicked.connect(self.show_faq)
         layout.addWidget(self.faq_button)
-        self.successful_roots = {}
+        self.successful_roots = ScanResults()
 
         # BTRFS partition selection
         partition_layout = QHBoxLayout()
         self.partition_combo = QComboBox()
         self.partition_combo.currentIndexChanged.connect(self.on_partition_selected)
         refresh_button = QPushButton("Refresh")
-        refresh_button.clicked.connect(self.refresh_partitions)
+        refresh_button.clicked.connect(lambda: self.refresh_partitions(force=True))
         unmount_button = QPushButton("Unmount")
         unmount_button.clicked.connect(self.unmount_selected)
         partition_layout.addWidget(QLabel("BTRFS Partitions:"))
@@ -198,6 +515,10 @@ class MainWindow(QMainWindow):
         self.depth_combo = QComboBox()
         self.depth_combo.addItems(["Basic", "Advanced", "Deep"])
         depth_layout.addWidget(self.depth_combo)
+        depth_layout.addWidget(QLabel("Newer than generation:"))
+        self.min_generation_input = QLineEdit()
+        self.min_generation_input.setPlaceholderText("any")
+        depth_layout.addWidget(self.min_generation_input)
         layout.addLayout(depth_layout)
 
         # Add regex type selection
@@ -213,7 +534,7 @@ class MainWindow(QMainWindow):
         regex_input_layout = QHBoxLayout()
         regex_input_layout.addWidget(QLabel("Path/Filename:"))
         self.regex_input = QLineEdit()
-        self.regex_input.setPlaceholderText("Enter path or filename")
+        self.regex_input.setPlaceholderText("Enter path or filename; separate several patterns with ;")
         regex_input_layout.addWidget(self.regex_input)
         layout.addLayout(regex_input_layout)
 
@@ -228,6 +549,21 @@ class MainWindow(QMainWindow):
         device_layout.addWidget(device_button)
         layout.addLayout(device_layout)
 
+        # Optional local copy of the device's metadata; listings read it instead of the
+        # device, restores still read the device
+        image_layout = QHBoxLayout()
+        image_layout.addWidget(QLabel("Metadata image:"))
+        self.image_input = QLineEdit()
+        self.image_input.setPlaceholderText("Leave blank to scan the device directly")
+        image_layout.addWidget(self.image_input)
+        image_button = QPushButton("Browse")
+        image_button.clicked.connect(self.browse_image)
+        image_layout.addWidget(image_button)
+        self.capture_button = QPushButton("Capture")
+        self.capture_button.clicked.connect(self.capture_image)
+        image_layout.addWidget(self.capture_button)
+        layout.addLayout(image_layout)
+
         # Destination input
         dest_layout = QHBoxLayout()
         dest_label = QLabel("Destination:")
@@ -243,6 +579,60 @@ class MainWindow(QMainWindow):
         self.sudo_checkbox = QCheckBox("Use sudo")
         layout.addWidget(self.sudo_checkbox)
 
+        # Scan cache checkbox
+        self.cache_checkbox = QCheckBox("Reuse cached scan results")
+        self.cache_checkbox.setChecked(True)
+        layout.addWidget(self.cache_checkbox)
+
+        # Listings and restores go to the recovery daemon when one is running
+        self.daemon_checkbox = QCheckBox("Use the recovery daemon")
+        self.daemon_checkbox.setToolTip("Start it with: sudo python -m btrfs_restore_cli daemon")
+        self.daemon_checkbox.setChecked(daemon_available())
+        layout.addWidget(self.daemon_checkbox)
+        self.daemon_scan = None
+
+        # Number of roots scanned concurrently
+        workers_layout = QHBoxLayout()
+        workers_layout.addWidget(QLabel("Parallel Scans:"))
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, 64)
+        self.workers_spin.setValue(os.cpu_count() or 1)
+        workers_layout.addWidget(self.workers_spin)
+        self.scan_status = QLabel("")
+        workers_layout.addWidget(self.scan_status)
+        layout.addLayout(workers_layout)
+
+        # Limits that bound how long a listing can take
+        limits_layout = QHBoxLayout()
+        limits_layout.addWidget(QLabel("Time limit per root (s):"))
+        self.root_timeout_spin = QSpinBox()
+        self.root_timeout_spin.setRange(0, 86400)
+        self.root_timeout_spin.setSpecialValueText("none")
+        limits_layout.addWidget(self.root_timeout_spin)
+        limits_layout.addWidget(QLabel("Stop after files found:"))
+        self.max_matches_spin = QSpinBox()
+        self.max_matches_spin.setRange(0, 10000000)
+        self.max_matches_spin.setSpecialValueText("no limit")
+        limits_layout.addWidget(self.max_matches_spin)
+        layout.addLayout(limits_layout)
+
+        # Restore job options: a journal to resume from, and read limits for fragile disks
+        restore_options_layout = QHBoxLayout()
+        self.journal_checkbox = QCheckBox("Resume interrupted restores")
+        self.journal_checkbox.setChecked(True)
+        restore_options_layout.addWidget(self.journal_checkbox)
+        restore_options_layout.addWidget(QLabel("Read limit (MiB/s):"))
+        self.read_limit_spin = QSpinBox()
+        self.read_limit_spin.setRange(0, 100000)
+        self.read_limit_spin.setSpecialValueText("none")
+        restore_options_layout.addWidget(self.read_limit_spin)
+        restore_options_layout.addWidget(QLabel("Files per second:"))
+        self.files_limit_spin = QSpinBox()
+        self.files_limit_spin.setRange(0, 100000)
+        self.files_limit_spin.setSpecialValueText("no limit")
+        restore_options_layout.addWidget(self.files_limit_spin)
+        layout.addLayout(restore_options_layout)
+
         # List and Restore buttons
         button_layout = QHBoxLayout()
         self.list_button = QPushButton("List Deleted Files")
@@ -250,7 +640,24 @@ class MainWindow(QMainWindow):
         self.restore_button = QPushButton("Restore Selected Files")
         self.restore_button.clicked.connect(self.start_restore)
         self.restore_button.setEnabled(False)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_listing)
+        self.cancel_button.setEnabled(False)
+        self.versions_button = QPushButton("Compare Versions")
+        self.versions_button.clicked.connect(self.start_versions)
+        self.versions_button.setEnabled(False)
+        # A finished listing can be saved, and opened again later instead of rescanning
+        self.open_scan_button = QPushButton("Open Scan...")
+        self.open_scan_button.clicked.connect(self.open_scan)
+        self.save_scan_button = QPushButton("Save Scan...")
+        self.save_scan_button.clicked.connect(self.save_scan)
+        self.save_scan_button.setEnabled(False)
+        self.scan_settings = None
         button_layout.addWidget(self.list_button)
+        button_layout.addWidget(self.cancel_button)
+        button_layout.addWidget(self.open_scan_button)
+        button_layout.addWidget(self.save_scan_button)
+        button_layout.addWidget(self.versions_button)
         button_layout.addWidget(self.restore_button)
         layout.addLayout(button_layout)
 
@@ -258,34 +665,94 @@ class MainWindow(QMainWindow):
         sort_layout = QHBoxLayout()
         sort_label = QLabel("Sort by:")
         self.sort_combo = QComboBox()
-        self.sort_combo.addItems(["Name", "Size", "Date"])
+        self.sort_combo.addItems(["Name", "Size", "Date", "Pattern"])
         self.sort_combo.currentIndexChanged.connect(self.sort_files)
         sort_layout.addWidget(sort_label)
         sort_layout.addWidget(self.sort_combo)
         layout.addLayout(sort_layout)
 
+        # Filtering the finished listing in memory; see btrfs_index.py for the syntax
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(QLabel("Filter:"))
+        self.filter_input = QLineEdit()
+        self.filter_input.setPlaceholderText("Part of the path, a glob such as *.sql, or an extension such as .jpg")
+        self.filter_input.setEnabled(False)
+        self.filter_input.textChanged.connect(self.schedule_filter)
+        filter_layout.addWidget(self.filter_input)
+        self.filter_status = QLabel("")
+        filter_layout.addWidget(self.filter_status)
+        layout.addLayout(filter_layout)
+        # Waits for a pause in typing instead of filtering on every key
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(150)
+        self.filter_timer.timeout.connect(self.apply_filter)
+        self.path_index = None
+        self.current_directory = ''
+
         # File list table
-        self.file_table = QTableWidget()
-        self.file_table.setColumnCount(3)
-        self.file_table.setHorizontalHeaderLabels(["File Name", "Size", "Date"])
+        self.file_model = DeletedFilesModel(self)
+        self.file_table = QTableView()
+        self.file_table.setModel(self.file_model)
         self.file_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        self.file_table.setSelectionBehavior(QTableWidget.SelectRows)
-        self.file_table.setSelectionMode(QTableWidget.MultiSelection)
-        layout.addWidget(self.file_table)
+        # Fixed row heights so the view never measures rows it doesn't paint
+        self.file_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.file_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.file_table.setSelectionMode(QAbstractItemView.MultiSelection)
+
+        # Directory tree of the listing; items are filled in when expanded
+        self.directory_tree = QTreeWidget()
+        self.directory_tree.setHeaderLabels(["Directory", "Files", "Size"])
+        self.directory_tree.setEnabled(False)
+        self.directory_tree.itemExpanded.connect(self.expand_directory)
+        self.directory_tree.currentItemChanged.connect(self.select_directory)
+        splitter = QSplitter(Qt.Horizontal)
+        splitter.addWidget(self.directory_tree)
+        splitter.addWidget(self.file_table)
+        splitter.setStretchFactor(1, 3)
+        layout.addWidget(splitter)
 
         # Output area
-        self.output_area = QTextEdit()
+        self.output_area = QPlainTextEdit()
         self.output_area.setReadOnly(True)
+        self.output_area.setMaximumBlockCount(LOG_MAX_BLOCKS)
         layout.addWidget(self.output_area)
+        log_buttons = QHBoxLayout()
+        save_log_button = QPushButton("Save Full Log")
+        save_log_button.clicked.connect(self.save_log)
+        log_buttons.addWidget(save_log_button)
+        stats_button = QPushButton("Performance Stats")
+        stats_button.clicked.connect(self.show_stats)
+        log_buttons.addWidget(stats_button)
+        jobs_button = QPushButton("Job Queue")
+        jobs_button.clicked.connect(self.show_job_queue)
+        log_buttons.addWidget(jobs_button)
+        layout.addLayout(log_buttons)
+        self.log_channel = LogChannel()
+        self.tracer = Tracer()
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.log_timer.start(int(LOG_FLUSH_INTERVAL * 1000))
 
-        self.deleted_files = []
-        self.refresh_partitions()
         self.mode_toggle = QPushButton("Switch to Light Mode")
         self.mode_toggle.clicked.connect(self.toggle_mode)
         layout.addWidget(self.mode_toggle)
 
         self.deleted_files = []
+        # Opened with the Job Queue window and kept running when it is closed
+        self.job_queue = None
+        self.job_dialog = None
+        # Partitions found last time are shown right away and rediscovered in the
+        # background; the timer notices devices coming and going
+        self.device_cache = DeviceCache()
+        self.device_worker = None
+        self.device_fingerprint = self.device_cache.fingerprint
+        if self.device_cache.devices:
+            self.show_partitions(self.device_cache.devices)
         self.refresh_partitions()
+        self.device_timer = QTimer(self)
+        self.device_timer.timeout.connect(self.check_devices)
+        self.device_timer.start(DEVICE_CHECK_INTERVAL)
 
     def toggle_mode(self):
         self.color_scheme.dark_mode = not self.color_scheme.dark_mode
@@ -295,10 +762,10 @@ class MainWindow(QMainWindow):
 
     def update_regex_hint(self, index):
         hints = [
-            "Enter filename (e.g., important.txt)",
-            "Enter directory name (e.g., documents)",
-            "Enter file extension (e.g., jpg)",
-            "Enter directory/filename (e.g., work/report.pdf)",
+            "Enter filename (e.g., important.txt; more.txt; dir:documents)",
+            "Enter directory name (e.g., documents; ext:pdf)",
+            "Enter file extension (e.g., jpg; png; dir:photos)",
+            "Enter directory/filename (e.g., work/report.pdf; ext:sql)",
             "Leave blank to recover everything"
         ]
         self.regex_input.setPlaceholderText(hints[index])
@@ -309,66 +776,106 @@ class MainWindow(QMainWindow):
         if device_path:
             self.device_input.setText(device_path)
 
+    def browse_image(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Metadata Image", "btrfs-metadata.img",
+                                              options=QFileDialog.DontConfirmOverwrite)
+        if path:
+            self.image_input.setText(path)
+
+    def capture_image(self):
+        device = self.device_input.text()
+        path = self.image_input.text().strip()
+        error = check_device(device)
+        if error:
+            self.log(error)
+            return
+        if not path:
+            self.log("Choose where to save the metadata image first.")
+            return
+        self.capture_button.setEnabled(False)
+        self.list_button.setEnabled(False)
+        self.log(f"Capturing the metadata of {device} to {path}")
+        self.capture_worker = MetadataCaptureWorker(device, path, self.sudo_checkbox.isChecked(), self.tracer)
+        self.capture_worker.progress.connect(self.update_progress)
+        self.capture_worker.capture_progress.connect(self.update_capture_progress)
+        self.capture_worker.finished.connect(self.capture_finished)
+        self.capture_worker.start()
+
+    def update_capture_progress(self, copied, total):
+        if total:
+            self.scan_status.setText(f"Metadata captured: {copied // (1024 * 1024)}/{total // (1024 * 1024)} MiB")
+
+    def capture_finished(self, result):
+        self.capture_button.setEnabled(True)
+        self.list_button.setEnabled(True)
+        if result is None:
+            return
+        self.log(f"Captured {result['bytes']} bytes of metadata ({result['method']}); "
+                 "listings now read the image instead of the device")
+        if result['unreadable_bytes']:
+            self.log(f"Warning: {result['unreadable_bytes']} bytes of metadata could not be read")
+        if result.get('warning'):
+            self.log(result['warning'])
+
     def browse_destination(self):
         destination = QFileDialog.getExistingDirectory(self, "Select Destination")
         if destination:
             self.dest_input.setText(destination)
 
-    def list_btrfs_partitions(self):
-        try:
-            result = subprocess.run(['sudo', 'btrfs', 'filesystem', 'show'], capture_output=True, text=True)
-            
-            partitions = []
-            current_uuid = None
-            current_label = None
-            for line in result.stdout.split('\n'):
-                if line.startswith('Label:'):
-                    parts = line.split()
-                    current_label = parts[1].strip("'")
-                    current_uuid = parts[-1]
-                elif line.strip().startswith('devid'):
-                    parts = line.split()
-                    device = parts[-1]
-                    if current_uuid and device:
-                        partition_info = f"{device} (UUID: {current_uuid}, Label: {current_label})"
-                        partitions.append(partition_info)
-                    current_uuid = None
-                    current_label = None
-            
-            return partitions
-        except Exception as e:
-            self.output_area.append(f"Error listing BTRFS partitions: {str(e)}")
-            return []
+    def refresh_partitions(self, force=False):
+        if self.device_worker and self.device_worker.isRunning():
+            return
+        self.device_worker = DeviceDiscoveryWorker(self.device_cache, force)
+        self.device_worker.progress.connect(self.update_progress)
+        self.device_worker.finished.connect(self.update_partitions)
+        self.device_worker.start()
+
+    def check_devices(self):
+        fingerprint = device_fingerprint()
+        if fingerprint != self.device_fingerprint:
+            self.device_fingerprint = fingerprint
+            self.refresh_partitions()
 
-    def refresh_partitions(self):
-        partitions = self.list_btrfs_partitions()
+    def update_partitions(self, devices):
+        self.device_fingerprint = self.device_cache.fingerprint
+        if devices:
+            self.show_partitions(devices)
+            self.log("Partitions refreshed successfully.")
+        else:
+            self.partition_combo.clear()
+            self.log("No BTRFS partitions found or an error occurred.")
+
+    def show_partitions(self, devices):
+        partitions = [f"{device} (UUID: {uuid}, Label: {label})" for device, uuid, label in devices]
+        current = self.device_input.text()
+        # Repopulating mustn't replace a device the user already picked or typed
+        self.partition_combo.blockSignals(True)
         self.partition_combo.clear()
-        if partitions:
-            self.partition_combo.addItems(partitions)
-            self.output_area.append("Partitions refreshed successfully.")
+        self.partition_combo.addItems(partitions)
+        names = [device for device, _, _ in devices]
+        self.partition_combo.setCurrentIndex(names.index(current) if current in names else 0)
+        self.partition_combo.blockSignals(False)
+        if not current:
             # Set the device input to the first partition
-            first_partition = partitions[0].split()[0]
-            self.device_input.setText(first_partition)
-        else:
-            self.output_area.append("No BTRFS partitions found or an error occurred.")
+            self.device_input.setText(names[0])
 
     def on_partition_selected(self, index):
         selected = self.partition_combo.currentText()
         if selected:
             device = selected.split()[0]
             self.device_input.setText(device)
-            self.output_area.append(f"Selected partition: {selected}")
+            self.log(f"Selected partition: {selected}")
         else:
-            self.output_area.append("No partition selected")
+            self.log("No partition selected")
 
     def unmount_partition(self, device):
         try:
-            subprocess.run(['sudo', 'umount', device], check=True)
-            self.output_area.append(f"Successfully unmounted {device}")
-        except subprocess.CalledProcessError:
-            self.output_area.append(f"Failed to unmount {device}. It might not be mounted.")
+            if unmount_device(device):
+                self.log(f"Successfully unmounted {device}")
+            else:
+                self.log(f"Failed to unmount {device}. It might not be mounted.")
         except Exception as e:
-            self.output_area.append(f"Error unmounting {device}: {str(e)}")
+            self.log(f"Error unmounting {device}: {str(e)}")
 
     def unmount_selected(self):
         selected = self.partition_combo.currentText()
@@ -377,135 +884,404 @@ class MainWindow(QMainWindow):
             self.unmount_partition(device)
             self.refresh_partitions()
         else:
-            self.output_area.append("No partition selected")
+            self.log("No partition selected")
 
     def list_deleted_files(self):
         device = self.device_input.text()
-        destination = self.dest_input.text() or '/tmp/btrfs_recovery'
-        if not device:
-            self.output_area.append("Please select a BTRFS device or partition.")
-            return
-        
-        if not os.path.exists(device):
-            self.output_area.append(f"Error: Device '{device}' does not exist.")
-            return
-        
-        if not os.path.isfile(device) and not stat.S_ISBLK(os.stat(device).st_mode):
-            self.output_area.append(f"Error: '{device}' is not a block device or regular file.")
+        destination = self.dest_input.text() or DEFAULT_DESTINATION
+        metadata_image = self.image_input.text().strip() or None
+        # A listing from a metadata image doesn't need the device itself, e.g. when the
+        # image was brought to another machine
+        error = check_device(metadata_image or device)
+        if error:
+            self.log(error)
             return
 
-        # Try to unmount the partition
-        try:
-            subprocess.run(['sudo', 'umount', device], check=True)
-            self.output_area.append(f"Successfully unmounted {device}")
-        except subprocess.CalledProcessError:
-            self.output_area.append(f"Note: {device} was not mounted or couldn't be unmounted.")
+        use_daemon = self.daemon_checkbox.isChecked()
+        # Try to unmount the partition; a listing from an image leaves it alone, and the
+        # daemon unmounts it itself
+        if not metadata_image and not use_daemon:
+            if unmount_device(device):
+                self.log(f"Successfully unmounted {device}")
+            else:
+                self.log(f"Note: {device} was not mounted or couldn't be unmounted.")
 
         self.list_button.setEnabled(False)
-        self.output_area.clear()
-        self.output_area.append("Starting file recovery...")
+        self.clear_log()
+        self.tracer.clear()
+        self.log("Starting file recovery...")
 
-        regex_type = self.regex_type.currentIndex()
-        user_input = self.regex_input.text()
+        patterns = PathPatterns.parse(self.regex_input.text(), RECOVERY_TYPES[self.regex_type.currentIndex()])
+        path_regex = patterns.path_regex
 
-        if regex_type == 0:  # Specific File
-            path_regex = f"/{user_input}"
-        elif regex_type == 1:  # Specific Directory
-            path_regex = f"/{user_input}/."
-        elif regex_type == 2:  # File Extension
-            path_regex = f"/.*\\.{user_input}"
-        elif regex_type == 3:  # File in Directory
-            path_regex = f"/{user_input}"
-        else:  # Everything
-            path_regex = "/."
+        if len(patterns) > 1:
+            self.log(f"Listing {len(patterns)} patterns in one scan: {', '.join(patterns.labels())}")
+        self.log(f"Using path regex: {path_regex}")
 
-        self.output_area.append(f"Using path regex: {path_regex}")
+        min_generation = self.min_generation_input.text().strip()
+        if min_generation and not min_generation.isdigit():
+            self.log(f"Error: '{min_generation}' is not a valid generation number.")
+            self.list_button.setEnabled(True)
+            return
 
-        self.worker = BtrfsListWorker(device, self.sudo_checkbox.isChecked(), path_regex, destination)
+        self.daemon_scan = None
+        self.save_scan_button.setEnabled(False)
+        # What a saved scan records about how it was made, see btrfs_export.scan_info()
+        self.scan_settings = {'device': os.path.abspath(device), 'use_sudo': self.sudo_checkbox.isChecked(),
+                              'metadata_image': metadata_image and os.path.abspath(metadata_image),
+                              'pattern': self.regex_input.text(),
+                              'type': RECOVERY_TYPES[self.regex_type.currentIndex()],
+                              'depth': self.depth_combo.currentText(),
+                              'min_generation': int(min_generation) if min_generation else None}
+        if use_daemon:
+            self.worker = DaemonListWorker({'device': os.path.abspath(device), 'pattern': self.regex_input.text(),
+                                            'type': RECOVERY_TYPES[self.regex_type.currentIndex()],
+                                            'depth': self.depth_combo.currentText(),
+                                            'min_generation': int(min_generation) if min_generation else None,
+                                            'metadata_image': metadata_image and os.path.abspath(metadata_image),
+                                            'root_timeout': self.root_timeout_spin.value() or None,
+                                            'max_matches': self.max_matches_spin.value() or None,
+                                            'use_cache': self.cache_checkbox.isChecked(),
+                                            'unmount': not metadata_image},
+                                           self.log_channel, self.tracer)
+        else:
+            self.worker = BtrfsListWorker(device, self.sudo_checkbox.isChecked(), path_regex, destination,
+                                          max_workers=self.workers_spin.value(),
+                                          depth=self.depth_combo.currentText(),
+                                          use_cache=self.cache_checkbox.isChecked(),
+                                          log_channel=self.log_channel,
+                                          min_generation=int(min_generation) if min_generation else None,
+                                          tracer=self.tracer,
+                                          root_timeout=self.root_timeout_spin.value() or None,
+                                          max_matches=self.max_matches_spin.value() or None,
+                                          metadata_image=metadata_image)
         self.worker.progress.connect(self.update_progress)
+        self.worker.root_progress.connect(self.update_root_progress)
+        self.worker.stats.connect(self.update_scan_stats)
+        self.worker.files_found.connect(self.append_found_files)
+        self.worker.metadata_found.connect(self.file_model.set_metadata)
+        self.worker.index_ready.connect(self.set_path_index)
         self.worker.finished.connect(self.update_file_list)
+        self.deleted_files = []
+        self.file_model.set_files([])
+        self.file_model.set_metadata({})
+        self.file_model.set_patterns(patterns)
+        self.set_path_index(None)
+        self.cancel_button.setEnabled(True)
         self.worker.start()
 
+    def cancel_listing(self):
+        self.cancel_button.setEnabled(False)
+        self.log("Cancelling, waiting for running scans to stop...")
+        self.worker.cancel()
+
     def update_progress(self, message):
-        self.output_area.append(message)
+        self.log(message)
+
+    def update_root_progress(self, done, total, root, elapsed):
+        self.scan_status.setText(f"Roots scanned: {done}/{total}")
+
+    def update_scan_stats(self, stats):
+        timed_out = f", {stats['roots_timed_out']} over time limit" if stats['roots_timed_out'] else ""
+        self.scan_status.setText(f"Roots scanned: {stats['roots_done']}/{stats['roots_total']} "
+                                 f"({stats['roots_skipped']} duplicates skipped{timed_out}), "
+                                 f"{stats['files_matched']} files, {stats['lines_per_sec']:.0f} lines/s")
+
+    def log(self, message):
+        self.log_channel.append(message)
+
+    def clear_log(self):
+        self.log_channel.clear()
+        self.output_area.clear()
+
+    def flush_log(self):
+        lines, skipped = self.log_channel.drain()
+        if not (lines or skipped):
+            return
+        with self.tracer.span('flush log', 'gui', lines=len(lines)):
+            if skipped:
+                self.output_area.appendPlainText(f"[{skipped} lines not shown, use Save Full Log for the complete output]")
+            if lines:
+                self.output_area.appendPlainText(display_path('\n'.join(lines)))
+
+    def save_log(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Save Full Log", "btrfs-recovery.log")
+        if path:
+            try:
+                self.log_channel.save(path)
+                self.log(f"Log saved to {path}")
+            except OSError as e:
+                self.log(f"Error saving log: {str(e)}")
+
+    def append_found_files(self, files):
+        with self.tracer.span('append rows', 'gui', rows=len(files)):
+            self.deleted_files.extend(files)
+            self.file_model.append_files(files)
 
     def update_file_list(self, files, successful_roots):
         self.deleted_files = files
         self.successful_roots = successful_roots
+        # Restores of a daemon listing are done by the daemon too
+        self.daemon_scan = getattr(self.worker, 'task', None)
         self.populate_table()
+        self.cancel_button.setEnabled(False)
+        self.list_button.setEnabled(True)
+        self.restore_button.setEnabled(True)
+        self.versions_button.setEnabled(True)
+        self.save_scan_button.setEnabled(True)
+
+    def save_scan(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Save Scan", "btrfs-scan.sqlite",
+                                              "Saved scans (*.sqlite *.db);;NDJSON (*.ndjson *.jsonl);;All Files (*)")
+        if not path:
+            return
+        self.save_scan_button.setEnabled(False)
+        self.log(f"Saving {len(self.successful_roots)} files to {path}...")
+        self.save_worker = ScanSaveWorker(path, self.successful_roots, self.file_model.info, self.scan_settings,
+                                          self.tracer)
+        self.save_worker.finished.connect(lambda error: self.scan_saved(path, error))
+        self.save_worker.start()
+
+    def scan_saved(self, path, error):
+        self.save_scan_button.setEnabled(True)
+        self.log(f"Error saving the scan: {error}" if error else f"Scan saved to {path}")
+
+    def open_scan(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Open Scan", "",
+                                              "Saved scans (*.sqlite *.db *.ndjson *.jsonl);;All Files (*)")
+        if not path:
+            return
+        self.list_button.setEnabled(False)
+        self.open_scan_button.setEnabled(False)
+        self.clear_log()
+        self.log(f"Opening {path}...")
+        self.load_worker = ScanLoadWorker(path, self.sudo_checkbox.isChecked(), self.tracer)
+        self.load_worker.progress.connect(self.update_progress)
+        self.load_worker.index_ready.connect(self.set_path_index)
+        self.load_worker.finished.connect(self.scan_opened)
+        self.load_worker.start()
+
+    def scan_opened(self, loaded):
         self.list_button.setEnabled(True)
+        self.open_scan_button.setEnabled(True)
+        if loaded is None:
+            return
+        results, metadata, info = loaded
+        # Restores read the device the scan was saved from, with the patterns it was saved with
+        self.device_input.setText(info.get('device') or '')
+        self.image_input.setText(info.get('metadata_image') or '')
+        self.regex_input.setText(info.get('pattern') or '')
+        if info.get('type') in RECOVERY_TYPES:
+            self.regex_type.setCurrentIndex(RECOVERY_TYPES.index(info['type']))
+        self.scan_settings = {name: info.get(name) for name in ('device', 'metadata_image', 'pattern', 'type',
+                                                                'depth', 'min_generation')}
+        self.scan_settings['use_sudo'] = self.sudo_checkbox.isChecked()
+        self.file_model.set_patterns(PathPatterns.parse(info.get('pattern') or '', info.get('type') or 'everything'))
+        self.file_model.set_metadata(metadata)
+        self.deleted_files = list(results)
+        self.successful_roots = results
+        self.daemon_scan = None
+        self.populate_table()
+        self.log(f"Opened {len(results)} files from {len(results.root_names)} roots of {info.get('device')}")
         self.restore_button.setEnabled(True)
+        self.versions_button.setEnabled(True)
+        self.save_scan_button.setEnabled(True)
 
     def populate_table(self):
-        self.file_table.setRowCount(len(self.deleted_files))
-        for row, path in enumerate(self.deleted_files):
-            self.file_table.setItem(row, 0, QTableWidgetItem(path))
-            # Get file size and modification date if the file exists
-            if os.path.exists(path):
-                size = os.path.getsize(path)
-                date = datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d %H:%M:%S')
-            else:
-                size = "Unknown"
-                date = "Unknown"
-            self.file_table.setItem(row, 1, QTableWidgetItem(str(size)))
-            self.file_table.setItem(row, 2, QTableWidgetItem(date))
+        if self.path_index is not None and (self.filter_input.text() or self.current_directory):
+            self.apply_filter()
+            return
+        with self.tracer.span('populate table', 'gui', rows=len(self.deleted_files)):
+            self.file_model.set_files(self.deleted_files)
+        self.sort_files(self.sort_combo.currentIndex())
+
+    def set_path_index(self, index):
+        self.path_index = index
+        self.current_directory = ''
+        self.filter_status.setText("")
+        self.directory_tree.clear()
+        self.filter_input.setEnabled(index is not None)
+        self.directory_tree.setEnabled(index is not None)
+        if index is None:
+            return
+        files, size = index.directory_stats('')
+        top = self.add_directory_item(self.directory_tree, "All files", '', files, size)
+        # Already showing everything, so selecting the top item needn't filter
+        self.directory_tree.blockSignals(True)
+        self.directory_tree.setCurrentItem(top)
+        self.directory_tree.blockSignals(False)
+        top.setExpanded(True)
+
+    def add_directory_item(self, parent, name, directory, files, size):
+        item = QTreeWidgetItem(parent, [display_path(name), str(files), str(size)])
+        item.setData(0, Qt.UserRole, directory)
+        if files:
+            # Placeholder child, so the item can be expanded before its children exist
+            QTreeWidgetItem(item)
+        return item
+
+    def expand_directory(self, item):
+        if item.childCount() != 1 or item.child(0).data(0, Qt.UserRole) is not None:
+            return
+        item.takeChild(0)
+        directory = item.data(0, Qt.UserRole)
+        subdirectories, _ = self.path_index.children(directory)
+        prefix = directory + '/' if directory else ''
+        for name, files, size in subdirectories:
+            self.add_directory_item(item, name, prefix + name, files, size)
+
+    def select_directory(self, item, previous=None):
+        if item is None or self.path_index is None:
+            return
+        self.current_directory = item.data(0, Qt.UserRole) or ''
+        self.apply_filter()
+
+    def schedule_filter(self, text):
+        self.filter_timer.start()
+
+    def apply_filter(self):
+        if self.path_index is None:
+            return
+        query = self.filter_input.text()
+        with self.tracer.span('filter', 'gui', query=query, directory=self.current_directory) as span:
+            files = self.path_index.filter(query, self.current_directory)
+            span['rows'] = len(files)
+            self.file_model.set_files(files)
+        self.filter_status.setText(f"{len(files)} of {len(self.path_index)} files")
+        self.sort_files(self.sort_combo.currentIndex())
 
     def sort_files(self, index):
-        if index == 0:  # Name
-            self.deleted_files.sort()
-        elif index == 1:  # Size
-            self.deleted_files.sort(key=lambda x: os.path.getsize(x) if os.path.exists(x) else 0, reverse=True)
-        elif index == 2:  # Date
-            self.deleted_files.sort(key=lambda x: os.path.getmtime(x) if os.path.exists(x) else 0, reverse=True)
-        self.populate_table()
+        with self.tracer.span('sort table', 'gui', rows=len(self.file_model.files)):
+            if index == 0:  # Name
+                self.file_model.sort(0, Qt.AscendingOrder)
+            elif index == 1:  # Size
+                self.file_model.sort(1, Qt.DescendingOrder)
+            elif index == 2:  # Date
+                self.file_model.sort(2, Qt.DescendingOrder)
+            elif index == 3:  # Pattern
+                self.file_model.sort(DeletedFilesModel.PATTERN_COLUMN, Qt.AscendingOrder)
 
     def start_restore(self):
         device = self.device_input.text()
-        destination = self.dest_input.text() or '/tmp/btrfs_recovery'
-        selected_rows = set(index.row() for index in self.file_table.selectedIndexes())
-        selected_files = [self.deleted_files[row] for row in selected_rows]
+        destination = self.dest_input.text() or DEFAULT_DESTINATION
+        selected_rows = set(index.row() for index in self.file_table.selectionModel().selectedRows())
+        selected_files = [self.file_model.files[row] for row in selected_rows]
 
         if not (device and destination and selected_files):
-            self.output_area.append("Please fill in all fields and select files to restore.")
+            self.log("Please fill in all fields and select files to restore.")
             return
 
         self.restore_button.setEnabled(False)
-        self.output_area.clear()
-        self.output_area.append("Starting restoration process...")
-
-        # Ensure the destination directory exists
-        os.makedirs(destination, exist_ok=True)
+        self.clear_log()
+        self.log("Starting restoration process...")
 
+        file_roots = {}
         for file in selected_files:
             # Find the correct root for this file
             root = self.find_root_for_file(file)
             if not root:
-                self.output_area.append(f"Error: Could not find a valid root for {file}")
+                self.log(f"Error: Could not find a valid root for {file}")
                 continue
+            file_roots[file] = root
+
+        if self.daemon_scan:
+            self.restore_worker = DaemonRestoreWorker({'scan': self.daemon_scan, 'paths': list(file_roots),
+                                                       'destination': os.path.abspath(destination),
+                                                       'journal': self.journal_checkbox.isChecked(),
+                                                       'max_read_mib': self.read_limit_spin.value() or None,
+                                                       'max_files_per_sec': self.files_limit_spin.value() or None},
+                                                      self.log_channel)
+        else:
+            journal = RestoreJournal(default_journal_path(destination)) if self.journal_checkbox.isChecked() else None
+            sizes = {path: self.file_model.info.get(path, (None,))[0] for path in file_roots}
+            self.restore_worker = BtrfsRestoreWorker(device, destination, file_roots,
+                                                     use_sudo=self.sudo_checkbox.isChecked(),
+                                                     max_workers=self.workers_spin.value(),
+                                                     log_channel=self.log_channel, tracer=self.tracer,
+                                                     journal=journal, sizes=sizes,
+                                                     max_read_bytes=self.read_limit_spin.value() * 1024 * 1024 or None,
+                                                     max_files=self.files_limit_spin.value() or None)
+        self.restore_worker.progress.connect(self.update_progress)
+        self.restore_worker.restore_progress.connect(self.update_restore_progress)
+        self.restore_worker.finished.connect(self.restore_finished)
+        self.restore_worker.start()
+
+    def update_restore_progress(self, restored, total):
+        self.scan_status.setText(f"Files restored: {restored}/{total}")
+
+    def restore_finished(self, restored):
+        self.restore_button.setEnabled(True)
+        self.log(f"Restoration process completed: {restored} files restored.")
+        if self.restore_worker.skipped:
+            self.log(f"{self.restore_worker.skipped} files were already restored by an earlier run.")
+        if self.restore_worker.failed:
+            self.log(f"Warning: {len(self.restore_worker.failed)} files are missing or don't have the expected size.")
 
-            command = ['sudo', 'btrfs', 'restore', '-ivv', '-t', root, '--path-regex', f'/{re.escape(file)}$', device, destination]
-            
-            self.output_area.append(f"Executing command: {' '.join(command)}")
-            
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-            for line in process.stdout:
-                self.output_area.append(line.strip())
-            
-            process.wait()
+    def start_versions(self):
+        device = self.device_input.text()
+        destination = self.dest_input.text() or DEFAULT_DESTINATION
+        selected_rows = set(index.row() for index in self.file_table.selectionModel().selectedRows())
+        selected_files = [self.file_model.files[row] for row in selected_rows]
+        if not (device and selected_files):
+            self.log("Please select the files whose versions you want to compare.")
+            return
 
-        self.restore_button.setEnabled(True)
-        self.output_area.append("Restoration process completed.")
+        self.versions_button.setEnabled(False)
+        self.clear_log()
+        # Each root's copies go to their own directory here, next to the restored files
+        staging = os.path.join(destination, '.btrfs-versions')
+        self.log(f"Staging every version of {len(selected_files)} files in {staging}")
+        self.version_worker = VersionWorker(device, staging, self.successful_roots, selected_files,
+                                            use_sudo=self.sudo_checkbox.isChecked(),
+                                            max_workers=self.workers_spin.value(),
+                                            log_channel=self.log_channel, tracer=self.tracer)
+        self.version_worker.progress.connect(self.update_progress)
+        self.version_worker.stage_progress.connect(
+            lambda done, total: self.scan_status.setText(f"Version batches staged: {done}/{total}"))
+        self.version_worker.finished.connect(self.versions_finished)
+        self.version_worker.start()
+
+    def versions_finished(self, found):
+        self.versions_button.setEnabled(True)
+        versions, _ = found
+        if versions:
+            dialog = VersionsDialog(versions, self.dest_input.text() or DEFAULT_DESTINATION, self.log, self)
+            dialog.exec_()
 
     def find_root_for_file(self, file):
-        for root, files in self.successful_roots.items():
-            if file in files:
-                return root
-        return None
+        return self.successful_roots.root_for(file)
     
     def show_faq(self):
         faq_dialog = FAQDialog(self)
         faq_dialog.exec_()
 
+    def show_stats(self):
+        stats_dialog = StatsDialog(self.tracer, self)
+        stats_dialog.exec_()
+
+    def job_spec(self):
+        # The search settings above as JobQueue.add() arguments, or None if they aren't valid
+        min_generation = self.min_generation_input.text().strip()
+        if min_generation and not min_generation.isdigit():
+            self.log(f"Error: '{min_generation}' is not a valid generation number.")
+            return None
+        return {'pattern': self.regex_input.text(), 'recovery_type': RECOVERY_TYPES[self.regex_type.currentIndex()],
+                'depth': self.depth_combo.currentText(),
+                'min_generation': int(min_generation) if min_generation else None,
+                'use_sudo': self.sudo_checkbox.isChecked()}
+
+    def show_job_queue(self):
+        if self.job_queue is None:
+            try:
+                self.job_queue = JobQueue(tracer=self.tracer)
+            except RecoveryError as e:
+                self.log(str(e))
+                return
+        if self.job_dialog is None:
+            self.job_dialog = JobQueueDialog(self.job_queue, self)
+        self.job_dialog.show()
+        self.job_dialog.raise_()
+
 
 class FAQDialog(QDialog):
     def __init__(self, parent=None):
@@ -642,9 +1418,289 @@ class FAQDialog(QDialog):
         <p><em>Remember, while this tool aims to assist in file recovery, it's always best to maintain regular backups of important data to prevent loss.</em></p>
         """
 
-if __name__ == '__main__':
+
+class VersionsDialog(QDialog):
+    # Distinct versions of each file, newest first, with every root and generation that
+    # holds the same bytes
+    def __init__(self, versions, destination, log, parent=None):
+        super().__init__(parent)
+        self.destination = destination
+        self.log = log
+        self.setWindowTitle("CatNode BTRFS Recovery Tool - File Versions")
+        self.setGeometry(100, 100, 800, 450)
+
+        layout = QVBoxLayout()
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(["File / Version", "Size", "Generations", "Roots", "Content Hash"])
+        self.tree.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.versions = []
+        for path, found in sorted(versions.items()):
+            file_item = QTreeWidgetItem(self.tree, [display_path(path), "", "", "", f"{len(found)} distinct"])
+            for number, version in enumerate(found, 1):
+                generations = [generation for _, generation in version.roots]
+                item = QTreeWidgetItem(file_item, [f"Version {number}", str(version.size),
+                                                   ", ".join(str(generation) for generation in generations),
+                                                   str(len(version.roots)), version.digest])
+                item.setData(0, Qt.UserRole, len(self.versions))
+                self.versions.append((path, version))
+            file_item.setExpanded(True)
+        layout.addWidget(self.tree)
+
+        button_layout = QHBoxLayout()
+        restore_button = QPushButton("Restore Selected Versions")
+        restore_button.clicked.connect(self.restore_selected)
+        close_button = QPushButton("Close")
+        close_button.clicked.connect(self.close)
+        button_layout.addWidget(restore_button)
+        button_layout.addWidget(close_button)
+        layout.addLayout(button_layout)
+        self.setLayout(layout)
+
+    def restore_selected(self):
+        for item in self.tree.selectedItems():
+            number = item.data(0, Qt.UserRole)
+            if number is None:
+                continue
+            path, version = self.versions[number]
+            try:
+                target = restore_version(version, self.destination, path)
+                self.log(f"Restored version {version.digest[:12]} of {path} to {target}")
+            except OSError as e:
+                self.log(f"Error restoring {path}: {str(e)}")
+
+
+class JobQueueDialog(QDialog):
+    # Jobs over many devices or images with the main window's search settings; see
+    # btrfs_jobs.py. The table is refreshed on a timer while the window is open.
+    COLUMNS = ["ID", "Device", "Patterns", "Priority", "Stage", "State", "Roots", "Files", "Restored", "Status"]
+
+    def __init__(self, queue, main_window):
+        super().__init__(main_window)
+        self.queue = queue
+        self.main_window = main_window
+        self.setWindowTitle("CatNode BTRFS Recovery Tool - Job Queue")
+        self.setGeometry(100, 100, 1000, 450)
+
+        layout = QVBoxLayout()
+        add_layout = QHBoxLayout()
+        self.restore_checkbox = QCheckBox("Restore matches to the destination")
+        self.restore_checkbox.setChecked(True)
+        add_layout.addWidget(self.restore_checkbox)
+        add_current_button = QPushButton("Add Current Device")
+        add_current_button.clicked.connect(self.add_current)
+        add_layout.addWidget(add_current_button)
+        add_images_button = QPushButton("Add Images...")
+        add_images_button.clicked.connect(self.add_images)
+        add_layout.addWidget(add_images_button)
+        layout.addLayout(add_layout)
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        layout.addWidget(self.table)
+        self.summary_label = QLabel("")
+        layout.addWidget(self.summary_label)
+
+        limits_layout = QHBoxLayout()
+        limits_layout.addWidget(QLabel("Jobs at once:"))
+        self.max_jobs_spin = QSpinBox()
+        self.max_jobs_spin.setRange(1, 64)
+        self.max_jobs_spin.setValue(queue.max_jobs)
+        limits_layout.addWidget(self.max_jobs_spin)
+        limits_layout.addWidget(QLabel("Jobs per physical disk:"))
+        self.per_disk_spin = QSpinBox()
+        self.per_disk_spin.setRange(1, 64)
+        self.per_disk_spin.setValue(queue.per_disk)
+        limits_layout.addWidget(self.per_disk_spin)
+        layout.addLayout(limits_layout)
+
+        button_layout = QHBoxLayout()
+        self.start_button = QPushButton("Start")
+        self.start_button.clicked.connect(self.toggle_running)
+        raise_button = QPushButton("Raise Priority")
+        raise_button.clicked.connect(lambda: self.change_priority(1))
+        lower_button = QPushButton("Lower Priority")
+        lower_button.clicked.connect(lambda: self.change_priority(-1))
+        cancel_button = QPushButton("Cancel Job")
+        cancel_button.clicked.connect(lambda: self.change_job(self.queue.cancel))
+        retry_button = QPushButton("Retry")
+        retry_button.clicked.connect(lambda: self.change_job(self.queue.retry))
+        remove_button = QPushButton("Remove")
+        remove_button.clicked.connect(lambda: self.change_job(self.queue.remove))
+        close_button = QPushButton("Close")
+        close_button.clicked.connect(self.close)
+        for button in (self.start_button, raise_button, lower_button, cancel_button, retry_button, remove_button,
+                       close_button):
+            button_layout.addWidget(button)
+        if queue.read_only:
+            for button in (add_current_button, add_images_button, self.start_button, raise_button, lower_button,
+                           cancel_button, retry_button, remove_button):
+                button.setEnabled(False)
+            self.summary_label.setToolTip("Another process is running this queue")
+        layout.addLayout(button_layout)
+        self.setLayout(layout)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(JOB_REFRESH_INTERVAL)
+        self.refresh()
+
+    def add_job(self, device, metadata_image=None, subdirectory=None):
+        spec = self.main_window.job_spec()
+        if spec is None:
+            return
+        destination = None
+        if self.restore_checkbox.isChecked():
+            destination = self.main_window.dest_input.text() or DEFAULT_DESTINATION
+            if subdirectory:
+                destination = os.path.join(destination, subdirectory)
+        job = self.queue.add(os.path.abspath(device), metadata_image=metadata_image, destination=destination, **spec)
+        self.main_window.log(f"Added job {job.id} for {device}")
+
+    def add_current(self):
+        device = self.main_window.device_input.text()
+        if not device:
+            self.main_window.log("Please select a device or image first.")
+            return
+        self.add_job(device, self.main_window.image_input.text().strip() or None)
+        self.refresh()
+
+    def add_images(self):
+        paths, _ = QFileDialog.getOpenFileNames(self, "Select Devices or Images", filter="All Files (*)")
+        # Each restores into its own subdirectory of the destination
+        for path in paths:
+            self.add_job(path, subdirectory=os.path.basename(path))
+        self.refresh()
+
+    def selected_job(self):
+        rows = self.table.selectionModel().selectedRows()
+        if not rows:
+            return None
+        return int(self.table.item(rows[0].row(), 0).text())
+
+    def change_job(self, change):
+        job_id = self.selected_job()
+        if job_id is None:
+            return
+        try:
+            change(job_id)
+        except RecoveryError as e:
+            self.main_window.log(str(e))
+        self.refresh()
+
+    def change_priority(self, step):
+        job_id = self.selected_job()
+        if job_id is not None:
+            self.queue.set_priority(job_id, self.queue.job(job_id).priority + step)
+            self.refresh()
+
+    def toggle_running(self):
+        if self.queue.started:
+            self.queue.stop()
+        else:
+            self.queue.max_jobs = self.max_jobs_spin.value()
+            self.queue.per_disk = self.per_disk_spin.value()
+            self.queue.start()
+        self.refresh()
+
+    def refresh(self):
+        if self.queue.read_only:
+            self.queue.reload()
+        selected = self.selected_job()
+        jobs = self.queue.snapshot()
+        self.table.setRowCount(len(jobs))
+        for row, job in enumerate(jobs):
+            progress = job['progress']
+            restored = (f"{progress['restored']}/{progress['selected']}" if job['stage'] == RESTORE
+                        else "-" if job['destination'] else "list only")
+            status = job['error'] or (progress['message'] if job['state'] in (QUEUED, RUNNING) else "")
+            patterns = ", ".join(PathPatterns.parse(job['pattern'], job['recovery_type']).labels())
+            values = [str(job['id']), job['device'], patterns, str(job['priority']),
+                      job['stage'], job['state'], f"{progress['roots_done']}/{progress['roots_total']}",
+                      str(progress['files']), restored, status]
+            for column, value in enumerate(values):
+                item = self.table.item(row, column)
+                if item is None:
+                    self.table.setItem(row, column, QTableWidgetItem(value))
+                elif item.text() != value:
+                    item.setText(value)
+            if job['id'] == selected:
+                self.table.selectRow(row)
+        summary = self.queue.summary()
+        self.summary_label.setText(
+            f"{summary['running']} running, {summary['queued']} queued, {summary['done']} done, "
+            f"{summary['failed']} failed, {summary['cancelled']} cancelled - roots {summary['roots_done']}/"
+            f"{summary['roots_total']}, {summary['files']} files found, {summary['restored']}/"
+            f"{summary['selected']} restored"
+            + (" (read only: another process is running this queue)" if self.queue.read_only else ""))
+        self.start_button.setText("Stop" if self.queue.started else "Start")
+
+
+class StatsDialog(QDialog):
+    # Per-phase totals and the slowest spans of the last listing and restore
+    def __init__(self, tracer, parent=None):
+        super().__init__(parent)
+        self.tracer = tracer
+        self.setWindowTitle("CatNode BTRFS Recovery Tool - Performance Stats")
+        self.setGeometry(100, 100, 700, 450)
+
+        layout = QVBoxLayout()
+        self.content = QTextBrowser()
+        layout.addWidget(self.content)
+
+        button_layout = QHBoxLayout()
+        refresh_button = QPushButton("Refresh")
+        refresh_button.clicked.connect(self.refresh)
+        json_button = QPushButton("Export JSON")
+        json_button.clicked.connect(lambda: self.export('json'))
+        chrome_button = QPushButton("Export Chrome Trace")
+        chrome_button.clicked.connect(lambda: self.export('chrome'))
+        close_button = QPushButton("Close")
+        close_button.clicked.connect(self.close)
+        for button in (refresh_button, json_button, chrome_button, close_button):
+            button_layout.addWidget(button)
+        layout.addLayout(button_layout)
+
+        self.setLayout(layout)
+        self.refresh()
+
+    def refresh(self):
+        rows = []
+        for category, total in self.tracer.summary().items():
+            rows.append(f"<tr><td>{category}</td><td>{total['spans']}</td><td>{total['seconds']:.2f}s</td>"
+                        f"<td>{total['cpu_seconds']:.2f}s</td><td>{total['max_rss_kb'] / 1024:.1f} MiB</td>"
+                        f"<td>{total['read_bytes'] / 1048576:.1f} MiB</td><td>{total['lines']}</td></tr>")
+        slowest = []
+        for span in self.tracer.slowest():
+            slowest.append(f"<tr><td>{html.escape(span['name'])}</td><td>{span['category']}</td>"
+                           f"<td>{span['seconds']:.2f}s</td><td>{span['values'].get('lines', '')}</td></tr>")
+        self.content.setHtml(
+            "<h3>Phases</h3><table cellpadding='4'><tr><th>Phase</th><th>Spans</th><th>Wall</th><th>Child CPU</th>"
+            "<th>Max RSS</th><th>Device reads</th><th>Lines</th></tr>" + ''.join(rows) + "</table>"
+            "<h3>Slowest</h3><table cellpadding='4'><tr><th>Span</th><th>Phase</th><th>Wall</th><th>Lines</th></tr>"
+            + ''.join(slowest) + "</table>")
+
+    def export(self, fmt):
+        default = "btrfs-recovery-trace.json" if fmt == 'chrome' else "btrfs-recovery-stats.json"
+        path, _ = QFileDialog.getSaveFileName(self, "Export Stats", default)
+        if path:
+            try:
+                self.tracer.save(path, fmt)
+            except OSError as e:
+                self.content.append(f"Error exporting stats: {str(e)}")
+
+
+def main():
     app = QApplication(sys.argv)
     window = MainWindow()
     window.color_scheme.apply_to_app(app)
     window.show()   
-    sys.exit(app.exec_())
\ No newline at end of file
+    return app.exec_()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
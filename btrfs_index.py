@@ -0,0 +1,165 @@
+import bisect
+import re
+from array import array
+from itertools import accumulate
+
+# In-memory index over one listing, so narrowing it down never rescans the device. Paths
+# are kept sorted, which puts every directory's subtree in one contiguous range found by
+# bisection; per-directory file counts come from the range and sizes from a prefix sum
+# over it. Extensions get position lists; they and the lowercased paths for substring
+# searches are built on first use, or up front by prepare().
+#
+# filter() understands:
+#   *.sql, dir5/*.py       glob, against the end of the path (see glob_regex)
+#   .sql                   extension
+#   anything else          substring of the path, ignoring case unless it has capitals
+# Typing more characters of a substring only searches the previous matches.
+
+
+def glob_regex(pattern):
+    # Like fnmatch, except that wildcards never match a '/' and the pattern only has to
+    # match the end of the path, starting at a '/': "*.sql" matches file names and
+    # "dir5/*.py" matches in any dir5. A leading '/' anchors it at the top.
+    anchored = pattern.startswith('/')
+    pattern = pattern.lstrip('/')
+    parts = []
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        position += 1
+        if char == '*':
+            parts.append('[^/]*')
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[' and pattern.find(']', position + 1) > 0:
+            # As in fnmatch, a ']' right after the '[' is part of the set
+            end = pattern.find(']', position + 1)
+            content = pattern[position:end].replace('\\', '\\\\')
+            if content.startswith('!'):
+                content = '^' + content[1:]
+            parts.append(f'[{content}]')
+            position = end + 1
+        else:
+            parts.append(re.escape(char))
+    prefix = '' if anchored else '(?:.*/)?'
+    return re.compile(prefix + ''.join(parts) + r'\Z', re.DOTALL)
+
+
+def glob_literal(pattern):
+    # Longest wildcard-free piece of pattern; every match contains it
+    pieces = re.split(r'\[[^\]]*\]|[*?]', pattern.lstrip('/'))
+    longest = max(pieces, key=len)
+    return '' if '[' in longest or ']' in longest else longest
+
+
+def extension_of(path):
+    name = path.rpartition('/')[2]
+    dot = name.rfind('.')
+    return name[dot + 1:].lower() if dot > 0 else ''
+
+
+class PathIndex:
+    def __init__(self, paths, metadata=None):
+        self.paths = sorted(paths)
+        metadata = metadata or {}
+        unknown = (0,)
+        self.size_sums = array('q', accumulate((metadata.get(path, unknown)[0] or 0 for path in self.paths),
+                                               initial=0))
+        self.extensions = None
+        self.lowered = None
+        self.last_query = None
+        self.last_matches = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def prepare(self):
+        # Builds the lazy parts now, e.g. on a worker thread, so the first query is fast
+        self.extension_positions('', 0, 0)
+        if self.lowered is None:
+            self.lowered = [path.lower() for path in self.paths]
+
+    def subtree(self, directory):
+        # (first, end) positions of everything under directory; '' is the whole listing
+        if not directory:
+            return 0, len(self.paths)
+        directory = directory.rstrip('/')
+        # Paths under "a/b" sort from "a/b/" up to, not including, "a/b0" ('0' follows '/')
+        return (bisect.bisect_left(self.paths, directory + '/'),
+                bisect.bisect_left(self.paths, directory + '0'))
+
+    def directory_stats(self, directory):
+        # (files, total size in bytes) under directory
+        first, end = self.subtree(directory)
+        return end - first, self.size_sums[end] - self.size_sums[first]
+
+    def children(self, directory):
+        # Subdirectories directly under directory as [(name, files, size)], and the number
+        # of files directly in it
+        first, end = self.subtree(directory)
+        prefix = directory.rstrip('/') + '/' if directory else ''
+        subdirectories = []
+        files = 0
+        position = first
+        while position < end:
+            rest = self.paths[position][len(prefix):]
+            slash = rest.find('/')
+            if slash < 0:
+                files += 1
+                position += 1
+                continue
+            name = rest[:slash]
+            child_end = bisect.bisect_left(self.paths, prefix + name + '0', position, end)
+            subdirectories.append((name, child_end - position,
+                                   self.size_sums[child_end] - self.size_sums[position]))
+            position = child_end
+        return subdirectories, files
+
+    def filter(self, query, directory=''):
+        first, end = self.subtree(directory)
+        if not query:
+            return self.paths[first:end]
+        if any(char in query for char in '*?['):
+            return self.filter_glob(query, first, end)
+        if query.startswith('.') and len(query) > 1 and '/' not in query:
+            return [self.paths[position] for position in self.extension_positions(query[1:].lower(), first, end)]
+        return self.filter_substring(query, directory, first, end)
+
+    def filter_glob(self, query, first, end):
+        matcher = glob_regex(query).match
+        # "*.ext" only has to look at the paths with that extension
+        extension = query[2:] if query.startswith('*.') else None
+        if extension and not any(char in extension for char in '*?[./'):
+            candidates = [self.paths[position] for position in self.extension_positions(extension.lower(), first, end)]
+        else:
+            candidates = self.paths[first:end]
+        # A plain substring test is much cheaper than the regex, so it goes first
+        literal = glob_literal(query)
+        if literal:
+            candidates = [path for path in candidates if literal in path]
+        return [path for path in candidates if matcher(path)]
+
+    def extension_positions(self, extension, first, end):
+        if self.extensions is None:
+            self.extensions = {}
+            for position, path in enumerate(self.paths):
+                self.extensions.setdefault(extension_of(path), array('I')).append(position)
+        positions = self.extensions.get(extension, ())
+        return positions[bisect.bisect_left(positions, first):bisect.bisect_left(positions, end)]
+
+    def filter_substring(self, query, directory, first, end):
+        ignore_case = query == query.lower()
+        if ignore_case:
+            if self.lowered is None:
+                self.lowered = [path.lower() for path in self.paths]
+            haystack = self.lowered
+        else:
+            haystack = self.paths
+        previous = self.last_query
+        if previous and previous[1:] == (directory, ignore_case) and previous[0] in query:
+            positions = [position for position in self.last_matches if query in haystack[position]]
+        else:
+            positions = [position for position in range(first, end) if query in haystack[position]]
+        self.last_query = (query, directory, ignore_case)
+        self.last_matches = positions
+        return [self.paths[position] for position in positions]
@@ -0,0 +1,461 @@
+import fcntl
+import json
+import os
+import threading
+import time
+
+from btrfs_devices import physical_disks
+from btrfs_engine import ListEngine, PathPatterns, RecoveryError, RestoreEngine, check_device, no_op
+from btrfs_journal import RestoreJournal, default_journal_path
+from btrfs_results import file_record
+from btrfs_trace import Tracer
+
+# Queue of recovery jobs over many devices or image files, e.g. the disks of a failed
+# array. Each job lists its device with its own patterns and, if it has a destination,
+# restores every match there. A job runs one stage at a time (scan: root discovery and
+# scanning; then restore) and goes back into the queue between them, so a high-priority
+# job's scan isn't stuck behind another job's long restore.
+#
+# At most max_jobs stages run at once, and at most per_disk of them read from the same
+# physical disk (see btrfs_devices.physical_disks), so images sitting on one spindle are
+# processed one after another while images on different disks run in parallel.
+#
+# The queue is saved to a JSON file after every change, and only one process at a time
+# may change or run it (a flock on the file next to it); others get a read-only view.
+# Jobs that were running when the owning process stopped are queued again on load; a
+# restore resumes from its journal, and its rescan is mostly served by the scan cache.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+JOB_STATES = [QUEUED, RUNNING, DONE, FAILED, CANCELLED]
+
+SCAN = 'scan'
+RESTORE = 'restore'
+
+
+def default_queue_path():
+    state_home = os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state')
+    return os.path.join(state_home, 'btrfs-restore-gui', 'jobs.json')
+
+
+class JobLog:
+    # Stands in for LogChannel: a job's btrfs output and progress messages are appended
+    # to its own file instead of being kept in memory
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'ab')
+
+    def append(self, line):
+        self.append_block(line.encode('utf-8', 'surrogateescape') + b'\n')
+
+    def append_block(self, block):
+        with self.lock:
+            self.file.write(block)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Job:
+    # Only the spec, state and last progress are saved; the engine and scan results live
+    # as long as the process
+    SAVED = ['id', 'device', 'pattern', 'recovery_type', 'depth', 'min_generation', 'metadata_image', 'destination',
+             'use_sudo', 'priority', 'state', 'stage', 'error', 'created', 'progress']
+
+    def __init__(self, id, device, pattern='', recovery_type='everything', depth='Deep', min_generation=None,
+                 metadata_image=None, destination=None, use_sudo=False, priority=0, state=QUEUED, stage=SCAN,
+                 error=None, created=None, progress=None):
+        self.id = id
+        self.device = device
+        self.pattern = pattern
+        self.recovery_type = recovery_type
+        self.depth = depth
+        self.min_generation = min_generation
+        self.metadata_image = metadata_image
+        self.destination = destination
+        self.use_sudo = use_sudo
+        self.priority = priority
+        self.state = state
+        self.stage = stage
+        self.error = error
+        self.created = created or time.time()
+        self.progress = progress or {'roots_done': 0, 'roots_total': 0, 'files': 0, 'restored': 0, 'selected': 0,
+                                     'message': ''}
+        self.engine = None
+        self.results = None
+        self.metadata = None
+        self.patterns = None
+        self.disks = set()
+        self.cancel_requested = False
+        self.requeue = False
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.SAVED}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{name: data[name] for name in cls.SAVED if name in data})
+
+    def sources(self):
+        # Files the next stage reads: the metadata image (or device) for a scan, the device
+        # for a restore, and both when a restore has to rescan first
+        scanned = self.metadata_image or self.device
+        if self.stage == SCAN:
+            return [scanned]
+        return [self.device] if self.results is not None else sorted({scanned, self.device})
+
+
+class JobQueue:
+    # Callbacks, called from any thread:
+    #   on_change()    a job was added, removed, started or finished, or its priority changed
+    # Nothing runs until start(); stop() lets the running stages finish but starts no more,
+    # and interrupt() also stops them and puts their jobs back in the queue.
+
+    def __init__(self, path=None, max_jobs=2, per_disk=1, workers_per_job=2, tracer=None):
+        self.on_change = no_op
+        self.path = path or default_queue_path()
+        self.log_directory = os.path.join(os.path.dirname(self.path), 'jobs')
+        self.max_jobs = max(1, max_jobs)
+        self.per_disk = max(1, per_disk)
+        self.workers_per_job = workers_per_job
+        self.tracer = tracer or Tracer()
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.jobs = {}
+        self.next_id = 1
+        self.running = {}
+        self.disk_load = {}
+        self.started = False
+        self.lock_file = None
+        self.read_only = not self.take_ownership()
+        self.load()
+
+    def take_ownership(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path + '.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def check_writable(self):
+        if self.read_only:
+            raise RecoveryError(f"The job queue {self.path} is in use by another process")
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            jobs = [Job.from_dict(job) for job in data['jobs']]
+            next_id = data.get('next_id', 1)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise RecoveryError(f"Can't read the job queue {self.path}: {e}")
+        for job in jobs:
+            # Whatever was running when the last owner stopped starts that stage again
+            if job.state == RUNNING and not self.read_only:
+                job.state = QUEUED
+            self.jobs[job.id] = job
+        self.next_id = max([next_id] + [job.id + 1 for job in jobs])
+
+    def reload(self):
+        # For a read-only view: picks up what the owning process saved since
+        with self.lock:
+            self.jobs = {}
+            self.load()
+
+    def save(self):
+        with self.lock:
+            data = {'next_id': self.next_id, 'jobs': [job.to_dict() for job in self.jobs.values()]}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(data, f, indent=1)
+            os.replace(temporary, self.path)
+
+    def changed_jobs(self):
+        # Called with lock held after every change
+        self.save()
+        self.changed.notify_all()
+        self.on_change()
+
+    def job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                raise RecoveryError(f"There is no job {job_id}")
+            return job
+
+    def log_path(self, job_id):
+        return os.path.join(self.log_directory, f"{job_id}.log")
+
+    def listing_path(self, job_id):
+        return os.path.join(self.log_directory, f"{job_id}.ndjson")
+
+    def add(self, device, **spec):
+        self.check_writable()
+        with self.lock:
+            job = Job(self.next_id, device, **spec)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.changed_jobs()
+            self.schedule()
+            return job
+
+    def set_priority(self, job_id, priority):
+        # Higher runs first; takes effect the next time a stage is started
+        self.check_writable()
+        with self.lock:
+            self.job(job_id).priority = priority
+            self.changed_jobs()
+
+    def cancel(self, job_id):
+        # A running scan stops right away; a running restore finishes its current batches,
+        # and its journal lets a retry carry on from there
+        self.check_writable()
+        with self.lock:
+            job = self.job(job_id)
+            if job.state == QUEUED:
+                job.state = CANCELLED
+                self.changed_jobs()
+            elif job.state == RUNNING:
+                job.cancel_requested = True
+                if job.engine:
+                    job.engine.cancel()
+
+    def retry(self, job_id):
+        self.check_writable()
+        with self.lock:
+            job = self.job(job_id)
+            if job.state in (FAILED, CANCELLED):
+                job.state = QUEUED
+                job.error = None
+                job.cancel_requested = False
+                self.changed_jobs()
+                self.schedule()
+
+    def remove(self, job_id):
+        self.check_writable()
+        with self.lock:
+            job = self.job(job_id)
+            if job.state == RUNNING:
+                raise RecoveryError(f"Job {job_id} is running, cancel it first")
+            del self.jobs[job_id]
+            self.changed_jobs()
+
+    def snapshot(self):
+        # [job dict] in the order jobs are picked: running first, then by priority
+        with self.lock:
+            jobs = sorted(self.jobs.values(), key=lambda job: (job.state != RUNNING, job.state != QUEUED,
+                                                                -job.priority, job.id))
+            return [{**job.to_dict(), 'progress': dict(job.progress), 'disks': sorted(job.disks)} for job in jobs]
+
+    def summary(self):
+        # Job counts per state and progress added up over every job
+        with self.lock:
+            summary = {state: 0 for state in JOB_STATES}
+            totals = {'roots_done': 0, 'roots_total': 0, 'files': 0, 'restored': 0, 'selected': 0}
+            for job in self.jobs.values():
+                summary[job.state] += 1
+                for name in totals:
+                    totals[name] += job.progress.get(name) or 0
+            return {'jobs': len(self.jobs), **summary, **totals, 'busy_disks': sorted(self.disk_load)}
+
+    def start(self):
+        self.check_writable()
+        with self.lock:
+            self.started = True
+            self.schedule()
+
+    def stop(self):
+        with self.lock:
+            self.started = False
+            self.changed.notify_all()
+
+    def interrupt(self):
+        with self.lock:
+            self.started = False
+            for job_id in self.running:
+                job = self.jobs[job_id]
+                job.requeue = job.cancel_requested = True
+                if job.engine:
+                    job.engine.cancel()
+            self.changed.notify_all()
+
+    def is_idle(self):
+        with self.lock:
+            return not self.running and (not self.started or not any(job.state == QUEUED for job in self.jobs.values()))
+
+    def wait(self, timeout=None):
+        # Blocks until nothing runs and nothing more can start; returns False on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while not self.is_idle():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+            return True
+
+    def schedule(self):
+        # Starts queued stages, highest priority first, while there are free slots. A job
+        # whose disk is busy is passed over for the next one rather than holding the slot.
+        with self.lock:
+            if not self.started:
+                return
+            waiting = sorted((job for job in self.jobs.values() if job.state == QUEUED),
+                             key=lambda job: (-job.priority, job.id))
+            for job in waiting:
+                if len(self.running) >= self.max_jobs:
+                    break
+                try:
+                    disks = set().union(*(physical_disks(source) for source in job.sources()))
+                except OSError as e:
+                    job.state = FAILED
+                    job.error = f"{e.filename}: {e.strerror}"
+                    self.changed_jobs()
+                    continue
+                if any(self.disk_load.get(disk, 0) >= self.per_disk for disk in disks):
+                    continue
+                job.disks = disks
+                for disk in disks:
+                    self.disk_load[disk] = self.disk_load.get(disk, 0) + 1
+                job.state = RUNNING
+                job.error = None
+                thread = threading.Thread(target=self.run_stage, args=(job,), name=f"job-{job.id}", daemon=True)
+                self.running[job.id] = thread
+                self.changed_jobs()
+                thread.start()
+
+    def run_stage(self, job):
+        log = JobLog(self.log_path(job.id))
+        state = DONE
+        error = None
+        try:
+            if job.stage == SCAN:
+                self.scan(job, log)
+                if job.cancel_requested:
+                    state = CANCELLED
+                elif job.destination and job.progress['files']:
+                    # Back into the queue for the restore stage
+                    job.stage = RESTORE
+                    state = QUEUED
+                elif not job.destination:
+                    self.write_listing(job)
+            else:
+                if job.results is None:
+                    self.scan(job, log)
+                if job.cancel_requested:
+                    state = CANCELLED
+                else:
+                    self.restore(job, log)
+                    if job.cancel_requested:
+                        state = CANCELLED
+                    elif job.engine.failed:
+                        state = FAILED
+                        error = f"{len(job.engine.failed)} files missing or of the wrong size after the restore"
+        except Exception as e:
+            state = FAILED
+            error = str(e)
+        finally:
+            log.append(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {job.stage} stage {state}"
+                       + (f": {error}" if error else ""))
+            log.close()
+        self.finish_stage(job, state, error)
+
+    def finish_stage(self, job, state, error):
+        with self.lock:
+            for disk in job.disks:
+                self.disk_load[disk] -= 1
+                if not self.disk_load[disk]:
+                    del self.disk_load[disk]
+            job.disks = set()
+            job.engine = None
+            if job.requeue:
+                state = QUEUED
+                error = None
+                job.requeue = job.cancel_requested = False
+            job.state = state
+            job.error = error
+            if state != QUEUED:
+                # Results are only kept between the stages of a job
+                job.results = None
+                job.metadata = None
+                job.patterns = None
+            self.running.pop(job.id, None)
+            self.changed_jobs()
+            self.schedule()
+
+    def set_progress(self, job, **values):
+        with self.lock:
+            job.progress.update(values)
+
+    def progress_message(self, job, log):
+        def report(message):
+            log.append(message)
+            self.set_progress(job, message=message)
+        return report
+
+    def scan(self, job, log):
+        error = check_device(job.metadata_image or job.device)
+        if error:
+            raise RecoveryError(error)
+        patterns = PathPatterns.parse(job.pattern, job.recovery_type)
+        engine = ListEngine(job.device, job.use_sudo, patterns.path_regex, max_workers=self.workers_per_job,
+                            depth=job.depth, log_channel=log, min_generation=job.min_generation,
+                            tracer=self.tracer, metadata_image=job.metadata_image)
+        metadata = {}
+        engine.on_progress = self.progress_message(job, log)
+        engine.on_root_progress = lambda done, total, root, seconds: self.set_progress(
+            job, roots_done=done, roots_total=total)
+        engine.on_files_found = lambda paths: self.set_progress(job, files=job.progress['files'] + len(paths))
+        engine.on_metadata = metadata.update
+        with self.lock:
+            job.engine = engine
+            job.progress.update(roots_done=0, roots_total=0, files=0)
+        if job.cancel_requested:
+            return
+        with self.tracer.span(f"job {job.id} scan", 'scan', device=job.device) as span:
+            files, results = engine.run()
+            span.update(files=len(files))
+        with self.lock:
+            job.results = results
+            job.metadata = metadata
+            job.patterns = patterns
+            job.progress['files'] = len(files)
+
+    def restore(self, job, log):
+        error = check_device(job.device)
+        if error:
+            raise RecoveryError(error)
+        file_roots = {path: job.results.root_for(path) for path in job.results}
+        engine = RestoreEngine(job.device, job.destination, file_roots, job.use_sudo, self.workers_per_job, log,
+                               self.tracer, journal=RestoreJournal(default_journal_path(job.destination)),
+                               sizes={path: info[0] for path, info in job.metadata.items()})
+        engine.on_progress = self.progress_message(job, log)
+        engine.on_restore_progress = lambda restored, total: self.set_progress(job, restored=restored,
+                                                                               selected=total)
+        with self.lock:
+            job.engine = engine
+            job.progress.update(restored=0, selected=len(file_roots))
+        if not job.cancel_requested:
+            engine.run()
+
+    def write_listing(self, job):
+        # What a scan-only job found, one JSON object per file
+        os.makedirs(self.log_directory, exist_ok=True)
+        with open(self.listing_path(job.id), 'w') as f:
+            for path in sorted(job.results):
+                f.write(json.dumps(file_record(path, job.results, job.metadata, job.patterns)) + '\n')
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import threading
+
+# Journal of a restore job, so an interrupted job resumes where it stopped. One JSON
+# object per line, appended and synced after every batch:
+#   {"root": ..., "path": ..., "status": "verified", "bytes": 1234, "hash": "..."}
+# status is "verified" when the file is at the destination with the expected size,
+# "size-mismatch" when its size differs from the btrfs metadata, and "missing" when
+# btrfs restore didn't produce it. A later record for the same path replaces earlier ones.
+
+HASH_BLOCK = 1024 * 1024
+
+
+def content_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def default_journal_path(destination):
+    return os.path.join(destination, '.btrfs-restore-journal.jsonl')
+
+
+class RestoreJournal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = self.load()
+        self.file = None
+
+    def load(self):
+        records = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        records[record['path']] = record
+                    except (ValueError, KeyError, TypeError):
+                        # The last line of a job killed mid-write
+                        continue
+        except FileNotFoundError:
+            pass
+        return records
+
+    def is_done(self, path, root, destination):
+        # Verified by an earlier run, from the same root, and still there with the same
+        # content; the size is compared first so most changed files aren't read
+        record = self.records.get(path)
+        if not record or record['status'] != 'verified' or record['root'] != root:
+            return False
+        target = os.path.join(destination, path)
+        try:
+            return os.path.getsize(target) == record['bytes'] and content_hash(target) == record['hash']
+        except OSError:
+            return False
+
+    def verify(self, root, path, destination, expected_size=None):
+        # Checks one restored file and returns its record. Without an expected size, from
+        # files whose metadata couldn't be read, any file that is there is verified.
+        target = os.path.join(destination, path)
+        try:
+            size = os.path.getsize(target)
+            digest = content_hash(target)
+        except OSError:
+            return {'root': root, 'path': path, 'status': 'missing', 'bytes': None, 'hash': None}
+        status = 'verified' if expected_size is None or expected_size == size else 'size-mismatch'
+        return {'root': root, 'path': path, 'status': status, 'bytes': size, 'hash': digest}
+
+    def write(self, records):
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self.file = open(self.path, 'a')
+            for record in records:
+                self.records[record['path']] = record
+                self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,116 @@
+import contextlib
+import re
+import subprocess
+
+from btrfs_trace import wait_process
+
+FS_TREE_ROOT_DIR = 256
+
+ITEM_KEY = re.compile(r'^\s*item \d+ key \((\S+) (\S+) (\S+)\)')
+FS_TREE_ROOT_ITEM = re.compile(r'key \(FS_TREE ROOT_ITEM \d+\)')
+ROOT_BYTENR = re.compile(r'\bbytenr (\d+)')
+INODE_SIZE = re.compile(r'^\s*generation \d+ transid \d+ size (\d+)')
+INODE_MTIME = re.compile(r'^\s*mtime (\d+)\.?(\d*)')
+REF_NAME = re.compile(r'^\s*index \d+ namelen \d+ name: (.*)$')
+
+
+def dump_tree_command(device, bytenr, use_sudo=False):
+    command = ['btrfs', 'inspect-internal', 'dump-tree', '--follow', '-b', str(bytenr), device]
+    if use_sudo:
+        command = ['sudo'] + command
+    return command
+
+
+def untracked(process):
+    return contextlib.nullcontext()
+
+
+def find_fs_tree_bytenr(device, root, use_sudo=False, track=untracked):
+    # The roots reported by btrfs-find-root are tree roots; the FS_TREE ROOT_ITEM in
+    # that tree points at the block holding the top of the filesystem tree.
+    process = subprocess.Popen(dump_tree_command(device, root, use_sudo), stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, universal_newlines=True, errors='surrogateescape')
+    bytenr = None
+    in_fs_root_item = False
+    with track(process):
+        for line in process.stdout:
+            if ITEM_KEY.match(line):
+                in_fs_root_item = bool(FS_TREE_ROOT_ITEM.search(line))
+            elif in_fs_root_item:
+                match = ROOT_BYTENR.search(line)
+                if match:
+                    bytenr = match.group(1)
+                    break
+        process.kill()
+        process.wait()
+    return bytenr
+
+
+def read_inode_metadata(device, root, use_sudo=False, stats=None, track=untracked):
+    # Returns {path: (size, mtime)} for every inode of the filesystem tree under root,
+    # with paths in the same form btrfs restore lists them (relative, no leading slash).
+    # stats, if given, receives the line count and the dump's resource usage. Both
+    # dump-tree processes run inside track(process), a context manager the caller can
+    # use to terminate them; a dump terminated early gives the inodes read until then.
+    fs_tree = find_fs_tree_bytenr(device, root, use_sudo, track)
+    if fs_tree is None:
+        raise RuntimeError(f"no filesystem tree found under root {root}")
+
+    process = subprocess.Popen(dump_tree_command(device, fs_tree, use_sudo), stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, universal_newlines=True, errors='surrogateescape')
+    sizes = {}
+    mtimes = {}
+    parents = {}
+    inode = None
+    item_type = None
+    lines = 0
+    with track(process):
+        for line in process.stdout:
+            lines += 1
+            key = ITEM_KEY.match(line)
+            if key:
+                item_type = key.group(2)
+                inode = int(key.group(1)) if key.group(1).isdigit() else None
+                ref_parent = int(key.group(3)) if key.group(3).isdigit() else None
+                continue
+            if inode is None:
+                continue
+            if item_type == 'INODE_ITEM':
+                match = INODE_SIZE.match(line)
+                if match:
+                    sizes[inode] = int(match.group(1))
+                    continue
+                match = INODE_MTIME.match(line)
+                if match:
+                    mtimes[inode] = float(f"{match.group(1)}.{match.group(2) or 0}")
+            elif item_type == 'INODE_REF' and inode not in parents:
+                # Hard links have several names; the first one is enough to place the inode
+                match = REF_NAME.match(line)
+                if match:
+                    parents[inode] = (ref_parent, match.group(1))
+        usage = wait_process(process)
+    if stats is not None:
+        stats.update(usage, lines=lines)
+
+    paths = {FS_TREE_ROOT_DIR: ''}
+
+    def path_of(inode):
+        chain = []
+        while inode not in paths:
+            ref = parents.get(inode)
+            if ref is None or len(chain) > len(parents):
+                return None
+            chain.append((inode, ref[1]))
+            inode = ref[0]
+        path = paths[inode]
+        for child, name in reversed(chain):
+            path = f"{path}/{name}" if path else name
+            paths[child] = path
+        return path
+
+    metadata = {}
+    for inode, size in sizes.items():
+        path = path_of(inode)
+        if path:
+            metadata[path] = (size, mtimes.get(inode))
+    return metadata
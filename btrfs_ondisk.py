@@ -0,0 +1,332 @@
+import bisect
+import collections
+import hashlib
+import os
+import struct
+
+# Read-only access to the on-disk btrfs structures needed to find tree roots without
+# btrfs-find-root: the superblock copies, the chunk tree that maps logical addresses to
+# this device, and the tree blocks owned by the root tree.
+
+SUPERBLOCK_OFFSETS = (0x10000, 0x4000000, 0x4000000000)
+SUPERBLOCK_SIZE = 0x1000
+SUPERBLOCK_MAGIC = b'_BHRfS_M'
+
+HEADER_SIZE = 0x65
+LEAF_ITEM_SIZE = 25
+KEY_PTR_SIZE = 33
+CHUNK_ITEM_SIZE = 48
+STRIPE_SIZE = 32
+
+ROOT_TREE_OBJECTID = 1
+FS_TREE_OBJECTID = 5
+ROOT_ITEM_KEY = 132
+CHUNK_ITEM_KEY = 228
+# Offset of bytenr in btrfs_root_item, after the embedded inode item, generation and root_dirid
+ROOT_ITEM_BYTENR = 176
+
+BLOCK_GROUP_SYSTEM = 1 << 1
+BLOCK_GROUP_METADATA = 1 << 2
+# Profiles whose data is spread over several devices; a single image can't be mapped
+BLOCK_GROUP_STRIPED = (1 << 3) | (1 << 6) | (1 << 7) | (1 << 8)
+INCOMPAT_METADATA_UUID = 1 << 10
+
+CSUM_CRC32C = 0
+CSUM_SHA256 = 2
+CSUM_BLAKE2 = 3
+
+Superblock = collections.namedtuple('Superblock', [
+    'offset', 'fsid', 'metadata_uuid', 'generation', 'root', 'chunk_root', 'root_level',
+    'chunk_root_level', 'nodesize', 'sectorsize', 'devid', 'label', 'csum_type', 'csum_ok',
+    'sys_chunk_array'])
+Chunk = collections.namedtuple('Chunk', ['logical', 'length', 'type', 'stripes'])
+TreeRoot = collections.namedtuple('TreeRoot', ['bytenr', 'generation', 'level'])
+
+
+class BtrfsFormatError(Exception):
+    pass
+
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data):
+    crc = 0xFFFFFFFF
+    table = CRC32C_TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def verify_checksum(block, csum_type):
+    # Returns True/False, or None for checksum types the standard library can't compute
+    stored = block[:32]
+    data = block[32:]
+    if csum_type == CSUM_CRC32C:
+        return stored[:4] == struct.pack('<I', crc32c(data))
+    if csum_type == CSUM_SHA256:
+        return stored == hashlib.sha256(data).digest()
+    if csum_type == CSUM_BLAKE2:
+        return stored == hashlib.blake2b(data, digest_size=32).digest()
+    return None
+
+
+def format_uuid(raw):
+    text = raw.hex()
+    return f"{text[:8]}-{text[8:12]}-{text[12:16]}-{text[16:20]}-{text[20:]}"
+
+
+def parse_superblock(block, offset):
+    if len(block) < SUPERBLOCK_SIZE or block[0x40:0x48] != SUPERBLOCK_MAGIC:
+        return None
+    if struct.unpack_from('<Q', block, 0x30)[0] != offset:
+        return None
+    generation, root, chunk_root = struct.unpack_from('<QQQ', block, 0x48)
+    sectorsize, nodesize = struct.unpack_from('<II', block, 0x90)
+    sys_chunk_array_size = struct.unpack_from('<I', block, 0xa0)[0]
+    incompat_flags = struct.unpack_from('<Q', block, 0xbc)[0]
+    csum_type = struct.unpack_from('<H', block, 0xc4)[0]
+    root_level, chunk_root_level = block[0xc6], block[0xc7]
+    devid = struct.unpack_from('<Q', block, 0xc9)[0]
+    fsid = bytes(block[0x20:0x30])
+    metadata_uuid = bytes(block[0x23b:0x24b]) if incompat_flags & INCOMPAT_METADATA_UUID else fsid
+    label = bytes(block[0x12b:0x22b]).split(b'\0', 1)[0].decode('utf-8', 'replace')
+    return Superblock(offset, fsid, metadata_uuid, generation, root, chunk_root, root_level,
+                      chunk_root_level, nodesize, sectorsize, devid, label, csum_type,
+                      verify_checksum(block[:SUPERBLOCK_SIZE], csum_type),
+                      bytes(block[0x32b:0x32b + sys_chunk_array_size]))
+
+
+def parse_chunk(data, offset, logical):
+    length, _, _, chunk_type = struct.unpack_from('<QQQQ', data, offset)
+    num_stripes = struct.unpack_from('<H', data, offset + 44)[0]
+    stripes = []
+    for i in range(num_stripes):
+        devid, physical = struct.unpack_from('<QQ', data, offset + CHUNK_ITEM_SIZE + i * STRIPE_SIZE)
+        stripes.append((devid, physical))
+    return Chunk(logical, length, chunk_type, stripes), CHUNK_ITEM_SIZE + num_stripes * STRIPE_SIZE
+
+
+class BtrfsImage:
+    # A btrfs device or image file opened read-only. Everything is read with pread rather
+    # than through mmap: a bad sector read through a mapping raises SIGBUS and kills the
+    # process, while pread fails with an OSError that is turned into BtrfsFormatError.
+
+    # Bytes read at once when scanning a metadata chunk for tree roots
+    SCAN_WINDOW = 4 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            self.size = os.lseek(self.fd, 0, os.SEEK_END)
+            if self.size < SUPERBLOCK_OFFSETS[0] + SUPERBLOCK_SIZE:
+                raise BtrfsFormatError(f"{path} is too small to hold a btrfs filesystem")
+            self.superblocks = self.read_superblocks()
+            if not self.superblocks:
+                raise BtrfsFormatError(f"no valid btrfs superblock found on {path}")
+            # The primary copy unless it is damaged, then the newest surviving backup
+            primary = [sb for sb in self.superblocks
+                       if sb.offset == SUPERBLOCK_OFFSETS[0] and sb.csum_ok is not False]
+            self.superblock = primary[0] if primary else max(self.superblocks, key=lambda sb: sb.generation)
+            self.chunks = []
+            self.chunk_starts = []
+            self.load_chunks()
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, offset, length):
+        try:
+            return os.pread(self.fd, length, offset)
+        except OSError as e:
+            raise BtrfsFormatError(f"could not read {length} bytes at {offset} of {self.path}: {e.strerror}")
+
+    def read_superblocks(self):
+        superblocks = []
+        for offset in SUPERBLOCK_OFFSETS:
+            if offset + SUPERBLOCK_SIZE <= self.size:
+                # A damaged copy is skipped like a missing one
+                try:
+                    sb = parse_superblock(self.read(offset, SUPERBLOCK_SIZE), offset)
+                except BtrfsFormatError:
+                    continue
+                if sb:
+                    superblocks.append(sb)
+        return superblocks
+
+    def add_chunk(self, chunk):
+        index = bisect.bisect_left(self.chunk_starts, chunk.logical)
+        if index < len(self.chunk_starts) and self.chunk_starts[index] == chunk.logical:
+            return
+        self.chunk_starts.insert(index, chunk.logical)
+        self.chunks.insert(index, chunk)
+
+    def load_chunks(self):
+        # The superblock carries the SYSTEM chunks needed to read the chunk tree itself
+        data = self.superblock.sys_chunk_array
+        offset = 0
+        while offset + 17 <= len(data):
+            _, key_type, logical = struct.unpack_from('<QBQ', data, offset)
+            offset += 17
+            if key_type != CHUNK_ITEM_KEY:
+                raise BtrfsFormatError(f"unexpected key type {key_type} in sys_chunk_array")
+            chunk, size = parse_chunk(data, offset, logical)
+            self.add_chunk(chunk)
+            offset += size
+        self.walk_chunk_tree(self.superblock.chunk_root)
+
+    def walk_chunk_tree(self, bytenr):
+        block = self.read_tree_block(bytenr)
+        nritems = struct.unpack_from('<I', block, 0x60)[0]
+        level = block[0x64]
+        for i in range(nritems):
+            if level:
+                pointer = struct.unpack_from('<Q', block, HEADER_SIZE + i * KEY_PTR_SIZE + 17)[0]
+                self.walk_chunk_tree(pointer)
+                continue
+            item = HEADER_SIZE + i * LEAF_ITEM_SIZE
+            _, key_type, logical, data_offset, _ = struct.unpack_from('<QBQII', block, item)
+            if key_type == CHUNK_ITEM_KEY:
+                self.add_chunk(parse_chunk(block, HEADER_SIZE + data_offset, logical)[0])
+
+    def chunk_for(self, logical):
+        index = bisect.bisect_right(self.chunk_starts, logical) - 1
+        if index >= 0:
+            chunk = self.chunks[index]
+            if logical < chunk.logical + chunk.length:
+                return chunk
+        return None
+
+    def stripe_offset(self, chunk):
+        # Physical start of the chunk on this device, or None if it lives elsewhere
+        if chunk.type & BLOCK_GROUP_STRIPED:
+            return None
+        for devid, physical in chunk.stripes:
+            if devid == self.superblock.devid:
+                return physical
+        return None
+
+    def logical_to_physical(self, logical):
+        chunk = self.chunk_for(logical)
+        if chunk is None:
+            raise BtrfsFormatError(f"logical address {logical} is not covered by any chunk")
+        physical = self.stripe_offset(chunk)
+        if physical is None:
+            raise BtrfsFormatError(f"logical address {logical} is not stored on this device")
+        return physical + logical - chunk.logical
+
+    def read_tree_block(self, bytenr):
+        physical = self.logical_to_physical(bytenr)
+        block = self.read(physical, self.superblock.nodesize)
+        if len(block) < self.superblock.nodesize or struct.unpack_from('<Q', block, 0x30)[0] != bytenr:
+            raise BtrfsFormatError(f"bad tree block at {bytenr}")
+        return block
+
+    def search_tree(self, bytenr, key):
+        # Returns the data of the item with exactly this (objectid, type, offset) key, or None
+        block = self.read_tree_block(bytenr)
+        nritems = struct.unpack_from('<I', block, 0x60)[0]
+        if block[0x64]:
+            child = None
+            for i in range(nritems):
+                pointer = HEADER_SIZE + i * KEY_PTR_SIZE
+                if struct.unpack_from('<QBQ', block, pointer) > key:
+                    break
+                child = struct.unpack_from('<Q', block, pointer + 17)[0]
+            return None if child is None else self.search_tree(child, key)
+        for i in range(nritems):
+            objectid, key_type, offset, data_offset, size = struct.unpack_from(
+                '<QBQII', block, HEADER_SIZE + i * LEAF_ITEM_SIZE)
+            if (objectid, key_type, offset) == key:
+                return block[HEADER_SIZE + data_offset:HEADER_SIZE + data_offset + size]
+        return None
+
+    def fs_tree_fingerprint(self, root):
+        # Hash of the top block of the filesystem tree that the tree root at root points to.
+        # Blocks are copy-on-write and name their children by address and generation, so
+        # equal top blocks mean equal trees, whatever else changed in other subvolumes.
+        item = self.search_tree(root, (FS_TREE_OBJECTID, ROOT_ITEM_KEY, 0))
+        if item is None or len(item) < ROOT_ITEM_BYTENR + 8:
+            return None
+        block = self.read_tree_block(struct.unpack_from('<Q', item, ROOT_ITEM_BYTENR)[0])
+        return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+    def find_tree_roots(self, min_generation=None, max_generation=None):
+        # Scans every metadata chunk on this device for blocks owned by the root tree and
+        # keeps, per generation, the highest-level block: that block is the tree root
+        # committed in that transaction. Unreadable blocks are skipped. Returns TreeRoots,
+        # newest generation first.
+        sb = self.superblock
+        max_generation = sb.generation if max_generation is None else max_generation
+        min_generation = 0 if min_generation is None else min_generation
+        best = {}
+        for chunk in self.chunks:
+            if not chunk.type & BLOCK_GROUP_METADATA:
+                continue
+            physical = self.stripe_offset(chunk)
+            if physical is None:
+                continue
+            end = min(physical + chunk.length, self.size)
+            for start in range(physical, end, self.SCAN_WINDOW):
+                for offset, data in self.read_window(start, min(self.SCAN_WINDOW, end - start)):
+                    self.scan_blocks(data, offset - physical + chunk.logical, min_generation, max_generation, best)
+        return sorted(best.values(), key=lambda root: root.generation, reverse=True)
+
+    def read_window(self, offset, length):
+        # Yields (offset, data) covering the window, or its readable blocks one by one
+        # when reading all of it at once fails
+        try:
+            yield offset, self.read(offset, length)
+            return
+        except BtrfsFormatError:
+            pass
+        nodesize = self.superblock.nodesize
+        for start in range(offset, offset + length, nodesize):
+            try:
+                yield start, self.read(start, nodesize)
+            except BtrfsFormatError:
+                continue
+
+    def scan_blocks(self, data, logical, min_generation, max_generation, best):
+        # Adds the root tree blocks in data, which starts at logical address logical, to best
+        nodesize = self.superblock.nodesize
+        fsid = self.superblock.metadata_uuid
+        unpack_from = struct.unpack_from
+        for offset in range(0, len(data) - HEADER_SIZE + 1, nodesize):
+            if data[offset + 0x20:offset + 0x30] != fsid:
+                continue
+            bytenr, _ = unpack_from('<QQ', data, offset + 0x30)
+            generation, owner = unpack_from('<QQ', data, offset + 0x50)
+            if owner != ROOT_TREE_OBJECTID or bytenr != logical + offset:
+                continue
+            if not min_generation <= generation <= max_generation:
+                continue
+            level = data[offset + 0x64]
+            if generation not in best or level > best[generation].level:
+                best[generation] = TreeRoot(bytenr, generation, level)
+
+def find_tree_roots(path, min_generation=None, max_generation=None):
+    with BtrfsImage(path) as image:
+        return image.find_tree_roots(min_generation, max_generation)
@@ -0,0 +1,48 @@
+import re
+
+# Binary parsing of btrfs-progs output. Subprocess output is read in large blocks of
+# whole lines and searched with precompiled byte patterns instead of being decoded and
+# split line by line. Paths are decoded with surrogateescape, so names that aren't valid
+# UTF-8 come back byte for byte when they are passed to another --path-regex;
+# display_path() is only for showing them.
+
+READ_SIZE = 1024 * 1024
+
+WELL_BLOCK = re.compile(rb'Well block (\d+)(?:\(gen: (\d+))?')
+RESTORING = re.compile(rb'^Restoring ', re.MULTILINE)
+
+
+def read_line_blocks(stream, size=READ_SIZE):
+    # Yields blocks of complete lines, each ending in a newline, as soon as the process
+    # has written them; read1 returns whatever is available instead of waiting for size.
+    partial = b''
+    while True:
+        data = stream.read1(size)
+        if not data:
+            break
+        if partial:
+            data = partial + data
+        end = data.rfind(b'\n') + 1
+        partial = data[end:]
+        if end:
+            yield data[:end]
+    if partial:
+        yield partial + b'\n'
+
+
+def restoring_pattern(output_dir):
+    # 'btrfs restore' prints "Restoring <output_dir>/<path>"; group 1 is the path
+    prefix = re.escape(output_dir.rstrip('/').encode() + b'/')
+    return re.compile(rb'^Restoring ' + prefix + rb'(.*)$', re.MULTILINE)
+
+
+def decode_lines(block):
+    return block[:-1].decode('utf-8', 'surrogateescape').split('\n')
+
+
+def decode_path(raw):
+    return raw.decode('utf-8', 'surrogateescape')
+
+
+def display_path(path):
+    return path.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
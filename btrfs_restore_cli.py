@@ -0,0 +1,667 @@
+import argparse
+import json
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+from btrfs_capture import CAPTURE_METHODS, capture_metadata
+from btrfs_client import DaemonClient
+from btrfs_daemon import RecoveryDaemon
+from btrfs_engine import (DEFAULT_DESTINATION, RECOVERY_TYPES, SEARCH_DEPTHS, ListEngine, PathPatterns,
+                          RecoveryError, RestoreEngine, check_device, list_btrfs_partitions, unmount_device)
+from btrfs_export import check_saved_scan, load_scan, save_scan, scan_info
+from btrfs_jobs import FAILED, JobQueue
+from btrfs_journal import RestoreJournal, default_journal_path
+from btrfs_results import file_record
+from btrfs_trace import Tracer
+from btrfs_versions import VersionCollector
+
+# Headless front end: python -m btrfs_restore_cli
+#   {devices,capture,roots,list,restore,versions,queue,daemon,gui} ...
+# PyQt5 is only imported by the gui command. With --daemon, roots, list and restore are
+# done by a running recovery daemon (see btrfs_daemon) instead of in this process.
+
+EXIT_OK = 0
+EXIT_NO_MATCHES = 1
+EXIT_USAGE = 2
+EXIT_ERROR = 3
+
+
+class Output:
+    # ndjson writes every record as soon as it happens; json and text collect the final
+    # result and write it once at the end.
+
+    def __init__(self, fmt, quiet=False):
+        self.format = fmt
+        self.quiet = quiet
+        self.lock = threading.Lock()
+
+    def event(self, record):
+        if self.format != 'ndjson':
+            return
+        with self.lock:
+            sys.stdout.write(json.dumps(record) + '\n')
+            sys.stdout.flush()
+
+    def progress(self, message):
+        if not self.quiet:
+            with self.lock:
+                print(message, file=sys.stderr, flush=True)
+
+    def result(self, document, lines):
+        if self.format == 'json':
+            json.dump(document, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        elif self.format == 'text':
+            for line in lines:
+                print(line)
+
+
+class StderrLog:
+    # Stands in for LogChannel: btrfs output goes straight to stderr with --verbose and is
+    # dropped otherwise, so nothing accumulates in memory.
+
+    def __init__(self, verbose):
+        self.verbose = verbose
+        self.lock = threading.Lock()
+
+    def append(self, line):
+        if self.verbose:
+            with self.lock:
+                print(line, file=sys.stderr, flush=True)
+
+    def append_block(self, block):
+        if self.verbose:
+            with self.lock:
+                sys.stderr.flush()
+                sys.stderr.buffer.write(block)
+                sys.stderr.buffer.flush()
+
+
+def add_scan_arguments(parser):
+    parser.add_argument('--device', '-d', help="btrfs device or image file; with --load, defaults to the saved one")
+    parser.add_argument('--type', '-t', choices=RECOVERY_TYPES, default='everything',
+                        help="what the pattern names, as in the GUI's Recovery Type")
+    parser.add_argument('--pattern', '-p', action='append', default=[],
+                        help="file name, directory, extension or dir/file; repeat it or separate patterns with ';' "
+                             "to list several in one scan, and prefix one with a type to override --type "
+                             "(e.g. -p ext:sql -p dir:nginx)")
+    parser.add_argument('--depth', choices=list(SEARCH_DEPTHS), default='Deep')
+    parser.add_argument('--min-generation', type=int, help="only use roots at or above this generation")
+    parser.add_argument('--jobs', '-j', type=int, help="roots scanned in parallel (default: CPU count)")
+    parser.add_argument('--root-timeout', type=float, metavar='SECONDS',
+                        help="stop scanning a root, or reading its metadata, after this long and keep what it listed")
+    parser.add_argument('--max-matches', type=int, metavar='N',
+                        help="stop once N distinct files were found and keep only those")
+    parser.add_argument('--sudo', action='store_true', help="run btrfs-progs through sudo")
+    parser.add_argument('--no-cache', action='store_true', help="ignore and don't update the scan cache")
+    parser.add_argument('--no-triage', action='store_true',
+                        help="scan roots even when their filesystem tree duplicates an earlier root")
+    parser.add_argument('--unmount', action='store_true', help="unmount the device before scanning")
+    parser.add_argument('--metadata-image', metavar='IMAGE',
+                        help="scan this image made by the capture command instead of the device; "
+                             "restores still read the device")
+    parser.add_argument('--save', metavar='FILE',
+                        help="save the scan to FILE for --load: SQLite, or NDJSON if FILE ends in .ndjson or .jsonl")
+    parser.add_argument('--load', metavar='FILE',
+                        help="use a scan saved with --save instead of scanning; --pattern narrows it down")
+
+
+def make_list_engine(args, output):
+    args.patterns = PathPatterns.parse(';'.join(args.pattern), args.type)
+    engine = ListEngine(args.device, args.sudo, args.patterns.path_regex,
+                        max_workers=args.jobs, depth=args.depth, use_cache=not args.no_cache,
+                        log_channel=StderrLog(args.verbose), min_generation=args.min_generation,
+                        triage=not args.no_triage, tracer=args.tracer, root_timeout=args.root_timeout,
+                        max_matches=args.max_matches, metadata_image=args.metadata_image)
+    engine.on_progress = output.progress
+    engine.on_files_found = lambda paths: [output.event({'event': 'match', 'path': path,
+                                                         'pattern': args.patterns.tag(path)}) for path in paths]
+    engine.on_root_progress = lambda done, total, root, seconds: output.event(
+        {'event': 'root', 'root': root, 'done': done, 'total': total, 'seconds': round(seconds, 3)})
+    return engine
+
+
+def prepare_device(args, output, device_needed=True):
+    # A listing from a metadata image or a saved scan doesn't need the device itself
+    if getattr(args, 'load', None):
+        return load_saved_scan(args, output, device_needed)
+    image = getattr(args, 'metadata_image', None)
+    for device in ([image] if image else []) + ([args.device] if device_needed or not image else []):
+        error = check_device(device)
+        if error:
+            output.progress(error)
+            return False
+    # The daemon unmounts the device itself
+    if args.unmount and not args.daemon and unmount_device(args.device):
+        output.progress(f"Successfully unmounted {args.device}")
+    return True
+
+
+def load_saved_scan(args, output, device_needed):
+    output.progress(f"Loading the scan saved in {args.load}")
+    with args.tracer.span('load scan', 'scan', file=args.load) as span:
+        args.saved = load_scan(args.load)
+        span.update(files=len(args.saved[0]))
+    info = args.saved[2]
+    args.device = args.device or info.get('device')
+    if not device_needed:
+        return True
+    error = check_device(args.device)
+    if error:
+        output.progress(error)
+        return False
+    warning = check_saved_scan(info, args.device, args.sudo)
+    if warning:
+        output.progress(warning)
+    return True
+
+
+def saved_scan(args, output):
+    # scan() from args.saved. Patterns given on the command line pick out matching files,
+    # otherwise all of them are used, tagged with the patterns they were saved with.
+    results, metadata, info = args.saved
+    if args.pattern or args.type != 'everything':
+        args.patterns = PathPatterns.parse(';'.join(args.pattern), args.type)
+        search = re.compile(args.patterns.path_regex).search
+        files = [path for path in results if search('/' + path)]
+    else:
+        args.patterns = PathPatterns.parse(info.get('pattern') or '', info.get('type') or 'everything')
+        files = list(results)
+    output.progress(f"{len(files)} of {len(results)} saved files from {len(results.root_names)} roots")
+    return sorted(files), results, metadata
+
+
+def save_results(args, output, results, metadata):
+    if args.load:
+        # Converting a saved scan keeps what it was saved with
+        info = {**args.saved[2], 'saved': time.time()}
+    else:
+        info = scan_info(results, args.device, args.metadata_image, args.sudo, pattern=';'.join(args.pattern),
+                         type=args.type, depth=args.depth, min_generation=args.min_generation)
+    with args.tracer.span('save scan', 'scan', file=args.save, files=len(results)):
+        save_scan(args.save, results, metadata, info)
+    output.progress(f"Saved {len(results)} files from {len(results.root_names)} roots to {args.save}")
+
+
+def interrupt_cancels(output, cancel):
+    # The first Ctrl-C calls cancel() and keeps what was found, a second one aborts.
+    # Returns the handler to restore afterwards.
+    def interrupt(signum, frame):
+        signal.signal(signal.SIGINT, previous)
+        output.progress("Cancelling, press Ctrl-C again to abort")
+        cancel()
+
+    previous = signal.signal(signal.SIGINT, interrupt)
+    return previous
+
+
+def daemon_event(args, output, event):
+    kind = event['event']
+    if kind == 'progress':
+        output.progress(event['message'])
+    elif kind == 'files':
+        for path in event['paths']:
+            output.event({'event': 'match', 'path': path, 'pattern': args.patterns.tag(path)})
+    elif kind == 'root':
+        output.event({'event': 'root', 'root': event['root'], 'done': event['done'], 'total': event['total'],
+                      'seconds': round(event['seconds'], 3)})
+    elif kind == 'restore':
+        output.event({'event': 'restore_progress', 'restored': event['restored'], 'total': event['total']})
+    elif kind == 'dropped':
+        output.progress(f"{event['events']} earlier events of the task are no longer kept")
+    elif kind == 'log' and args.verbose:
+        for line in event['lines']:
+            print(line, file=sys.stderr)
+
+
+def watch_task(args, output, client, task):
+    # Streams a daemon task's events to output until it ends; Ctrl-C cancels it
+    def cancel():
+        with DaemonClient(args.socket) as other:
+            other.call('cancel', task=task['task'])
+
+    previous = interrupt_cancels(output, cancel)
+    try:
+        finished = client.subscribe(task['task'], lambda event: daemon_event(args, output, event), log=args.verbose)
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    if finished['state'] == 'failed':
+        raise RecoveryError(finished['error'])
+    return finished
+
+
+def daemon_scan(args, output):
+    # scan() through the daemon; a listing it still holds is answered from memory
+    args.patterns = PathPatterns.parse(';'.join(args.pattern), args.type)
+    with DaemonClient(args.socket) as client:
+        task = client.call('scan', device=args.device, pattern=';'.join(args.pattern), type=args.type,
+                           depth=args.depth, min_generation=args.min_generation, metadata_image=args.metadata_image,
+                           root_timeout=args.root_timeout, max_matches=args.max_matches,
+                           use_cache=not args.no_cache, unmount=args.unmount, triage=not args.no_triage)
+        if task['state'] != 'running':
+            output.progress(f"Reusing scan {task['task']} held by the daemon")
+        watch_task(args, output, client, task)
+        results, metadata = client.fetch_results(task['task'])
+    args.scan_task = task['task']
+    return sorted(results), results, metadata
+
+
+def scan(args, output):
+    # Returns (files, ScanResults, metadata)
+    if args.load:
+        files, results, metadata = saved_scan(args, output)
+    elif args.daemon:
+        files, results, metadata = daemon_scan(args, output)
+    else:
+        files, results, metadata = local_scan(args, output)
+    if args.save:
+        save_results(args, output, results, metadata)
+    return files, results, metadata
+
+
+def local_scan(args, output):
+    engine = make_list_engine(args, output)
+    metadata = {}
+    engine.on_metadata = metadata.update
+    output.progress(f"Using path regex: {engine.path_regex}")
+
+    previous = interrupt_cancels(output, engine.cancel)
+    try:
+        files, results = engine.run()
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    return sorted(files), results, metadata
+
+
+def command_devices(args, output):
+    partitions = list_btrfs_partitions()
+    records = [{'device': device, 'uuid': uuid, 'label': label} for device, uuid, label in partitions]
+    for record in records:
+        output.event({'event': 'device', **record})
+    output.result(records, [f"{r['device']}\t{r['uuid']}\t{r['label']}" for r in records])
+    return EXIT_OK if records else EXIT_NO_MATCHES
+
+
+def command_capture(args, output):
+    if not prepare_device(args, output):
+        return EXIT_ERROR
+    last = [0]
+
+    def progress(copied, total):
+        # One message per 5% at most
+        if total and copied * 20 // total != last[0]:
+            last[0] = copied * 20 // total
+            output.progress(f"Captured {copied // (1024 * 1024)} of {total // (1024 * 1024)} MiB")
+            output.event({'event': 'capture_progress', 'bytes': copied, 'total': total})
+
+    output.progress(f"Capturing the metadata of {args.device} to {args.output}")
+    with args.tracer.span('capture', 'capture', device=args.device) as span:
+        result = capture_metadata(args.device, args.output, args.sudo, args.method, progress)
+        span.update(result)
+    if result['unreadable_bytes']:
+        output.progress(f"Warning: {result['unreadable_bytes']} bytes of metadata could not be read")
+    if result.get('warning'):
+        output.progress(result['warning'])
+    output.event({'event': 'summary', **result})
+    output.result({'image': args.output, **result},
+                  [f"Captured {result['bytes']} bytes of metadata to {args.output} ({result['method']})"])
+    return EXIT_OK
+
+
+def command_roots(args, output):
+    if not prepare_device(args, output, device_needed=False):
+        return EXIT_ERROR
+    if args.load:
+        results = args.saved[0]
+        roots = list(zip(results.root_names, results.generations))
+    elif args.daemon:
+        with DaemonClient(args.socket) as client:
+            records = client.call('roots', device=args.device, metadata_image=args.metadata_image,
+                                  min_generation=args.min_generation)
+        roots = [(record['root'], record['generation']) for record in records]
+    else:
+        roots = make_list_engine(args, output).list_roots()
+    records = [{'root': root, 'generation': generation} for root, generation in roots]
+    for record in records:
+        output.event({'event': 'root', **record})
+    output.result(records, [f"{r['root']}\t{r['generation']}" for r in records])
+    return EXIT_OK if records else EXIT_NO_MATCHES
+
+
+def command_list(args, output):
+    if not prepare_device(args, output, device_needed=False):
+        return EXIT_ERROR
+    files, results, metadata = scan(args, output)
+    records = [file_record(path, results, metadata, args.patterns) for path in files]
+    for record in records:
+        output.event({'event': 'file', **record})
+    roots = results.roots()
+    output.event({'event': 'summary', 'files': len(files), 'roots': len(roots)})
+    output.result({'files': records,
+                   'roots': {root: {'generation': results.generation(root), 'files': results.count(root)}
+                             for root in roots}},
+                  files)
+    return EXIT_OK if files else EXIT_NO_MATCHES
+
+
+def command_restore(args, output):
+    if not prepare_device(args, output):
+        return EXIT_ERROR
+    files, results, metadata = scan(args, output)
+    if not files:
+        output.progress("No matching files to restore.")
+        output.result({'restored': 0, 'selected': 0}, [])
+        return EXIT_NO_MATCHES
+
+    if args.daemon:
+        return daemon_restore(args, output, files)
+    file_roots = {path: results.root_for(path) for path in files}
+    journal = None if args.no_journal else RestoreJournal(args.journal or default_journal_path(args.destination))
+    engine = RestoreEngine(args.device, args.destination, file_roots, use_sudo=args.sudo,
+                           max_workers=args.jobs, log_channel=StderrLog(args.verbose), tracer=args.tracer,
+                           journal=journal, sizes={path: info[0] for path, info in metadata.items()},
+                           max_read_bytes=args.max_read_mib * 1024 * 1024 if args.max_read_mib else None,
+                           max_files=args.max_files_per_sec, check_space=not args.no_space_check)
+    engine.on_progress = output.progress
+    engine.on_restore_progress = lambda restored, total: output.event(
+        {'event': 'restore_progress', 'restored': restored, 'total': total})
+    restored = engine.run()
+    summary = {'restored': restored, 'selected': len(files), 'skipped': engine.skipped}
+    if journal:
+        summary.update(verified=engine.verified, failed=engine.failed)
+    output.event({'event': 'summary', **summary})
+    output.result({**summary, 'destination': args.destination},
+                  [f"Restored {restored} of {len(files)} files to {args.destination}"
+                   + (f", {engine.skipped} already restored" if engine.skipped else "")])
+    return EXIT_OK if not engine.failed else EXIT_ERROR
+
+
+def daemon_restore(args, output, files):
+    if args.journal:
+        output.progress("The daemon keeps its journal in the destination, --journal is ignored")
+    with DaemonClient(args.socket) as client:
+        task = client.call('restore', scan=args.scan_task, destination=os.path.abspath(args.destination),
+                           journal=not args.no_journal, max_read_mib=args.max_read_mib,
+                           max_files_per_sec=args.max_files_per_sec, check_space=not args.no_space_check)
+        summary = watch_task(args, output, client, task)['result']
+    failed = summary['failed']
+    if args.no_journal:
+        summary = {name: summary[name] for name in ('restored', 'selected', 'skipped')}
+    output.event({'event': 'summary', **summary})
+    output.result({**summary, 'destination': args.destination},
+                  [f"Restored {summary['restored']} of {len(files)} files to {args.destination}"
+                   + (f", {summary['skipped']} already restored" if summary['skipped'] else "")])
+    return EXIT_OK if not failed else EXIT_ERROR
+
+
+def command_versions(args, output):
+    if not prepare_device(args, output):
+        return EXIT_ERROR
+    files, results, _ = scan(args, output)
+    if not files:
+        output.progress("No matching files.")
+        output.result({'files': []}, [])
+        return EXIT_NO_MATCHES
+
+    collector = VersionCollector(args.device, args.staging, results, files, use_sudo=args.sudo,
+                                 max_workers=args.jobs, log_channel=StderrLog(args.verbose), tracer=args.tracer)
+    collector.on_progress = output.progress
+    versions, totals = collector.run()
+    records = [{'path': path, 'versions': [version.to_dict() for version in found]} for path, found in versions.items()]
+    lines = []
+    for record in records:
+        output.event({'event': 'file', **record})
+        for version in record['versions']:
+            generations = ','.join(str(root['generation']) for root in version['roots'])
+            lines.append(f"{record['path']}\t{version['digest']}\t{version['size']}\t{generations}\t{version['staged']}")
+    output.event({'event': 'summary', 'files': len(records), **totals})
+    output.result({'files': records, **totals}, lines)
+    return EXIT_OK
+
+
+def job_line(job):
+    progress = job['progress']
+    done = f"{progress['roots_done']}/{progress['roots_total']} roots, {progress['files']} files"
+    if job['stage'] == 'restore':
+        done += f", {progress['restored']}/{progress['selected']} restored"
+    return (f"{job['id']}\t{job['state']}\t{job['stage']}\t{job['priority']}\t{job['device']}\t"
+            f"{job['pattern'] or '*'}\t{job['destination'] or '-'}\t{done}"
+            + (f"\t{job['error']}" if job['error'] else ""))
+
+
+def summary_line(summary):
+    return (f"{summary['running']} running, {summary['queued']} queued, {summary['done']} done, "
+            f"{summary['failed']} failed, {summary['cancelled']} cancelled; {summary['roots_done']}/"
+            f"{summary['roots_total']} roots, {summary['files']} files, {summary['restored']}/"
+            f"{summary['selected']} restored")
+
+
+def open_queue(args):
+    return JobQueue(args.queue, getattr(args, 'max_jobs', 2), getattr(args, 'per_disk', 1),
+                    getattr(args, 'workers_per_job', 2), args.tracer)
+
+
+def command_queue_add(args, output):
+    queue = open_queue(args)
+    if args.metadata_image and len(args.devices) > 1:
+        output.progress("--metadata-image only fits a single device")
+        return EXIT_USAGE
+    pattern = ';'.join(args.pattern)
+    records = []
+    for device in args.devices:
+        destination = args.destination
+        # Several devices each restore into their own subdirectory
+        if destination and len(args.devices) > 1:
+            destination = os.path.join(destination, os.path.basename(device.rstrip('/')))
+        job = queue.add(os.path.abspath(device), pattern=pattern, recovery_type=args.type, depth=args.depth,
+                        min_generation=args.min_generation, destination=destination and os.path.abspath(destination),
+                        metadata_image=args.metadata_image and os.path.abspath(args.metadata_image),
+                        use_sudo=args.sudo, priority=args.priority)
+        records.append(job.to_dict())
+        output.event({'event': 'job', **records[-1]})
+    output.result(records, [f"Added job {record['id']} for {record['device']}" for record in records])
+    return EXIT_OK
+
+
+def command_queue_list(args, output):
+    queue = open_queue(args)
+    jobs = queue.snapshot()
+    summary = queue.summary()
+    for job in jobs:
+        output.event({'event': 'job', **job})
+    output.event({'event': 'summary', **summary})
+    output.result({'jobs': jobs, 'summary': summary}, [job_line(job) for job in jobs] + [summary_line(summary)])
+    return EXIT_OK
+
+
+def command_queue_change(args, output):
+    queue = open_queue(args)
+    if args.queue_command == 'priority':
+        queue.set_priority(args.id, args.priority)
+    elif args.queue_command == 'cancel':
+        queue.cancel(args.id)
+    elif args.queue_command == 'retry':
+        queue.retry(args.id)
+    else:
+        queue.remove(args.id)
+        output.result({'removed': args.id}, [f"Removed job {args.id}"])
+        return EXIT_OK
+    job = next(job for job in queue.snapshot() if job['id'] == args.id)
+    output.result(job, [job_line(job)])
+    return EXIT_OK
+
+
+def command_queue_run(args, output):
+    # Runs queued jobs until none are left. The first Ctrl-C stops the running stages and
+    # puts their jobs back in the queue for the next run.
+    queue = open_queue(args)
+    queue.on_change = lambda: output.event({'event': 'summary', **queue.summary()})
+
+    def interrupt(signum, frame):
+        signal.signal(signal.SIGINT, previous)
+        output.progress("Stopping, the running jobs stay queued; press Ctrl-C again to abort")
+        queue.interrupt()
+
+    previous = signal.signal(signal.SIGINT, interrupt)
+    try:
+        queue.start()
+        while not queue.wait(args.interval):
+            # So 'queue list' in another shell sees recent progress
+            queue.save()
+            output.progress(summary_line(queue.summary()))
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    jobs = queue.snapshot()
+    summary = queue.summary()
+    output.result({'jobs': jobs, 'summary': summary}, [job_line(job) for job in jobs] + [summary_line(summary)])
+    return EXIT_ERROR if any(job['state'] == FAILED for job in jobs) else EXIT_OK
+
+
+def command_daemon(args, output):
+    daemon = RecoveryDaemon(args.socket, args.max_tasks, args.jobs, args.sudo, args.tracer)
+    output.progress(f"Listening on {daemon.socket_path}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=daemon.shutdown).start())
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        daemon.shutdown()
+    return EXIT_OK
+
+
+def command_gui(args, output):
+    import btrfs_gui_restore
+    return btrfs_gui_restore.main()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m btrfs_restore_cli',
+                                     description="List and restore deleted files from btrfs filesystems.")
+    parser.add_argument('--format', '-f', choices=['text', 'json', 'ndjson'], default='text')
+    parser.add_argument('--quiet', '-q', action='store_true', help="no progress messages on stderr")
+    parser.add_argument('--verbose', '-v', action='store_true', help="copy btrfs-progs output to stderr")
+    parser.add_argument('--trace', metavar='FILE', help="write per-phase timings and subprocess resource usage")
+    parser.add_argument('--trace-format', choices=['json', 'chrome'], default='json',
+                        help="json summary and spans, or Chrome trace events")
+    parser.add_argument('--daemon', action='store_true',
+                        help="have the recovery daemon run roots, list and restore and keep their results")
+    parser.add_argument('--socket', metavar='PATH',
+                        help="the daemon's socket (default: per user, see the daemon command)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    devices = commands.add_parser('devices', help="list btrfs partitions")
+    devices.set_defaults(handler=command_devices)
+
+    capture = commands.add_parser('capture', help="copy the filesystem metadata into an image for --metadata-image")
+    capture.add_argument('--device', '-d', required=True, help="btrfs device")
+    capture.add_argument('--output', '-o', required=True, help="image file to write")
+    capture.add_argument('--method', choices=CAPTURE_METHODS,
+                         help="built-in copier (default) or btrfs-image, which leaves out the old tree roots "
+                              "deleted files are found in")
+    capture.add_argument('--sudo', action='store_true', help="read the device through sudo")
+    capture.add_argument('--unmount', action='store_true', help="unmount the device first")
+    capture.set_defaults(handler=command_capture)
+
+    roots = commands.add_parser('roots', help="list tree roots without scanning them")
+    add_scan_arguments(roots)
+    roots.set_defaults(handler=command_roots)
+
+    listing = commands.add_parser('list', help="list deleted files")
+    add_scan_arguments(listing)
+    listing.set_defaults(handler=command_list)
+
+    restore = commands.add_parser('restore', help="list deleted files and restore all matches")
+    add_scan_arguments(restore)
+    restore.add_argument('--destination', '-o', default=DEFAULT_DESTINATION)
+    restore.add_argument('--journal', metavar='FILE',
+                         help="job journal; rerunning with the same one resumes the job "
+                              "(default: .btrfs-restore-journal.jsonl in the destination)")
+    restore.add_argument('--no-journal', action='store_true', help="restore everything without recording it")
+    restore.add_argument('--max-read-mib', type=float, metavar='MIB',
+                         help="restore at most this many MiB of file data per second")
+    restore.add_argument('--max-files-per-sec', type=float, metavar='N', help="restore at most N files per second")
+    restore.add_argument('--no-space-check', action='store_true',
+                         help="don't check the destination's free space first")
+    restore.set_defaults(handler=command_restore)
+
+    versions = commands.add_parser('versions', help="stage every version of the matches and group identical ones")
+    add_scan_arguments(versions)
+    versions.add_argument('--staging', '-o', required=True,
+                          help="directory for the staged versions, one subdirectory per root")
+    versions.set_defaults(handler=command_versions)
+
+    queue = commands.add_parser('queue', help="queue jobs over many devices or images and run them")
+    queue.add_argument('--queue', metavar='FILE',
+                       help="queue file (default: ~/.local/state/btrfs-restore-gui/jobs.json)")
+    queue_commands = queue.add_subparsers(dest='queue_command', required=True)
+    add = queue_commands.add_parser('add', help="add a job per device")
+    add.add_argument('devices', nargs='+', metavar='DEVICE', help="btrfs devices or image files")
+    add.add_argument('--type', '-t', choices=RECOVERY_TYPES, default='everything')
+    add.add_argument('--pattern', '-p', action='append', default=[], help="as for list")
+    add.add_argument('--depth', choices=list(SEARCH_DEPTHS), default='Deep')
+    add.add_argument('--min-generation', type=int, help="only use roots at or above this generation")
+    add.add_argument('--metadata-image', metavar='IMAGE', help="scan this image instead of the (single) device")
+    add.add_argument('--destination', '-o',
+                     help="restore the matches here, into a subdirectory per device when there are several; "
+                          "without it the job only lists them")
+    add.add_argument('--priority', type=int, default=0, help="higher runs first")
+    add.add_argument('--sudo', action='store_true', help="run btrfs-progs through sudo")
+    add.set_defaults(handler=command_queue_add)
+    listing = queue_commands.add_parser('list', help="show the jobs and their progress")
+    listing.set_defaults(handler=command_queue_list)
+    for name, help in (('priority', "change a job's priority"), ('cancel', "cancel a job"),
+                       ('retry', "queue a failed or cancelled job again"), ('remove', "remove a job")):
+        change = queue_commands.add_parser(name, help=help)
+        change.add_argument('id', type=int)
+        if name == 'priority':
+            change.add_argument('priority', type=int)
+        change.set_defaults(handler=command_queue_change)
+    run = queue_commands.add_parser('run', help="run the queued jobs until none are left")
+    run.add_argument('--max-jobs', type=int, default=2, help="stages running at once")
+    run.add_argument('--per-disk', type=int, default=1, help="stages reading the same physical disk at once")
+    run.add_argument('--workers-per-job', type=int, default=2, help="roots or batches each stage runs in parallel")
+    run.add_argument('--interval', type=float, default=5, metavar='SECONDS', help="progress message interval")
+    run.set_defaults(handler=command_queue_run)
+
+    daemon = commands.add_parser('daemon', help="serve scans and restores on a Unix socket, usually under sudo")
+    daemon.add_argument('--max-tasks', type=int, default=2, help="scans and restores running at once")
+    daemon.add_argument('--jobs', '-j', type=int,
+                        help="roots or batches each task runs in parallel (default: CPU count)")
+    daemon.add_argument('--sudo', action='store_true', help="run btrfs-progs through sudo when not started as root")
+    daemon.set_defaults(handler=command_daemon)
+
+    gui = commands.add_parser('gui', help="start the graphical interface")
+    gui.set_defaults(handler=command_gui)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if hasattr(args, 'load'):
+        if not args.device and not args.load:
+            parser.error("the following arguments are required: --device/-d")
+        if args.load and args.daemon:
+            parser.error("--load uses the saved scan in this process and can't be combined with --daemon")
+    # Paths that aren't valid UTF-8 are written back out as the original bytes
+    sys.stdout.reconfigure(errors='surrogateescape')
+    output = Output(args.format, args.quiet)
+    args.tracer = Tracer()
+    try:
+        return args.handler(args, output)
+    except KeyboardInterrupt:
+        output.progress("Interrupted")
+        return EXIT_ERROR
+    except Exception as e:
+        output.progress(f"Error: {str(e)}")
+        return EXIT_ERROR
+    finally:
+        if args.trace:
+            args.tracer.save(args.trace, args.trace_format)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+import bisect
+from array import array
+
+# Result store for a multi-root listing. Every distinct path is stored once and known by
+# an integer id; each root keeps the ids it listed as a sorted array, so a path found in
+# 300 roots costs one string plus 300 array slots instead of 300 set entries. The newest
+# root listing each path is tracked as roots are added, which makes root_for() a single
+# lookup when choosing where to restore from.
+
+
+def file_record(path, results, metadata, patterns=None):
+    # One listed file as the CLI, job queue and daemon report it
+    size, mtime, generation = metadata.get(path, (None, None, None))
+    return {'path': path, 'size': size, 'mtime': mtime, 'generation': generation,
+            'root': results.root_for(path), 'pattern': patterns.tag(path) if patterns else None}
+
+
+class ScanResults:
+    def __init__(self):
+        self.paths = []             # id -> path
+        self.ids = {}               # path -> id
+        self.newest = array('i')    # id -> index of the newest root listing the path
+        self.root_names = []        # index -> root
+        self.generations = []       # index -> generation, or None if unknown
+        self.members = []           # index -> sorted array of path ids
+        self.root_index = {}        # root -> index
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __contains__(self, path):
+        return path in self.ids
+
+    def add_root(self, root, generation, files):
+        # Returns the paths no earlier root listed. Between roots of the same generation
+        # the one added first wins, as when sorting the roots newest first.
+        index = len(self.root_names)
+        self.root_names.append(root)
+        self.generations.append(generation)
+        self.root_index[root] = index
+        rank = generation or 0
+        known, paths, newest, generations = self.ids, self.paths, self.newest, self.generations
+        new_files = []
+        ids = []
+        for path in files:
+            path_id = known.get(path)
+            if path_id is None:
+                path_id = len(paths)
+                known[path] = path_id
+                paths.append(path)
+                newest.append(index)
+                new_files.append(path)
+            elif rank > (generations[newest[path_id]] or 0):
+                newest[path_id] = index
+            ids.append(path_id)
+        ids.sort()
+        self.members.append(array('I', ids))
+        return new_files
+
+    def roots(self):
+        # Roots that listed at least one path, newest generation first
+        order = sorted(range(len(self.root_names)), key=lambda index: -(self.generations[index] or 0))
+        return [self.root_names[index] for index in order]
+
+    def generation(self, root):
+        return self.generations[self.root_index[root]]
+
+    def count(self, root):
+        return len(self.members[self.root_index[root]])
+
+    def files(self, root):
+        return [self.paths[path_id] for path_id in self.members[self.root_index[root]]]
+
+    def root_for(self, path):
+        # Newest root listing path, or None
+        path_id = self.ids.get(path)
+        if path_id is None:
+            return None
+        return self.root_names[self.newest[path_id]]
+
+    def roots_for(self, path):
+        # Every root listing path, newest generation first
+        path_id = self.ids.get(path)
+        if path_id is None:
+            return []
+        found = []
+        for root in self.roots():
+            members = self.members[self.root_index[root]]
+            position = bisect.bisect_left(members, path_id)
+            if position < len(members) and members[position] == path_id:
+                found.append(root)
+        return found
+
+    def group_by_root(self, paths):
+        # {root: [paths]} with each path under its newest root, roots newest first
+        groups = {root: [] for root in self.roots()}
+        for path in paths:
+            path_id = self.ids.get(path)
+            if path_id is not None:
+                groups[self.root_names[self.newest[path_id]]].append(path)
+        return {root: files for root, files in groups.items() if files}
+
+    def head(self, count):
+        # The first count paths found, as a new ScanResults holding only the roots that
+        # list any of them. Ids are handed out in order, so each root's ids below count
+        # are the start of its sorted array.
+        kept = []
+        index_map = {}
+        for index, members in enumerate(self.members):
+            members = members[:bisect.bisect_left(members, count)]
+            if members:
+                index_map[index] = len(kept)
+                kept.append((self.root_names[index], self.generations[index], members))
+        return ScanResults.from_parts(self.paths[:count], [index_map[index] for index in self.newest[:count]], kept)
+
+    def export(self):
+        # Plain lists for JSON: the paths by id and every root, in the order they were
+        # added, with the ids it listed. from_export() rebuilds the same ids and newest roots.
+        return {'paths': self.paths,
+                'roots': [[root, generation, members.tolist()]
+                          for root, generation, members in zip(self.root_names, self.generations, self.members)]}
+
+    @classmethod
+    def from_parts(cls, paths, newest, roots):
+        # Straight from stored columns: paths by id, the index of each path's newest root,
+        # and [(root, generation, sorted array('I') of ids)] in the order they were added
+        results = cls()
+        results.paths = paths
+        results.ids = dict(zip(paths, range(len(paths))))
+        results.newest = array('i', newest)
+        for index, (root, generation, members) in enumerate(roots):
+            results.root_names.append(root)
+            results.generations.append(generation)
+            results.members.append(members)
+            results.root_index[root] = index
+        return results
+
+    @classmethod
+    def from_export(cls, data):
+        results = cls()
+        paths = data['paths']
+        for root, generation, ids in data['roots']:
+            results.add_root(root, generation, [paths[path_id] for path_id in ids])
+        return results
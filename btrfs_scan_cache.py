@@ -0,0 +1,195 @@
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import threading
+import time
+import zlib
+
+from btrfs_ondisk import SUPERBLOCK_OFFSETS, SUPERBLOCK_SIZE, format_uuid, parse_superblock
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Bumped whenever cached scan results would differ from a fresh scan; version 1 stored
+# paths cut off at the first space.
+CACHE_VERSION = 2
+
+
+def default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'btrfs-restore-gui', 'scan-cache.sqlite3')
+
+
+def filesystem_identity(device, use_sudo=False):
+    # Returns (fsid, superblock generation) of the primary superblock, or None if it can't be read
+    try:
+        with open(device, 'rb') as f:
+            f.seek(SUPERBLOCK_OFFSETS[0])
+            sb = parse_superblock(f.read(SUPERBLOCK_SIZE), SUPERBLOCK_OFFSETS[0])
+        return (format_uuid(sb.fsid), sb.generation) if sb else None
+    except PermissionError:
+        if not use_sudo:
+            return None
+
+    result = subprocess.run(['sudo', 'btrfs', 'inspect-internal', 'dump-super', device],
+                            capture_output=True, text=True)
+    fsid = re.search(r'^fsid\s+(\S+)', result.stdout, re.MULTILINE)
+    generation = re.search(r'^generation\s+(\d+)', result.stdout, re.MULTILINE)
+    if result.returncode != 0 or not fsid or not generation:
+        return None
+    return fsid.group(1), int(generation.group(1))
+
+
+class ScanCache:
+    # Remembers btrfs-find-root output, per-root 'btrfs restore -D' file sets and per-root
+    # inode metadata for one filesystem. Everything cached for a filesystem is dropped as
+    # soon as its superblock generation changes, and the least recently used entries are
+    # evicted once they exceed max_bytes.
+
+    def __init__(self, fsid, generation, path=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.fsid = fsid
+        self.generation = generation
+        self.path = path or default_cache_path()
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS filesystems (
+                fsid TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS roots (
+                fsid TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                root TEXT NOT NULL,
+                root_generation INTEGER,
+                PRIMARY KEY (fsid, position)
+            );
+            CREATE TABLE IF NOT EXISTS scans (
+                fsid TEXT NOT NULL,
+                root TEXT NOT NULL,
+                path_regex TEXT NOT NULL,
+                files BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (fsid, root, path_regex)
+            );
+            CREATE INDEX IF NOT EXISTS scans_last_used ON scans (last_used);
+            CREATE TABLE IF NOT EXISTS metadata (
+                fsid TEXT NOT NULL,
+                root TEXT NOT NULL,
+                inodes BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (fsid, root)
+            );
+        ''')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+            self.db.execute('DELETE FROM scans')
+            self.db.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+        self.invalidate_if_changed()
+
+    @classmethod
+    def for_device(cls, device, use_sudo=False, **kwargs):
+        identity = filesystem_identity(device, use_sudo)
+        if identity is None:
+            return None
+        return cls(*identity, **kwargs)
+
+    def invalidate_if_changed(self):
+        with self.lock:
+            row = self.db.execute('SELECT generation FROM filesystems WHERE fsid = ?', (self.fsid,)).fetchone()
+            if row and row[0] == self.generation:
+                return
+            self.db.execute('BEGIN')
+            self.db.execute('DELETE FROM roots WHERE fsid = ?', (self.fsid,))
+            self.db.execute('DELETE FROM scans WHERE fsid = ?', (self.fsid,))
+            self.db.execute('DELETE FROM metadata WHERE fsid = ?', (self.fsid,))
+            self.db.execute('INSERT OR REPLACE INTO filesystems (fsid, generation) VALUES (?, ?)',
+                            (self.fsid, self.generation))
+            self.db.execute('COMMIT')
+
+    def get_roots(self):
+        # Returns [(root, generation)] in btrfs-find-root order, or None if never stored
+        with self.lock:
+            rows = self.db.execute('SELECT root, root_generation FROM roots WHERE fsid = ? ORDER BY position',
+                                   (self.fsid,)).fetchall()
+        return rows or None
+
+    def put_roots(self, roots):
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.execute('DELETE FROM roots WHERE fsid = ?', (self.fsid,))
+            self.db.executemany('INSERT INTO roots (fsid, position, root, root_generation) VALUES (?, ?, ?, ?)',
+                                [(self.fsid, position, root, generation)
+                                 for position, (root, generation) in enumerate(roots)])
+            self.db.execute('COMMIT')
+
+    def get_files(self, root, path_regex):
+        with self.lock:
+            row = self.db.execute('SELECT files FROM scans WHERE fsid = ? AND root = ? AND path_regex = ?',
+                                  (self.fsid, root, path_regex)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE scans SET last_used = ? WHERE fsid = ? AND root = ? AND path_regex = ?',
+                            (time.time(), self.fsid, root, path_regex))
+        data = zlib.decompress(row[0]).decode('utf-8', 'surrogateescape')
+        # Paths can't contain NUL, so it is a safe separator
+        return set(data.split('\0')) if data else set()
+
+    def put_files(self, root, path_regex, files):
+        data = zlib.compress('\0'.join(sorted(files)).encode('utf-8', 'surrogateescape'))
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.execute('INSERT OR REPLACE INTO scans (fsid, root, path_regex, files, size, last_used) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (self.fsid, root, path_regex, data, len(data), time.time()))
+            self.evict()
+            self.db.execute('COMMIT')
+
+    def get_metadata(self, root):
+        # Returns {path: (size, mtime)} for the filesystem tree under root, or None
+        with self.lock:
+            row = self.db.execute('SELECT inodes FROM metadata WHERE fsid = ? AND root = ?',
+                                  (self.fsid, root)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE metadata SET last_used = ? WHERE fsid = ? AND root = ?',
+                            (time.time(), self.fsid, root))
+        return {path: tuple(info) for path, info in json.loads(zlib.decompress(row[0])).items()}
+
+    def put_metadata(self, root, inodes):
+        data = zlib.compress(json.dumps(inodes).encode())
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.execute('INSERT OR REPLACE INTO metadata (fsid, root, inodes, size, last_used) '
+                            'VALUES (?, ?, ?, ?, ?)', (self.fsid, root, data, len(data), time.time()))
+            self.evict()
+            self.db.execute('COMMIT')
+
+    def evict(self):
+        total = self.db.execute('SELECT (SELECT COALESCE(SUM(size), 0) FROM scans) + '
+                                '(SELECT COALESCE(SUM(size), 0) FROM metadata)').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        entries = self.db.execute("SELECT 'scans', rowid, size, last_used FROM scans UNION ALL "
+                                  "SELECT 'metadata', rowid, size, last_used FROM metadata "
+                                  "ORDER BY last_used").fetchall()
+        for table, rowid, size, _ in entries:
+            self.db.execute(f'DELETE FROM {table} WHERE rowid = ?', (rowid,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.execute('DELETE FROM roots WHERE fsid = ?', (self.fsid,))
+            self.db.execute('DELETE FROM scans WHERE fsid = ?', (self.fsid,))
+            self.db.execute('DELETE FROM metadata WHERE fsid = ?', (self.fsid,))
+            self.db.execute('COMMIT')
+
+    def close(self):
+        self.db.close()
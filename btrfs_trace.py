@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-phase timing for listings and restores. Spans are recorded from any thread; each
+# has a name, a category (capture, discovery, triage, scan, metadata, restore, gui), a start
+# relative to the tracer's creation, a duration and a dict of extra values such as lines
+# parsed and the resource usage of the subprocess the span waited for.
+
+CATEGORIES = ['capture', 'discovery', 'triage', 'scan', 'metadata', 'restore', 'gui']
+
+
+def read_proc_io(pid):
+    # Bytes the process and its reaped children caused to be read from storage, or None
+    # if /proc/<pid>/io isn't readable (another user's process, e.g. under sudo)
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            fields = dict(line.split(': ', 1) for line in f.read().splitlines())
+        return int(fields['read_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def wait_process(process):
+    # Waits for process like Popen.wait() and returns
+    # {cpu_seconds, max_rss_kb, read_bytes} for it. The child is left unreaped until
+    # /proc/<pid>/io has been read, then reaped with wait4 for its rusage.
+    try:
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        read_bytes = read_proc_io(process.pid)
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # Already reaped, e.g. by a concurrent poll()
+        process.wait()
+        return {}
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {'cpu_seconds': usage.ru_utime + usage.ru_stime, 'max_rss_kb': usage.ru_maxrss,
+            'read_bytes': read_bytes}
+
+
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.origin = time.monotonic()
+
+    @contextmanager
+    def span(self, name, category, **values):
+        # Yields the values dict so the block can add to it
+        started = time.monotonic()
+        try:
+            yield values
+        finally:
+            self.add(name, category, started, time.monotonic() - started, **values)
+
+    def add(self, name, category, started, seconds, **values):
+        span = {'name': name, 'category': category, 'start': started - self.origin, 'seconds': seconds,
+                'thread': threading.current_thread().name, 'values': values}
+        with self.lock:
+            self.spans.append(span)
+
+    def clear(self):
+        with self.lock:
+            self.spans = []
+            self.origin = time.monotonic()
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.spans)
+
+    def summary(self):
+        # {category: {spans, seconds, cpu_seconds, max_rss_kb, read_bytes, lines}}
+        totals = {}
+        for span in self.snapshot():
+            total = totals.setdefault(span['category'], {'spans': 0, 'seconds': 0.0, 'cpu_seconds': 0.0,
+                                                         'max_rss_kb': 0, 'read_bytes': 0, 'lines': 0})
+            values = span['values']
+            total['spans'] += 1
+            total['seconds'] += span['seconds']
+            total['cpu_seconds'] += values.get('cpu_seconds') or 0.0
+            total['max_rss_kb'] = max(total['max_rss_kb'], values.get('max_rss_kb') or 0)
+            total['read_bytes'] += values.get('read_bytes') or 0
+            total['lines'] += values.get('lines') or 0
+        order = {category: position for position, category in enumerate(CATEGORIES)}
+        return dict(sorted(totals.items(), key=lambda item: order.get(item[0], len(order))))
+
+    def slowest(self, count=10, category=None):
+        spans = [span for span in self.snapshot() if category is None or span['category'] == category]
+        return sorted(spans, key=lambda span: span['seconds'], reverse=True)[:count]
+
+    def to_json(self):
+        return {'summary': self.summary(), 'spans': self.snapshot()}
+
+    def to_chrome_trace(self):
+        # Trace Event Format, for chrome://tracing or Perfetto
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for span in self.snapshot():
+            tid = threads.setdefault(span['thread'], len(threads) + 1)
+            events.append({'name': span['name'], 'cat': span['category'], 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': round(span['start'] * 1e6), 'dur': round(span['seconds'] * 1e6),
+                           'args': span['values']})
+        for name, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path, fmt='json'):
+        document = self.to_chrome_trace() if fmt == 'chrome' else self.to_json()
+        with open(path, 'w') as f:
+            json.dump(document, f, indent=None if fmt == 'chrome' else 2)
+            f.write('\n')
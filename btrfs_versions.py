@@ -0,0 +1,157 @@
+import fcntl
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from btrfs_engine import RestoreEngine, chunk_restore_paths, no_op
+from btrfs_journal import content_hash
+
+# Every version of a set of deleted paths, one per root that lists them. Each root's
+# versions are restored into its own directory of a staging area with one 'btrfs
+# restore' per batch, hashed, and versions with the same bytes are collapsed: the copies
+# after the first (newest) are replaced by a reflink of it where the filesystem supports
+# that and by a hard link otherwise, so the staging area holds each distinct version
+# once. restore_version() then copies the chosen one to its destination.
+
+# ioctl(dest_fd, FICLONE, src_fd) shares src's extents with dest (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def reflink(source, target):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_duplicate(source, target):
+    # Replaces target with a reflink or hard link of source; returns how, or None if
+    # target was left as a separate copy
+    temporary = target + '.dedup'
+    for method, link in (('reflink', reflink), ('hardlink', os.link)):
+        try:
+            link(source, temporary)
+        except OSError:
+            if os.path.lexists(temporary):
+                os.remove(temporary)
+            continue
+        os.replace(temporary, target)
+        return method
+    return None
+
+
+def clone_or_copy(source, target):
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    try:
+        reflink(source, target)
+        shutil.copystat(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+class Version:
+    # One distinct content of a path: every (root, generation) holding it, newest first,
+    # and the staged copy of the newest
+    def __init__(self, digest, size, staged):
+        self.digest = digest
+        self.size = size
+        self.staged = staged
+        self.roots = []
+
+    def to_dict(self):
+        return {'digest': self.digest, 'size': self.size, 'staged': self.staged,
+                'roots': [{'root': root, 'generation': generation} for root, generation in self.roots]}
+
+
+class VersionCollector:
+    # Stages and deduplicates every version of paths listed in results (a ScanResults).
+    # Callbacks, called from any thread:
+    #   on_progress(message)
+    #   on_stage_progress(batches done, batches total)
+
+    def __init__(self, device, staging, results, paths, use_sudo=True, max_workers=None, log_channel=None,
+                 tracer=None):
+        self.on_progress = no_op
+        self.on_stage_progress = no_op
+        self.staging = staging
+        self.results = results
+        self.paths = list(paths)
+        self.restorer = RestoreEngine(device, staging, {}, use_sudo, max_workers, log_channel, tracer)
+        self.tracer = self.restorer.tracer
+
+    def run(self):
+        # Returns {path: [Version]}, newest version first, and {bytes staged, bytes linked}
+        wanted = {}
+        for path in self.paths:
+            for root in self.results.roots_for(path):
+                wanted.setdefault(root, []).append(path)
+        self.stage(wanted)
+        return self.collapse()
+
+    def root_directory(self, root):
+        return os.path.join(self.staging, root)
+
+    def stage(self, wanted):
+        batches = [(root, chunk) for root, paths in wanted.items() for chunk in chunk_restore_paths(paths)]
+        self.on_progress(f"Staging {sum(len(paths) for paths in wanted.values())} versions of {len(self.paths)} "
+                         f"files from {len(wanted)} roots in {len(batches)} batches")
+        for root in wanted:
+            os.makedirs(self.root_directory(root), exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.restorer.max_workers) as pool:
+            futures = [pool.submit(self.restorer.restore_batch, root, paths, self.root_directory(root))
+                       for root, paths in batches]
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                self.on_stage_progress(done, len(batches))
+        if self.restorer.use_sudo and os.geteuid() != 0:
+            for root in wanted:
+                self.take_ownership(self.root_directory(root))
+
+    def take_ownership(self, directory):
+        # Versions restored through sudo belong to root, and we may not link to files we
+        # don't own (fs.protected_hardlinks), so duplicates would all be kept as copies.
+        # Only files root owns are handed over.
+        command = ['sudo', 'chown', '-R', '--from=0', f"{os.getuid()}:{os.getgid()}", directory]
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            self.on_progress(f"Warning: could not take ownership of {directory} "
+                             f"({result.stderr.decode('utf-8', 'replace').strip()}), identical versions may be "
+                             f"kept as separate copies")
+
+    def collapse(self):
+        versions = {}
+        totals = {'bytes_staged': 0, 'bytes_linked': 0, 'linked': {}}
+        with self.tracer.span('deduplicate versions', 'restore', paths=len(self.paths)) as span:
+            for path in self.paths:
+                by_digest = {}
+                for root in self.results.roots_for(path):
+                    staged = os.path.join(self.root_directory(root), path)
+                    # Roots whose restore failed for this path have nothing staged
+                    if not os.path.isfile(staged) or os.path.islink(staged):
+                        continue
+                    size = os.path.getsize(staged)
+                    digest = content_hash(staged)
+                    version = by_digest.get(digest)
+                    if version is None:
+                        version = by_digest[digest] = Version(digest, size, staged)
+                        totals['bytes_staged'] += size
+                    else:
+                        method = link_duplicate(version.staged, staged)
+                        if method:
+                            totals['bytes_linked'] += size
+                            totals['linked'][method] = totals['linked'].get(method, 0) + 1
+                        else:
+                            totals['bytes_staged'] += size
+                    version.roots.append((root, self.results.generation(root)))
+                versions[path] = list(by_digest.values())
+            span.update(totals, versions=sum(len(found) for found in versions.values()))
+        distinct = sum(len(found) for found in versions.values())
+        self.on_progress(f"{distinct} distinct versions of {len(self.paths)} files, "
+                         f"{totals['bytes_linked']} duplicate bytes linked instead of kept")
+        return versions, totals
+
+
+def restore_version(version, destination, path):
+    # Copies a staged version to destination/path, sharing its extents where possible
+    target = os.path.join(destination, path)
+    clone_or_copy(version.staged, target)
+    return target
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+# The modules live in the repository root, next to this directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FAKEBIN = os.path.join(ROOT, 'benchmarks', 'fakebin')
+
+
+@pytest.fixture
+def fake_btrfs(tmp_path, monkeypatch):
+    # The stand-in btrfs-progs from benchmarks/fakebin on PATH, with 4 roots over 40
+    # paths, and a device image that isn't btrfs, so roots come from btrfs-find-root.
+    # Returns the device; tests change BENCH_* with monkeypatch.setenv.
+    monkeypatch.setenv('PATH', FAKEBIN + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('BENCH_ROOTS', '4')
+    monkeypatch.setenv('BENCH_PATHS', '40')
+    monkeypatch.delenv('BENCH_LINE_DELAY', raising=False)
+    monkeypatch.delenv('BENCH_REPLAY_DIR', raising=False)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    device = tmp_path / 'device.img'
+    device.write_bytes(b'\0' * 4096)
+    return str(device)
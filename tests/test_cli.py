@@ -0,0 +1,37 @@
+import json
+import os
+import threading
+
+import pytest
+
+import btrfs_restore_cli
+from btrfs_daemon import RecoveryDaemon
+
+# The CLI against a real daemon on a temporary socket, with the stand-in btrfs-progs
+# (see conftest), so nothing here needs btrfs or root.
+
+
+@pytest.fixture
+def daemon(tmp_path, fake_btrfs):
+    daemon = RecoveryDaemon(socket_path=str(tmp_path / 'daemon.sock'), max_workers=2)
+    thread = threading.Thread(target=daemon.serve, daemon=True)
+    thread.start()
+    while not os.path.exists(daemon.socket_path):
+        thread.join(0.01)
+    yield daemon
+    daemon.shutdown()
+    thread.join(5)
+    daemon.pool.shutdown()
+
+
+@pytest.mark.parametrize('journal', [[], ['--no-journal']])
+def test_daemon_restore(daemon, fake_btrfs, tmp_path, capsys, journal):
+    destination = tmp_path / 'restored'
+    code = btrfs_restore_cli.main(['--daemon', '--socket', daemon.socket_path, '--quiet', '--format', 'json',
+                                   'restore', '--device', fake_btrfs, '--destination', str(destination),
+                                   '--no-cache', '--no-triage'] + journal)
+    result = json.loads(capsys.readouterr().out)
+    assert code == btrfs_restore_cli.EXIT_OK
+    assert result['selected'] == 40 and result['restored'] == 40
+    assert ('failed' in result) == (not journal)
+    assert (destination / '.btrfs-restore-journal.jsonl').exists() == (not journal)
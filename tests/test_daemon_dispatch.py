@@ -0,0 +1,142 @@
+import pytest
+
+import btrfs_daemon
+from btrfs_daemon import (DONE, ERROR_FAILED, ERROR_INTERNAL, ERROR_METHOD, ERROR_PARAMS, RUNNING, RecoveryDaemon,
+                          Task)
+from btrfs_engine import PathPatterns
+from btrfs_index import PathIndex
+from btrfs_results import ScanResults
+
+# RecoveryDaemon.dispatch() without a socket: a finished scan is put in place by hand, so
+# nothing here touches a device.
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    daemon = RecoveryDaemon(socket_path=str(tmp_path / 'daemon.sock'))
+    yield daemon
+    daemon.pool.shutdown()
+
+
+@pytest.fixture
+def scan(daemon):
+    results = ScanResults()
+    results.add_root('256', 7, ['home/a.txt', 'home/b.sql'])
+    results.add_root('300', 9, ['home/a.txt', 'srv/c.txt'])
+    metadata = {'home/a.txt': (10, 1.0, 9), 'srv/c.txt': (5, 2.0, 9)}
+    task = daemon.new_task('scan', {'device': '/dev/sdx'})
+    task.device = '/dev/sdx'
+    task.results = results
+    task.metadata = metadata
+    task.patterns = PathPatterns.parse('', 'everything')
+    task.index = PathIndex(list(results), metadata)
+    task.emit('progress', message='Listing')
+    task.emit('files', paths=list(results))
+    task.finish(DONE, {'files': 3, 'roots': 2})
+    return task
+
+
+def call(daemon, method, params=None, notify=None):
+    response = daemon.dispatch(method, {} if params is None else params, 7, notify or (lambda event: None))
+    assert response['jsonrpc'] == '2.0' and response['id'] == 7
+    return response
+
+
+def error_code(response):
+    assert 'result' not in response
+    return response['error']['code']
+
+
+def test_unknown_method(daemon):
+    assert error_code(call(daemon, 'shutdown')) == ERROR_METHOD
+    # Python methods that aren't in METHODS can't be reached either
+    assert error_code(call(daemon, 'new_task', {'kind': 'scan', 'params': {}})) == ERROR_METHOD
+
+
+@pytest.mark.parametrize('params', [['scan'], 'scan', None, {'scan': 1, 'unknown': True}, {}, {'notify': 1}])
+def test_bad_params(daemon, scan, params):
+    response = daemon.dispatch('query', params, 7, lambda event: None)
+    assert error_code(response) == ERROR_PARAMS
+
+
+def test_failures_are_reported(daemon, scan):
+    response = call(daemon, 'query', {'scan': 99})
+    assert error_code(response) == ERROR_FAILED
+    assert response['error']['message'] == "There is no scan 99"
+    assert error_code(call(daemon, 'forget', {'task': 99})) == ERROR_FAILED
+
+
+def test_bugs_are_internal_errors(daemon, scan, monkeypatch, capsys):
+    def broken(notify, scan):
+        return 1 / 0
+
+    monkeypatch.setattr(daemon, 'rpc_results', broken)
+    response = call(daemon, 'results', {'scan': scan.id})
+    assert error_code(response) == ERROR_INTERNAL
+    assert response['error']['message'].startswith('Internal error: ')
+    assert 'ZeroDivisionError' in capsys.readouterr().err
+
+
+def test_query(daemon, scan):
+    result = call(daemon, 'query', {'scan': scan.id, 'filter': '.txt'})['result']
+    assert result['total'] == 2
+    assert [record['path'] for record in result['files']] == ['home/a.txt', 'srv/c.txt']
+    assert result['files'][0]['root'] == '300' and result['files'][0]['size'] == 10
+    page = call(daemon, 'query', {'scan': scan.id, 'offset': 1, 'limit': 1})['result']
+    assert page['total'] == 3 and [record['path'] for record in page['files']] == ['home/b.sql']
+
+
+def test_children_and_results(daemon, scan):
+    children = call(daemon, 'children', {'scan': scan.id})['result']
+    assert children == {'directories': [{'name': 'home', 'files': 2, 'size': 10},
+                                        {'name': 'srv', 'files': 1, 'size': 5}], 'files': 0}
+    exported = call(daemon, 'results', {'scan': scan.id})['result']
+    rebuilt = ScanResults.from_export(exported)
+    assert rebuilt.group_by_root(rebuilt.paths) == scan.results.group_by_root(scan.results.paths)
+    assert exported['metadata'] == [(10, 1.0, 9), None, (5, 2.0, 9)]
+
+
+def test_running_scan_is_not_queryable(daemon):
+    task = daemon.new_task('scan', {})
+    response = call(daemon, 'query', {'scan': task.id})
+    assert error_code(response) == ERROR_FAILED
+    assert response['error']['message'] == f"Scan {task.id} is {RUNNING}"
+
+
+def test_subscribe_to_a_finished_task(daemon, scan):
+    events = []
+    result = call(daemon, 'subscribe', {'task': scan.id}, events.append)['result']
+    assert result['state'] == DONE and result['result'] == {'files': 3, 'roots': 2}
+    assert [event['event'] for event in events] == ['progress', 'files']
+    # Read to the end, so its events are let go and a late subscriber learns they were
+    assert len(scan.events) == 0
+    events.clear()
+    call(daemon, 'subscribe', {'task': scan.id}, events.append)
+    assert events == [{'task': scan.id, 'event': 'dropped', 'events': 2}]
+
+
+def test_subscribe_since(daemon, scan):
+    events = []
+    call(daemon, 'subscribe', {'task': scan.id, 'since': 1}, events.append)
+    assert [event['event'] for event in events] == ['files']
+
+
+def test_task_events_are_bounded(monkeypatch):
+    monkeypatch.setattr(btrfs_daemon, 'TASK_EVENTS', 3)
+    task = Task(1, 'scan', {})
+    for number in range(5):
+        task.emit('progress', number=number)
+    assert task.dropped == 2 and task.event_count() == 5
+    assert [event['number'] for event in task.events_since(0)] == [2, 3, 4]
+    assert [event['number'] for event in task.events_since(4)] == [4]
+    # A running task keeps what it has
+    task.trim()
+    assert len(task.events) == 3
+
+
+def test_forget(daemon, scan):
+    assert call(daemon, 'forget', {'task': scan.id})['result'] is True
+    assert call(daemon, 'tasks')['result'] == []
+    running = daemon.new_task('restore', {})
+    assert error_code(call(daemon, 'forget', {'task': running.id})) == ERROR_FAILED
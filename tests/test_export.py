@@ -0,0 +1,137 @@
+import json
+import sqlite3
+
+import pytest
+
+import btrfs_export
+from btrfs_engine import RecoveryError
+from btrfs_export import check_saved_scan, load_scan, save_scan, scan_info
+from btrfs_results import ScanResults
+
+UNDECODABLE = b'home/caf\xe9.txt'.decode('utf-8', 'surrogateescape')
+
+
+@pytest.fixture
+def scan():
+    results = ScanResults()
+    results.add_root('100', 5, ['home/a.txt', 'home/old.sql'])
+    results.add_root('300', 9, ['home/a.txt', UNDECODABLE, 'home/ünïcode'])
+    results.add_root('200', None, ['home/old.sql', 'var/log/x'])
+    metadata = {'home/a.txt': (12, 1700000000.5, 9), UNDECODABLE: (3, None, None)}
+    return results, metadata
+
+
+@pytest.fixture(autouse=True)
+def identity(monkeypatch):
+    # Every device is filesystem "fsid-1" at generation 42 unless a test changes it
+    known = {'identity': ('fsid-1', 42)}
+
+    def filesystem_identity(device, use_sudo=False):
+        if known['identity'] is None:
+            raise OSError("unreadable")
+        return known['identity']
+
+    monkeypatch.setattr(btrfs_export, 'filesystem_identity', filesystem_identity)
+    return known
+
+
+@pytest.mark.parametrize('name', ['scan.sqlite', 'scan.ndjson', 'scan.JSONL'])
+def test_round_trip(tmp_path, scan, name):
+    results, metadata = scan
+    info = scan_info(results, '/dev/sdx', pattern='*.txt', type='everything', depth='Deep')
+    path = str(tmp_path / name)
+    progress = []
+    save_scan(path, results, metadata, info, on_progress=lambda done, total: progress.append((done, total)))
+    assert progress[-1] == (5, 5)
+    assert not (tmp_path / (name + '.part')).exists()
+
+    loaded, loaded_metadata, loaded_info = load_scan(path)
+    assert loaded.paths == results.paths
+    assert loaded.root_names == results.root_names
+    assert loaded.generations == results.generations
+    assert [members.tolist() for members in loaded.members] == [members.tolist() for members in results.members]
+    for file in results:
+        assert loaded.root_for(file) == results.root_for(file)
+        assert loaded.roots_for(file) == results.roots_for(file)
+    assert loaded_metadata == metadata
+    assert loaded_info['fsid'] == 'fsid-1' and loaded_info['fs_generation'] == 42
+    assert loaded_info['pattern'] == '*.txt' and loaded_info['files'] == 5 and loaded_info['roots'] == 3
+
+
+def test_sqlite_is_queryable(tmp_path, scan):
+    results, metadata = scan
+    path = str(tmp_path / 'scan.db')
+    save_scan(path, results, metadata, scan_info(results, '/dev/sdx'))
+    db = sqlite3.connect(path)
+    try:
+        rows = db.execute('SELECT f.path, r.root FROM files f JOIN roots r ON f.root = r.position '
+                          'WHERE f.size IS NOT NULL ORDER BY f.id').fetchall()
+    finally:
+        db.close()
+    # Names that aren't UTF-8 are stored as their raw bytes
+    assert rows == [('home/a.txt', '300'), (b'home/caf\xe9.txt', '300')]
+
+
+def test_ndjson_records(tmp_path, scan):
+    results, metadata = scan
+    path = tmp_path / 'scan.ndjson'
+    save_scan(str(path), results, metadata, scan_info(results, '/dev/sdx'))
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [record['record'] for record in records] == ['scan'] + ['root'] * 3 + ['file'] * 5
+    old = next(record for record in records if record.get('path') == 'home/old.sql')
+    assert old['root'] == '100' and old['roots'] == ['100', '200']
+
+
+def test_empty_scan(tmp_path):
+    for name in ('empty.sqlite', 'empty.ndjson'):
+        path = str(tmp_path / name)
+        save_scan(path, ScanResults(), {}, scan_info(ScanResults(), '/dev/sdx'))
+        loaded, metadata, info = load_scan(path)
+        assert len(loaded) == 0 and metadata == {} and info['files'] == 0
+
+
+def test_not_a_saved_scan(tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_text('hello\n')
+    with pytest.raises(RecoveryError, match='not a saved scan'):
+        load_scan(str(path))
+    path.write_text('{"record": "root", "root": "1", "generation": 1, "files": 0}\n')
+    with pytest.raises(RecoveryError, match='no scan record'):
+        load_scan(str(path))
+
+
+def test_newer_format_is_refused(tmp_path, scan):
+    results, metadata = scan
+    path = str(tmp_path / 'scan.sqlite')
+    save_scan(path, results, metadata, {**scan_info(results, '/dev/sdx'), 'format_version': 99})
+    with pytest.raises(RecoveryError, match='newer version'):
+        load_scan(path)
+
+
+def test_failed_save_keeps_the_old_file(tmp_path, scan):
+    results, metadata = scan
+    path = tmp_path / 'scan.ndjson'
+    path.write_text('previous')
+
+    def fail(done, total):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        save_scan(str(path), results, metadata, scan_info(results, '/dev/sdx'), on_progress=fail)
+    assert path.read_text() == 'previous'
+    assert not (tmp_path / 'scan.ndjson.part').exists()
+
+
+def test_check_saved_scan(scan, identity):
+    results, _ = scan
+    info = scan_info(results, '/dev/sdx')
+    assert check_saved_scan(info, '/dev/sdx') is None
+    identity['identity'] = ('fsid-1', 43)
+    assert 'generation 43' in check_saved_scan(info, '/dev/sdx')
+    identity['identity'] = ('fsid-2', 42)
+    assert 'fsid-2' in check_saved_scan(info, '/dev/sdx')
+    identity['identity'] = None
+    assert check_saved_scan(info, '/dev/sdx') is None
+    # A scan saved from an unreadable device has no identity and can't be checked
+    assert scan_info(results, '/dev/sdx')['fsid'] is None
+    assert check_saved_scan({'fsid': None}, '/dev/sdx') is None
@@ -0,0 +1,87 @@
+import pytest
+
+from btrfs_index import PathIndex, extension_of, glob_literal, glob_regex
+
+PATHS = ['home/user/notes.txt', 'home/user/db/dump.SQL', 'home/user/db/old.sql', 'home/user0/x.py',
+         'srv/dir5/a.py', 'srv/dir5/sub/b.py', 'srv/dir50/c.py', 'README', 'srv/.hidden']
+METADATA = {'home/user/notes.txt': (10, None, None), 'home/user/db/dump.SQL': (200, None, None),
+            'home/user/db/old.sql': (3000, None, None), 'srv/dir5/a.py': (1, None, None),
+            'srv/dir5/sub/b.py': (None, None, None)}
+
+
+@pytest.fixture
+def index():
+    return PathIndex(PATHS, METADATA)
+
+
+def test_directory_stats(index):
+    assert len(index) == len(PATHS)
+    assert index.directory_stats('') == (len(PATHS), 3211)
+    assert index.directory_stats('home/user') == (3, 3210)
+    # "home/user0" sorts right after "home/user/" and isn't under it
+    assert index.directory_stats('home/user/') == (3, 3210)
+    assert index.directory_stats('srv/dir5') == (2, 1)
+    assert index.directory_stats('nowhere') == (0, 0)
+
+
+def test_children(index):
+    assert index.children('') == ([('home', 4, 3210), ('srv', 4, 1)], 1)
+    assert index.children('home/user') == ([('db', 2, 3200)], 1)
+    assert index.children('srv') == ([('dir5', 2, 1), ('dir50', 1, 0)], 1)
+
+
+def test_filter_everything(index):
+    assert index.filter('') == sorted(PATHS)
+    assert index.filter('', 'srv/dir5') == ['srv/dir5/a.py', 'srv/dir5/sub/b.py']
+
+
+def test_filter_extension(index):
+    assert index.filter('.sql') == ['home/user/db/dump.SQL', 'home/user/db/old.sql']
+    assert index.filter('.py', 'srv') == ['srv/dir5/a.py', 'srv/dir5/sub/b.py', 'srv/dir50/c.py']
+    # A dot file has no extension, so it isn't found as one
+    assert index.filter('.hidden') == []
+
+
+def test_filter_glob(index):
+    assert index.filter('*.sql') == ['home/user/db/old.sql']
+    assert index.filter('dir5/*.py') == ['srv/dir5/a.py']
+    assert index.filter('/srv/*/c.py') == ['srv/dir50/c.py']
+    assert index.filter('/dir5/*.py') == []
+    assert index.filter('?.py') == ['home/user0/x.py', 'srv/dir5/a.py', 'srv/dir5/sub/b.py', 'srv/dir50/c.py']
+    assert index.filter('[!ab].py') == ['home/user0/x.py', 'srv/dir50/c.py']
+
+
+def test_filter_substring(index):
+    assert index.filter('sql') == ['home/user/db/dump.SQL', 'home/user/db/old.sql']
+    assert index.filter('SQL') == ['home/user/db/dump.SQL']
+    assert index.filter('user', 'home/user') == ['home/user/db/dump.SQL', 'home/user/db/old.sql',
+                                                 'home/user/notes.txt']
+
+
+def test_narrowing_a_substring_reuses_matches(index):
+    assert index.filter('d') == [path for path in sorted(PATHS) if 'd' in path.lower()]
+    assert index.filter('di') == ['srv/dir5/a.py', 'srv/dir5/sub/b.py', 'srv/dir50/c.py']
+    assert index.filter('dir5/') == ['srv/dir5/a.py', 'srv/dir5/sub/b.py']
+    # A different directory starts over
+    assert index.filter('dir5/', 'home') == []
+
+
+def test_prepare(index):
+    index.prepare()
+    assert index.extensions is not None and index.lowered is not None
+    assert index.filter('.txt') == ['home/user/notes.txt']
+
+
+def test_glob_regex():
+    assert glob_regex('*.py').match('a/b.py')
+    assert not glob_regex('*.py').match('a/b.pyc')
+    assert not glob_regex('a*c').match('a/c')
+    assert glob_regex('[]x]').match(']')
+    assert glob_literal('dir5/*.py') == 'dir5/'
+    assert glob_literal('[ab]cd*') == 'cd'
+
+
+def test_extension_of():
+    assert extension_of('a/b.tar.GZ') == 'gz'
+    assert extension_of('a.d/README') == ''
+    assert extension_of('.bashrc') == ''
@@ -0,0 +1,140 @@
+import threading
+
+import pytest
+
+import btrfs_jobs
+from btrfs_engine import RecoveryError
+from btrfs_jobs import DONE, QUEUED, RESTORE, RUNNING, JobQueue
+from btrfs_results import ScanResults
+
+# JobQueue with the stages replaced by a fake runner that holds each one until the test
+# releases it, and devices that name the disk they are on: "A1" is on disk A.
+
+
+class FakeRunner(JobQueue):
+    def __init__(self, *args, **kwargs):
+        self.release = {}
+        self.active = []
+        self.peak = {}
+        self.stages = []
+        super().__init__(*args, **kwargs)
+
+    def run_fake(self, job, stage):
+        with self.lock:
+            self.stages.append((job.device, stage))
+            self.active.append(job.device[0])
+            self.peak[job.device[0]] = max(self.peak.get(job.device[0], 0), self.active.count(job.device[0]))
+            gate = self.release.setdefault(job.id, threading.Event())
+        gate.wait(10)
+        with self.lock:
+            self.active.remove(job.device[0])
+
+    def scan(self, job, log):
+        self.run_fake(job, 'scan')
+        results = ScanResults()
+        results.add_root('256', 1, ['a'])
+        job.results = results
+        job.metadata = {}
+        job.patterns = None
+        job.progress['files'] = len(results)
+
+    def restore(self, job, log):
+        self.run_fake(job, 'restore')
+        job.engine = type('Restored', (), {'failed': []})()
+
+    def finish(self, *jobs):
+        for job in jobs:
+            with self.lock:
+                gate = self.release.setdefault(job.id, threading.Event())
+            gate.set()
+
+    def states(self):
+        with self.lock:
+            return {job.device: job.state for job in self.jobs.values()}
+
+
+@pytest.fixture(autouse=True)
+def disks(monkeypatch):
+    monkeypatch.setattr(btrfs_jobs, 'physical_disks', lambda source: {source[0]})
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / 'state' / 'jobs.json')
+
+
+def test_one_stage_per_disk(queue_path):
+    queue = FakeRunner(queue_path, max_jobs=3, per_disk=1)
+    jobs = [queue.add(device) for device in ('A1', 'A2', 'B1', 'B2')]
+    queue.start()
+    # A2 waits for A1's disk and B1 takes the free slot
+    assert queue.states() == {'A1': RUNNING, 'A2': QUEUED, 'B1': RUNNING, 'B2': QUEUED}
+    assert queue.summary()['busy_disks'] == ['A', 'B']
+    queue.finish(*jobs)
+    assert queue.wait(10)
+    assert set(queue.states().values()) == {DONE}
+    assert queue.peak == {'A': 1, 'B': 1}
+    assert queue.summary()['busy_disks'] == []
+
+
+def test_per_disk_and_max_jobs(queue_path):
+    queue = FakeRunner(queue_path, max_jobs=3, per_disk=2)
+    jobs = [queue.add(device) for device in ('A1', 'A2', 'A3', 'B1')]
+    queue.start()
+    assert queue.states() == {'A1': RUNNING, 'A2': RUNNING, 'A3': QUEUED, 'B1': RUNNING}
+    queue.finish(*jobs)
+    assert queue.wait(10)
+    assert queue.peak == {'A': 2, 'B': 1}
+
+
+def test_priority_picks_the_next_stage(queue_path):
+    queue = FakeRunner(queue_path, max_jobs=1)
+    first, low, high = (queue.add(device) for device in ('A1', 'B1', 'C1'))
+    queue.start()
+    queue.set_priority(high.id, 5)
+    queue.finish(first, low, high)
+    assert queue.wait(10)
+    assert [device for device, _ in queue.stages] == ['A1', 'C1', 'B1']
+
+
+def test_restore_stage_goes_back_into_the_queue(queue_path, tmp_path):
+    # A high-priority scan added meanwhile isn't stuck behind the restore
+    queue = FakeRunner(queue_path, max_jobs=1)
+    restoring = queue.add('A1', destination=str(tmp_path / 'out'))
+    queue.start()
+    urgent = queue.add('B1', priority=1)
+    queue.finish(restoring, urgent)
+    assert queue.wait(10)
+    assert queue.stages == [('A1', 'scan'), ('B1', 'scan'), ('A1', 'restore')]
+    assert queue.job(restoring.id).stage == RESTORE and queue.job(restoring.id).state == DONE
+
+
+def test_only_one_process_owns_the_queue(queue_path):
+    owner = FakeRunner(queue_path)
+    job = owner.add('A1')
+    viewer = FakeRunner(queue_path)
+    assert not owner.read_only and viewer.read_only
+    assert [snapshot['device'] for snapshot in viewer.snapshot()] == ['A1']
+    for change in (lambda: viewer.add('B1'), viewer.start, lambda: viewer.cancel(job.id),
+                   lambda: viewer.set_priority(job.id, 1), lambda: viewer.remove(job.id)):
+        with pytest.raises(RecoveryError, match='in use by another process'):
+            change()
+    # A read-only view follows what the owner saves
+    owner.add('B1')
+    viewer.reload()
+    assert sorted(viewer.states()) == ['A1', 'B1']
+
+
+def test_running_jobs_are_requeued_by_the_next_owner(queue_path):
+    owner = FakeRunner(queue_path)
+    job = owner.add('A1')
+    owner.start()
+    assert owner.states() == {'A1': RUNNING}
+    # A viewer shows the job as running; once the owner is gone, the next owner runs it again
+    assert FakeRunner(queue_path).states() == {'A1': RUNNING}
+    owner.lock_file.close()
+    successor = FakeRunner(queue_path)
+    assert not successor.read_only
+    assert successor.states() == {'A1': QUEUED}
+    owner.finish(job)
+    owner.wait(10)
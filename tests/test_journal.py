@@ -0,0 +1,153 @@
+import json
+import os
+
+from btrfs_engine import RestoreEngine
+from btrfs_journal import RestoreJournal, content_hash, default_journal_path
+
+
+def write(destination, path, content):
+    target = os.path.join(destination, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'wb') as f:
+        f.write(content)
+
+
+class FakeRestore(RestoreEngine):
+    # Restores by writing each file's name as its content instead of running btrfs restore,
+    # and stops the job after batches_left batches, as if it were killed
+    def __init__(self, *args, batches_left=None, **kwargs):
+        super().__init__(*args, use_sudo=False, max_workers=1, check_space=False, **kwargs)
+        self.batches_left = batches_left
+        self.restored_paths = []
+
+    def restore_batch(self, root, files, destination=None):
+        if self.batches_left is not None:
+            if self.batches_left == 0:
+                raise KeyboardInterrupt
+            self.batches_left -= 1
+        for path in files:
+            write(self.destination, path, path.encode())
+        self.restored_paths.extend(files)
+        if self.journal:
+            self.record_batch(root, files)
+        return len(files)
+
+
+def test_records_survive_reopening(tmp_path):
+    destination = str(tmp_path)
+    path = default_journal_path(destination)
+    write(destination, 'a/one', b'12345')
+    journal = RestoreJournal(path)
+    records = [journal.verify('256', 'a/one', destination, 5), journal.verify('256', 'a/two', destination, 3)]
+    journal.write(records)
+    journal.close()
+
+    assert records[0] == {'root': '256', 'path': 'a/one', 'status': 'verified', 'bytes': 5,
+                          'hash': content_hash(os.path.join(destination, 'a/one'))}
+    assert records[1]['status'] == 'missing'
+    reopened = RestoreJournal(path)
+    assert reopened.records == {record['path']: record for record in records}
+    assert reopened.is_done('a/one', '256', destination)
+    assert not reopened.is_done('a/two', '256', destination)
+
+
+def test_is_done_checks_root_and_size(tmp_path):
+    destination = str(tmp_path)
+    write(destination, 'f', b'abc')
+    journal = RestoreJournal(default_journal_path(destination))
+    journal.write([journal.verify('300', 'f', destination)])
+    assert journal.is_done('f', '300', destination)
+    # Another root's version of the file still has to be restored
+    assert not journal.is_done('f', '301', destination)
+    write(destination, 'f', b'abcd')
+    assert not journal.is_done('f', '300', destination)
+    os.remove(os.path.join(destination, 'f'))
+    assert not journal.is_done('f', '300', destination)
+    journal.close()
+
+
+def test_is_done_checks_content(tmp_path):
+    destination = str(tmp_path)
+    write(destination, 'f', b'abc')
+    journal = RestoreJournal(default_journal_path(destination))
+    journal.write([journal.verify('300', 'f', destination, 3)])
+    # Damaged in place, same size
+    write(destination, 'f', b'abd')
+    assert not journal.is_done('f', '300', destination)
+    write(destination, 'f', b'abc')
+    assert journal.is_done('f', '300', destination)
+    journal.close()
+
+
+def test_unknown_size_verifies_any_file(tmp_path):
+    destination = str(tmp_path)
+    write(destination, 'f', b'')
+    journal = RestoreJournal(default_journal_path(destination))
+    record = journal.verify('1', 'f', destination)
+    assert record['status'] == 'verified' and record['bytes'] == 0
+    assert journal.verify('1', 'absent', destination)['status'] == 'missing'
+
+
+def test_size_mismatch(tmp_path):
+    destination = str(tmp_path)
+    write(destination, 'f', b'abc')
+    journal = RestoreJournal(default_journal_path(destination))
+    assert journal.verify('1', 'f', destination, 10)['status'] == 'size-mismatch'
+    assert journal.verify('1', 'f', destination, 3)['status'] == 'verified'
+
+
+def test_later_records_win_and_torn_lines_are_ignored(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    lines = [json.dumps({'root': '1', 'path': 'f', 'status': 'missing', 'bytes': None, 'hash': None}),
+             json.dumps({'root': '1', 'path': 'f', 'status': 'verified', 'bytes': 3, 'hash': 'x'}),
+             json.dumps({'root': '1', 'status': 'verified'}),
+             '{"root": "1", "path": "g", "sta']
+    path.write_text('\n'.join(lines))
+    journal = RestoreJournal(str(path))
+    assert list(journal.records) == ['f']
+    assert journal.records['f']['status'] == 'verified'
+
+
+def test_interrupted_job_resumes(tmp_path):
+    destination = str(tmp_path / 'out')
+    file_roots = {f'dir/file{number}': '256' for number in range(4)}
+    file_roots.update({f'other/file{number}': '300' for number in range(4)})
+    journal_path = default_journal_path(destination)
+
+    first = FakeRestore('/dev/sdx', destination, file_roots, journal=RestoreJournal(journal_path), batches_left=1)
+    try:
+        first.run()
+    except KeyboardInterrupt:
+        pass
+    done = set(first.restored_paths)
+    assert len(done) == 4
+
+    second = FakeRestore('/dev/sdx', destination, file_roots, journal=RestoreJournal(journal_path))
+    assert second.run() == 4
+    assert second.skipped == 4
+    assert set(second.restored_paths) == set(file_roots) - done
+    assert second.verified == 4 and second.failed == []
+
+    # A file changed after it was verified is restored again
+    write(destination, 'dir/file0', b'cut')
+    third = FakeRestore('/dev/sdx', destination, file_roots, journal=RestoreJournal(journal_path))
+    assert third.run() == 1
+    assert third.restored_paths == ['dir/file0']
+
+    fourth = FakeRestore('/dev/sdx', destination, file_roots, journal=RestoreJournal(journal_path))
+    assert fourth.run() == 0
+    assert fourth.skipped == len(file_roots)
+
+
+def test_missing_files_are_reported(tmp_path):
+    destination = str(tmp_path)
+
+    class Missing(FakeRestore):
+        def restore_batch(self, root, files, destination=None):
+            self.record_batch(root, files)
+            return 0
+
+    job = Missing('/dev/sdx', destination, {'gone': '256'}, journal=RestoreJournal(default_journal_path(destination)))
+    job.run()
+    assert job.failed == ['gone']
+    assert not RestoreJournal(default_journal_path(destination)).is_done('gone', '256', destination)
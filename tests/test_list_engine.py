@@ -0,0 +1,71 @@
+import threading
+import time
+
+from btrfs_engine import ListEngine, PathPatterns
+
+# ListEngine against the stand-in btrfs-progs (see conftest)
+
+EVERYTHING = PathPatterns.parse('', 'everything').path_regex
+
+
+def list_engine(device, **options):
+    engine = ListEngine(device, False, EVERYTHING, use_cache=False, triage=False, max_workers=2, **options)
+    found = []
+    metadata = {}
+    messages = []
+    engine.on_files_found = found.extend
+    engine.on_metadata = metadata.update
+    engine.on_progress = messages.append
+    return engine, found, metadata, messages
+
+
+def test_everything_is_listed(fake_btrfs):
+    engine, found, metadata, _ = list_engine(fake_btrfs)
+    files, results = engine.run()
+    assert len(files) == 40 and sorted(found) == sorted(files)
+    assert set(metadata) == set(files)
+
+
+def test_max_matches_keeps_only_that_many(fake_btrfs, monkeypatch):
+    monkeypatch.setenv('BENCH_PATHS', '2000')
+    engine, found, metadata, _ = list_engine(fake_btrfs, max_matches=10)
+    files, results = engine.run()
+    assert len(files) == 10 and len(results) == 10
+    assert found == list(results)
+    assert set(metadata) == set(files)
+    for path in files:
+        assert results.root_for(path) in results.roots_for(path)
+    assert sum(results.count(root) for root in results.roots()) >= 10
+
+
+def test_cancel_stops_the_metadata_dump(fake_btrfs, monkeypatch):
+    # Each scan prints 30 lines and each metadata dump a few hundred, 10ms apart
+    monkeypatch.setenv('BENCH_LINE_DELAY', '0.01')
+    engine, _, metadata, messages = list_engine(fake_btrfs)
+    cancelled = []
+
+    def on_progress(message):
+        messages.append(message)
+        if message.startswith('Reading file metadata') and not cancelled:
+            cancelled.append(time.monotonic())
+            threading.Timer(0.2, engine.cancel).start()
+
+    engine.on_progress = on_progress
+    files, _ = engine.run()
+    assert cancelled and time.monotonic() - cancelled[0] < 2
+    assert len(files) == 40
+    assert len(metadata) < 40
+    assert sum(message.startswith('Reading file metadata') for message in messages) == 1
+
+
+def test_root_timeout_bounds_the_metadata_dump(fake_btrfs, monkeypatch):
+    monkeypatch.setenv('BENCH_ROOTS', '1')
+    monkeypatch.setenv('BENCH_PATHS', '400')
+    monkeypatch.setenv('BENCH_LINE_DELAY', '0.002')
+    engine, _, metadata, messages = list_engine(fake_btrfs, root_timeout=1.5)
+    started = time.monotonic()
+    files, _ = engine.run()
+    assert time.monotonic() - started < 5
+    assert len(files) == 300 and not engine.roots_timed_out
+    assert any('reading metadata ran over the 1.5s limit' in message for message in messages)
+    assert len(metadata) < 300
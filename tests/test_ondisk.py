@@ -0,0 +1,167 @@
+import os
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+from btrfs_ondisk import (BLOCK_GROUP_METADATA, BLOCK_GROUP_SYSTEM, ROOT_TREE_OBJECTID, SUPERBLOCK_OFFSETS,
+                          BtrfsFormatError, BtrfsImage, crc32c, find_tree_roots)
+
+# Real filesystems made with mkfs.btrfs (skipped when btrfs-progs isn't installed), and a
+# hand-built image for the read error paths, which have to run everywhere.
+
+NODESIZE = 4096
+FSID = bytes(range(16))
+SYSTEM_LOGICAL = SYSTEM_PHYSICAL = 0x100000
+METADATA_LOGICAL = 0x1000000
+METADATA_PHYSICAL = 0x200000
+# (generation, owner, level) of the blocks in the metadata chunk
+BLOCKS = [(8, ROOT_TREE_OBJECTID, 0), (9, ROOT_TREE_OBJECTID, 1), (9, ROOT_TREE_OBJECTID, 0),
+          (10, ROOT_TREE_OBJECTID, 0), (10, 5, 1), (4, ROOT_TREE_OBJECTID, 0)]
+
+
+@pytest.fixture(scope='module')
+def mkfs_image(tmp_path_factory):
+    mkfs = shutil.which('mkfs.btrfs')
+    if not mkfs:
+        pytest.skip("mkfs.btrfs is not installed")
+    path = str(tmp_path_factory.mktemp('mkfs') / 'btrfs.img')
+    with open(path, 'wb') as f:
+        f.truncate(256 * 1024 * 1024)
+    subprocess.run([mkfs, '-q', '-f', '-L', 'ondisk-test', '-m', 'single', '-d', 'single', path],
+                   check=True, capture_output=True)
+    return path
+
+
+def header(logical, generation, owner, nritems, level):
+    block = bytearray(0x65)
+    block[0x20:0x30] = FSID
+    struct.pack_into('<QQ', block, 0x30, logical, 0)
+    struct.pack_into('<QQIB', block, 0x50, generation, owner, nritems, level)
+    return block
+
+
+def chunk_item(logical, length, chunk_type, physical):
+    key = struct.pack('<QBQ', 256, 228, logical)
+    item = (struct.pack('<QQQQIIIHH', length, 2, 65536, chunk_type, NODESIZE, NODESIZE, NODESIZE, 1, 0)
+            + struct.pack('<QQ', 1, physical) + bytes(16))
+    return key, item
+
+
+@pytest.fixture
+def synthetic_image(tmp_path):
+    # One SYSTEM chunk holding the chunk tree and one METADATA chunk holding BLOCKS
+    image = bytearray(4 * 1024 * 1024)
+    system = chunk_item(SYSTEM_LOGICAL, 0x100000, BLOCK_GROUP_SYSTEM, SYSTEM_PHYSICAL)
+    metadata = chunk_item(METADATA_LOGICAL, 0x100000, BLOCK_GROUP_METADATA, METADATA_PHYSICAL)
+    leaf = bytearray(NODESIZE)
+    leaf[:0x65] = header(SYSTEM_LOGICAL, 10, 3, 2, 0)
+    data_offset = NODESIZE - 0x65
+    for i, (key, item) in enumerate([system, metadata]):
+        data_offset -= len(item)
+        leaf[0x65 + data_offset:0x65 + data_offset + len(item)] = item
+        leaf[0x65 + i * 25:0x65 + (i + 1) * 25] = key + struct.pack('<II', data_offset, len(item))
+    image[SYSTEM_PHYSICAL:SYSTEM_PHYSICAL + NODESIZE] = leaf
+    for i, (generation, owner, level) in enumerate(BLOCKS):
+        physical = METADATA_PHYSICAL + i * NODESIZE
+        image[physical:physical + 0x65] = header(METADATA_LOGICAL + i * NODESIZE, generation, owner, 0, level)
+
+    superblock = bytearray(4096)
+    superblock[0x20:0x30] = FSID
+    struct.pack_into('<Q', superblock, 0x30, SUPERBLOCK_OFFSETS[0])
+    superblock[0x40:0x48] = b'_BHRfS_M'
+    struct.pack_into('<QQQ', superblock, 0x48, 10, METADATA_LOGICAL + 3 * NODESIZE, SYSTEM_LOGICAL)
+    struct.pack_into('<II', superblock, 0x90, NODESIZE, NODESIZE)
+    struct.pack_into('<I', superblock, 0xa0, len(system[0] + system[1]))
+    superblock[0x32b:0x32b + len(system[0] + system[1])] = system[0] + system[1]
+    struct.pack_into('<Q', superblock, 0xc9, 1)
+    superblock[0x12b:0x12b + 9] = b'synthetic'
+    struct.pack_into('<I', superblock, 0, crc32c(bytes(superblock[0x20:])))
+    image[SUPERBLOCK_OFFSETS[0]:SUPERBLOCK_OFFSETS[0] + 4096] = superblock
+
+    path = tmp_path / 'synthetic.img'
+    path.write_bytes(image)
+    return str(path)
+
+
+def test_mkfs_superblock(mkfs_image):
+    with BtrfsImage(mkfs_image) as image:
+        sb = image.superblock
+        assert sb.label == 'ondisk-test'
+        assert sb.csum_ok
+        assert sb.generation > 0
+        assert image.superblocks[0].offset == SUPERBLOCK_OFFSETS[0]
+
+
+def test_mkfs_chunk_map(mkfs_image):
+    with BtrfsImage(mkfs_image) as image:
+        assert any(chunk.type & BLOCK_GROUP_SYSTEM for chunk in image.chunks)
+        assert any(chunk.type & BLOCK_GROUP_METADATA for chunk in image.chunks)
+        for bytenr in (image.superblock.chunk_root, image.superblock.root):
+            block = image.read_tree_block(bytenr)
+            assert struct.unpack_from('<Q', block, 0x30)[0] == bytenr
+            assert image.logical_to_physical(bytenr) < image.size
+
+
+def test_mkfs_tree_roots(mkfs_image):
+    with BtrfsImage(mkfs_image) as image:
+        roots = image.find_tree_roots()
+        current = image.superblock.root
+        assert current in [root.bytenr for root in roots]
+        assert [root.generation for root in roots] == sorted((root.generation for root in roots), reverse=True)
+        assert image.fs_tree_fingerprint(current) is not None
+    assert find_tree_roots(mkfs_image, min_generation=roots[0].generation) == roots[:1]
+
+
+def test_synthetic_tree_roots(synthetic_image):
+    with BtrfsImage(synthetic_image) as image:
+        assert image.superblock.label == 'synthetic'
+        assert image.superblock.csum_ok
+        roots = image.find_tree_roots()
+    # The highest-level block per generation, other owners left out
+    assert [(root.generation, root.level) for root in roots] == [(10, 0), (9, 1), (8, 0), (4, 0)]
+    assert roots[1].bytenr == METADATA_LOGICAL + NODESIZE
+    assert [root.generation for root in find_tree_roots(synthetic_image, 5, 9)] == [9, 8]
+
+
+def test_unreadable_blocks_are_skipped(synthetic_image, monkeypatch):
+    # An I/O error in the middle of the metadata chunk fails the window read, then only the
+    # bad block is left out
+    bad = METADATA_PHYSICAL + 3 * NODESIZE
+    pread = os.pread
+
+    def failing_pread(fd, length, offset):
+        if offset <= bad < offset + length:
+            raise OSError(5, "Input/output error")
+        return pread(fd, length, offset)
+
+    with BtrfsImage(synthetic_image) as image:
+        monkeypatch.setattr(os, 'pread', failing_pread)
+        roots = image.find_tree_roots()
+        with pytest.raises(BtrfsFormatError):
+            image.read_tree_block(METADATA_LOGICAL + 3 * NODESIZE)
+    assert [root.generation for root in roots] == [9, 8, 4]
+
+
+def test_unreadable_superblock(synthetic_image, monkeypatch):
+    pread = os.pread
+
+    def failing_pread(fd, length, offset):
+        if offset == SUPERBLOCK_OFFSETS[0]:
+            raise OSError(5, "Input/output error")
+        return pread(fd, length, offset)
+
+    monkeypatch.setattr(os, 'pread', failing_pread)
+    with pytest.raises(BtrfsFormatError):
+        BtrfsImage(synthetic_image)
+
+
+def test_not_btrfs(tmp_path):
+    path = tmp_path / 'zero.img'
+    path.write_bytes(bytes(1024 * 1024))
+    with pytest.raises(BtrfsFormatError):
+        BtrfsImage(str(path))
+    path.write_bytes(bytes(100))
+    with pytest.raises(BtrfsFormatError):
+        BtrfsImage(str(path))
@@ -0,0 +1,63 @@
+import io
+
+from btrfs_output import (WELL_BLOCK, decode_lines, decode_path, display_path, read_line_blocks,
+                          restoring_pattern)
+
+
+class Chunked:
+    # A pipe that hands out its data in the given pieces, one per read1()
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+
+    def read1(self, size=-1):
+        return self.pieces.pop(0) if self.pieces else b''
+
+
+def test_line_blocks_only_split_on_newlines():
+    stream = Chunked([b'first\nsec', b'ond\nthi', b'rd', b'\nlast'])
+    blocks = list(read_line_blocks(stream))
+    assert blocks == [b'first\n', b'second\n', b'third\n', b'last\n']
+    assert all(block.endswith(b'\n') for block in blocks)
+
+
+def test_line_blocks_empty_stream():
+    assert list(read_line_blocks(Chunked([]))) == []
+
+
+def test_line_blocks_from_bytes_io():
+    data = b''.join(b'line %d\n' % number for number in range(1000))
+    blocks = list(read_line_blocks(io.BufferedReader(io.BytesIO(data)), size=100))
+    assert b''.join(blocks) == data
+    assert all(block.endswith(b'\n') for block in blocks)
+
+
+def test_well_block():
+    found = [(int(block), int(generation) if generation else None)
+             for block, generation in WELL_BLOCK.findall(b'Well block 30621696(gen: 11 level: 0) seems good\n'
+                                                         b'Well block 4194304 seems good\n')]
+    assert found == [(30621696, 11), (4194304, None)]
+
+
+def test_restoring_pattern():
+    block = (b'Restoring /tmp/out/home/user/a.txt\n'
+             b'Skipping existing file /tmp/out/home/b\n'
+             b'Restoring /tmp/out/home/\xff\xfe.bin\n'
+             b'Restoring /tmp/outside/c\n')
+    pattern = restoring_pattern('/tmp/out/')
+    assert pattern.findall(block) == [b'home/user/a.txt', b'home/\xff\xfe.bin']
+
+
+def test_restoring_pattern_escapes_the_directory():
+    pattern = restoring_pattern('/tmp/a.b+c')
+    assert pattern.findall(b'Restoring /tmp/a.b+c/x\nRestoring /tmp/aXbbc/y\n') == [b'x']
+
+
+def test_decode_lines():
+    assert decode_lines(b'one\ntwo\n') == ['one', 'two']
+
+
+def test_undecodable_names_round_trip():
+    raw = b'dir/caf\xe9.txt'
+    path = decode_path(raw)
+    assert path.encode('utf-8', 'surrogateescape') == raw
+    assert display_path(path) == 'dir/caf\ufffd.txt'
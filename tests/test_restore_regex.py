@@ -0,0 +1,128 @@
+import re
+
+import pytest
+
+from btrfs_engine import (PathPatterns, build_path_regex, build_restore_regex, chunk_restore_paths,
+                          posix_regex_escape, recovery_type_named)
+
+# Python's re agrees with POSIX extended regexes on everything build_restore_regex emits
+
+
+def matches(regex, path):
+    return re.match(regex, path) is not None
+
+
+def test_files_and_their_directories_match():
+    regex = build_restore_regex(['home/a', 'home/b/c.txt', 'etc/fstab'])
+    assert regex == '^(/home(|/a|/b(|/c\\.txt))|/etc(|/fstab))$'
+    for path in ['/home', '/home/a', '/home/b', '/home/b/c.txt', '/etc', '/etc/fstab']:
+        assert matches(regex, path), path
+    for path in ['/home/c', '/home/b/d', '/homeb', '/home/ab', '/etc/fstab2', '/', '/srv']:
+        assert not matches(regex, path), path
+
+
+def test_special_characters_are_literal():
+    name = 'a.b[c](d)*+?{1}|^$\\e'
+    regex = build_restore_regex([f'dir/{name}'])
+    assert matches(regex, f'/dir/{name}')
+    assert not matches(regex, '/dir/aXb[c](d)*+?{1}|^$\\e')
+    assert posix_regex_escape('x.y') == 'x\\.y'
+
+
+def test_leading_and_trailing_slashes_are_ignored():
+    assert build_restore_regex(['/a/b/']) == build_restore_regex(['a/b'])
+
+
+def test_chunks_cover_every_path_once():
+    paths = [f'dir{number % 7}/sub{number % 13}/file{number}.dat' for number in range(5000)]
+    chunks = list(chunk_restore_paths(paths, max_regex=4096))
+    assert len(chunks) > 1
+    flattened = [path for chunk in chunks for path in chunk]
+    assert flattened == sorted(paths)
+
+
+def test_chunks_stay_under_the_limit():
+    paths = [f'home/user/{"x.y" * (number % 20)}/file({number})' for number in range(3000)]
+    for max_regex in (1024, 8192, 32 * 1024):
+        for chunk in chunk_restore_paths(paths, max_regex=max_regex):
+            assert len(build_restore_regex(chunk)) <= max_regex
+
+
+def test_a_path_over_the_limit_gets_its_own_chunk():
+    long_path = 'a/' + 'b' * 100
+    chunks = list(chunk_restore_paths(['a/c', long_path, 'z'], max_regex=50))
+    assert chunks == [[long_path], ['a/c', 'z']]
+
+
+def test_no_paths_no_chunks():
+    assert list(chunk_restore_paths([])) == []
+
+
+@pytest.mark.parametrize('recovery_type, value, regex', [
+    ('file', 'etc/fstab', '/etc/fstab'),
+    ('directory', 'home/user', '/home/user/.'),
+    ('extension', 'sql', '/.*\\.sql'),
+    ('file-in-directory', 'srv/.*\\.conf', '/srv/.*\\.conf'),
+    ('everything', '', '/.'),
+])
+def test_path_regex(recovery_type, value, regex):
+    assert build_path_regex(recovery_type, value) == regex
+
+
+def test_recovery_type_names():
+    assert recovery_type_named('extension') == 'extension'
+    assert recovery_type_named('ext') == 'extension'
+    assert recovery_type_named('dir') == 'directory'
+    # "file" is a type of its own and a prefix of file-in-directory
+    assert recovery_type_named('file') == 'file'
+    assert recovery_type_named('fi') is None
+    assert recovery_type_named('') is None
+    assert recovery_type_named('nginx') is None
+
+
+def test_single_target():
+    patterns = PathPatterns.parse('sql', 'extension')
+    assert patterns.labels() == ['extension:sql']
+    assert patterns.path_regex == '/.*\\.sql'
+    # One target tags every match without looking at it
+    assert patterns.tag('anything') == 'extension:sql'
+
+
+def test_several_targets():
+    patterns = PathPatterns.parse('ext:sql; ext:conf ;dir:nginx; report.pdf', 'file')
+    assert len(patterns) == 4
+    assert patterns.labels() == ['extension:sql', 'extension:conf', 'directory:nginx', 'file:report.pdf']
+    assert patterns.path_regex == '(/.*\\.sql)|(/.*\\.conf)|(/nginx/.)|(/report.pdf)'
+    assert patterns.tag('var/db/dump.sql') == 'extension:sql'
+    assert patterns.tag('etc/nginx/nginx.conf') == 'extension:conf'
+    assert patterns.tag('etc/nginx/sites/default') == 'directory:nginx'
+    assert patterns.tag('home/report.pdf') == 'file:report.pdf'
+    assert patterns.tag('home/notes.txt') is None
+
+
+def test_parts_without_a_known_type_use_the_default():
+    patterns = PathPatterns.parse('http://x;fi:y', 'file-in-directory')
+    assert patterns.labels() == ['file-in-directory:http://x', 'file-in-directory:fi:y']
+
+
+def test_empty_and_duplicate_targets():
+    assert PathPatterns.parse('', 'extension').labels() == ['extension:']
+    assert PathPatterns.parse(' ; ;', 'file').labels() == ['file:']
+    assert PathPatterns.parse('', 'everything').path_regex == '/.'
+    patterns = PathPatterns.parse('ext:sql; extension:sql; ext:', 'file')
+    assert patterns.labels() == ['extension:sql']
+
+
+def test_everything_with_other_targets():
+    patterns = PathPatterns.parse('everything:; ext:sql', 'file')
+    assert patterns.labels() == ['everything:', 'extension:sql']
+    assert patterns.tag('a/b.sql') == 'everything:'
+
+
+def test_hand_written_regex_that_python_rejects():
+    # Still passed on to btrfs restore, but tag() can't place matches of it
+    patterns = PathPatterns.parse('file:a{2,1}; ext:sql', 'file')
+    assert patterns.path_regex == '(/a{2,1})|(/.*\\.sql)'
+    assert patterns.labels() == ['file:a{2,1}', 'extension:sql']
+    assert patterns.tag('aa') is None
+    assert patterns.tag('x.sql') == 'extension:sql'
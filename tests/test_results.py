@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+from btrfs_results import ScanResults, file_record
+
+
+@pytest.fixture
+def results():
+    # Added oldest first, as the multi-root listing does when roots come in any order
+    results = ScanResults()
+    results.add_root('100', 5, ['a', 'b', 'old'])
+    results.add_root('200', 9, ['a', 'c'])
+    results.add_root('150', 7, ['b', 'c', 'd'])
+    return results
+
+
+def test_paths_are_stored_once(results):
+    assert len(results) == 5
+    assert list(results) == ['a', 'b', 'old', 'c', 'd']
+    assert 'old' in results and 'missing' not in results
+
+
+def test_add_root_returns_new_files():
+    results = ScanResults()
+    assert results.add_root('1', 1, ['x', 'y']) == ['x', 'y']
+    assert results.add_root('2', 2, ['y', 'z']) == ['z']
+
+
+def test_roots_newest_first(results):
+    assert results.roots() == ['200', '150', '100']
+    assert results.generation('150') == 7
+    assert results.count('150') == 3
+    assert sorted(results.files('200')) == ['a', 'c']
+
+
+def test_root_for_is_the_newest_root(results):
+    assert results.root_for('a') == '200'
+    assert results.root_for('b') == '150'
+    assert results.root_for('c') == '200'
+    assert results.root_for('old') == '100'
+    assert results.root_for('missing') is None
+
+
+def test_roots_for(results):
+    assert results.roots_for('c') == ['200', '150']
+    assert results.roots_for('b') == ['150', '100']
+    assert results.roots_for('missing') == []
+
+
+def test_same_generation_keeps_the_first_root():
+    results = ScanResults()
+    results.add_root('first', 3, ['a'])
+    results.add_root('second', 3, ['a'])
+    assert results.root_for('a') == 'first'
+
+
+def test_unknown_generation_ranks_oldest():
+    results = ScanResults()
+    results.add_root('unknown', None, ['a'])
+    results.add_root('known', 1, ['a'])
+    assert results.root_for('a') == 'known'
+    assert results.roots() == ['known', 'unknown']
+
+
+def test_group_by_root(results):
+    groups = results.group_by_root(['old', 'a', 'b', 'c', 'missing'])
+    assert groups == {'200': ['a', 'c'], '150': ['b'], '100': ['old']}
+    assert list(groups) == ['200', '150', '100']
+
+
+def test_export_round_trip(results):
+    data = json.loads(json.dumps(results.export()))
+    loaded = ScanResults.from_export(data)
+    assert loaded.paths == results.paths
+    assert loaded.roots() == results.roots()
+    for path in results:
+        assert loaded.root_for(path) == results.root_for(path)
+        assert loaded.roots_for(path) == results.roots_for(path)
+
+
+def test_from_parts(results):
+    loaded = ScanResults.from_parts(list(results.paths), list(results.newest),
+                                    zip(results.root_names, results.generations, results.members))
+    assert loaded.group_by_root(results.paths) == results.group_by_root(results.paths)
+    assert loaded.count('100') == 3
+
+
+def test_file_record(results):
+    record = file_record('b', results, {'b': (10, 1.5, 7)})
+    assert record == {'path': 'b', 'size': 10, 'mtime': 1.5, 'generation': 7, 'root': '150', 'pattern': None}
+    assert file_record('a', results, {})['size'] is None
+
+
+def test_head(results):
+    first = results.head(2)
+    assert first.paths == ['a', 'b']
+    # Root 100 keeps a and b and loses old
+    assert first.roots() == ['200', '150', '100']
+    assert first.root_for('a') == '200' and first.root_for('b') == '150'
+    assert first.files('150') == ['b'] and first.count('100') == 2
+    assert 'old' not in first and first.roots_for('old') == []
+
+
+def test_head_drops_roots_without_kept_paths(results):
+    first = results.head(1)
+    assert first.roots() == ['200', '100']
+    assert first.group_by_root(['a']) == {'200': ['a']}
+    assert results.head(10).paths == results.paths
@@ -0,0 +1,130 @@
+import os
+import stat
+
+from btrfs_engine import ListEngine, PathPatterns
+from btrfs_scan_cache import ScanCache
+
+EVERYTHING = PathPatterns.parse('', 'everything').path_regex
+UNDECODABLE = b'caf\xe9 menu.txt'.decode('utf-8', 'surrogateescape')
+ROOT = '30408704'
+
+
+def open_cache(tmp_path, fsid='fsid-1', generation=10, **options):
+    return ScanCache(fsid, generation, str(tmp_path / 'cache.sqlite3'), **options)
+
+
+def test_round_trip(tmp_path):
+    cache = open_cache(tmp_path)
+    assert cache.get_roots() is None
+    assert cache.get_files('1', '/.') is None
+    assert cache.get_metadata('1') is None
+    cache.put_roots([('3', 9), ('2', None), ('1', 7)])
+    cache.put_files('1', '/.', {'a/b', UNDECODABLE, 'with space'})
+    cache.put_files('2', '/.', set())
+    cache.put_metadata('1', {'a/b': (10, 1.5)})
+    cache.close()
+
+    cache = open_cache(tmp_path)
+    assert cache.get_roots() == [('3', 9), ('2', None), ('1', 7)]
+    assert cache.get_files('1', '/.') == {'a/b', UNDECODABLE, 'with space'}
+    assert cache.get_files('2', '/.') == set()
+    # Another regex is another scan
+    assert cache.get_files('1', '/.*\\.sql') is None
+    assert cache.get_metadata('1') == {'a/b': (10, 1.5)}
+    cache.close()
+
+
+def test_new_generation_drops_the_filesystem(tmp_path):
+    cache = open_cache(tmp_path)
+    cache.put_roots([('1', 7)])
+    cache.put_files('1', '/.', {'a'})
+    cache.put_metadata('1', {'a': (1, None)})
+    other = open_cache(tmp_path, fsid='fsid-2')
+    other.put_files('1', '/.', {'b'})
+    cache.close()
+    other.close()
+
+    cache = open_cache(tmp_path, generation=11)
+    assert cache.get_roots() is None
+    assert cache.get_files('1', '/.') is None
+    assert cache.get_metadata('1') is None
+    cache.close()
+    # Only the filesystem that changed
+    other = open_cache(tmp_path, fsid='fsid-2')
+    assert other.get_files('1', '/.') == {'b'}
+    other.close()
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = open_cache(tmp_path, max_bytes=1)
+    cache.put_files('1', '/.', {'a'})
+    cache.put_files('2', '/.', {'b'})
+    assert cache.get_files('1', '/.') is None
+    assert cache.get_files('2', '/.') is None
+    cache.close()
+
+    cache = open_cache(tmp_path, max_bytes=10 ** 6)
+    for root in '123':
+        cache.put_files(root, '/.', {f'file{number}' for number in range(100)})
+    cache.get_files('1', '/.')
+    size = cache.db.execute('SELECT size FROM scans WHERE root = ?', ('1',)).fetchone()[0]
+    cache.max_bytes = 2 * size + size // 2
+    cache.put_metadata('4', {})
+    assert cache.get_files('2', '/.') is None
+    assert cache.get_files('1', '/.') is not None and cache.get_files('3', '/.') is not None
+    cache.close()
+
+
+def test_clear(tmp_path):
+    cache = open_cache(tmp_path)
+    cache.put_roots([('1', 7)])
+    cache.put_files('1', '/.', {'a'})
+    cache.clear()
+    assert cache.get_roots() is None and cache.get_files('1', '/.') is None
+    cache.close()
+
+
+def test_not_btrfs(tmp_path):
+    device = tmp_path / 'zero.img'
+    device.write_bytes(b'\0' * 128 * 1024)
+    assert ScanCache.for_device(str(device), path=str(tmp_path / 'cache.sqlite3')) is None
+
+
+def scan_root(tmp_path, device, **options):
+    # One root scanned by the engine with the cache in place
+    engine = ListEngine(device, False, EVERYTHING, use_cache=False, triage=False, **options)
+    engine.cache = open_cache(tmp_path)
+    try:
+        files, _ = engine.scan_root(ROOT)
+        return files, engine, engine.cache.get_files(ROOT, EVERYTHING)
+    finally:
+        engine.cache.close()
+
+
+def test_complete_scans_are_cached(tmp_path, fake_btrfs, monkeypatch):
+    files, engine, cached = scan_root(tmp_path, fake_btrfs)
+    assert len(files) == 30 and cached == files
+    # The next scan of the root doesn't run btrfs restore
+    monkeypatch.setenv('PATH', str(tmp_path / 'nothing'))
+    assert scan_root(tmp_path, fake_btrfs)[0] == files
+
+
+def test_failed_scans_are_not_cached(tmp_path, fake_btrfs, monkeypatch):
+    fakebin = tmp_path / 'failing'
+    fakebin.mkdir()
+    script = fakebin / 'btrfs'
+    script.write_text('#!/bin/sh\necho "Restoring /dev/null/partial"\nexit 1\n')
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', str(fakebin) + os.pathsep + os.environ['PATH'])
+    files, engine, cached = scan_root(tmp_path, fake_btrfs)
+    assert files == {'partial'}
+    assert engine.roots_failed == [ROOT] and cached is None
+
+
+def test_stopped_scans_are_not_cached(tmp_path, fake_btrfs, monkeypatch):
+    # Stopped by max_matches, even if the stub printed every path before it was
+    files, engine, cached = scan_root(tmp_path, fake_btrfs, max_matches=5)
+    assert len(files) >= 5 and cached is None
+    monkeypatch.setenv('BENCH_LINE_DELAY', '0.05')
+    files, engine, cached = scan_root(tmp_path, fake_btrfs, root_timeout=0.3)
+    assert len(files) < 30 and engine.roots_timed_out == [ROOT] and cached is None